@@ -0,0 +1,100 @@
+"""分子式生成重复运行延迟基准：每次新建进程池 vs 常驻预热进程池。
+
+用法：python benchmarks/bench_formula_worker_pool.py [--runs 5] [--spawn]
+--spawn 强制使用 spawn 启动方式，模拟 Windows 打包程序的进程启动开销。
+"""
+import argparse
+import multiprocessing
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from package.core.process_pool import ProcessPool
+from package.service.formula_generation_service import (
+    FormulaGenerator,
+    _SHARDS_PER_WORKER,
+    _run_windows_task,
+    normalize_elements,
+    plan_search_shards,
+    shutdown_worker_pool,
+    warm_up_worker_pool,
+)
+
+
+# 窄窗口：搜索本身很快，进程启动开销占主导
+CASES = {
+    'narrow': (181.0707, 0.0, 0.002, {'C': -1, 'N': -1, 'O': -1}),
+    'wide': (813.3, 0.0, 0.02, {'C': -1, 'N': -1, 'O': -1, 'S': -1, 'P': -1}),
+}
+ADDUCTS = ['H+']
+
+
+def _run_with_fresh_executor(generator: FormulaGenerator, m2z: float, error_pct: float, error_da: float, elements: dict) -> int:
+    # 复现旧实现：每次调用创建并销毁 ProcessPoolExecutor
+    order = normalize_elements(elements, generator.atomic_weights)
+    tolerance = generator._resolve_mw_tolerance(m2z, error_pct, error_da, 1)
+    max_workers = ProcessPool().max_workers
+    total = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for _, base_mw, _ in generator._build_adduct_tasks(m2z, 1, 'ESI+', ADDUCTS):
+            # 与进程池路径相同的子进程入口与分片方式，只是执行器每次新建
+            shards = plan_search_shards(base_mw, tolerance, order, max_workers * _SHARDS_PER_WORKER)
+            windows = [(base_mw - tolerance, base_mw + tolerance)]
+            futures = [
+                executor.submit(_run_windows_task, 'backtrack', windows, order, generator.atomic_weights, generator.element_categories, prefix, generator.heuristic_filter)
+                for prefix in shards
+            ]
+            total += sum(len(future.result()[0][0]) for future in futures)
+    return total
+
+
+def _run_with_warm_pool(generator: FormulaGenerator, m2z: float, error_pct: float, error_da: float, elements: dict) -> int:
+    results = generator.build_formula_results(m2z, error_pct, error_da, 1, 'ESI+', ADDUCTS, elements)
+    return sum(len(rows) for rows in results.values())
+
+
+def _measure(fn, runs: int, *args) -> list:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _report(label: str, timings: list) -> None:
+    print(f'  {label:<18} first={timings[0] * 1000:8.1f} ms  median={statistics.median(timings) * 1000:8.1f} ms  min={min(timings) * 1000:8.1f} ms')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--spawn', action='store_true')
+    args = parser.parse_args()
+    if args.spawn:
+        multiprocessing.set_start_method('spawn', force=True)
+
+    # 关闭查询缓存，保证每次都真实执行枚举
+    generator = FormulaGenerator(use_query_cache=False)
+    print(f'workers={ProcessPool().max_workers}, start_method={multiprocessing.get_start_method()}, runs={args.runs}')
+
+    start = time.perf_counter()
+    for future in warm_up_worker_pool():
+        future.result()
+    print(f'warm-up: {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    try:
+        for name, (m2z, error_pct, error_da, elements) in CASES.items():
+            print(f'[{name}] m/z={m2z}, error_da={error_da}')
+            _report('fresh executor', _measure(_run_with_fresh_executor, args.runs, generator, m2z, error_pct, error_da, elements))
+            _report('warm pool', _measure(_run_with_warm_pool, args.runs, generator, m2z, error_pct, error_da, elements))
+    finally:
+        shutdown_worker_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -39,6 +39,32 @@ class BaseConfig:
     BUTTON_HEIGHT_A = 1
     BUTTON_HEIGHT_B = 2
 
+    # 分子式生成常驻进程池的工作进程数，0 表示按 CPU 核数
+    FORMULA_GENERATION_WORKERS = 0
+    # 分子式查询结果缓存：内存 LRU 条目数与磁盘容量上限（MB）
+    FORMULA_QUERY_CACHE_MEMORY_ENTRIES = 64
+    FORMULA_QUERY_CACHE_DISK_MB = 256
+    # 保留最近枚举窗口的 (元素, base_mw) 组合数，用于误差放宽 / 收窄时增量复用
+    FORMULA_WINDOW_STORE_ENTRIES = 16
+    # 多个加合物时合并各自的质量窗口只枚举一次（backtrack / vectorized 引擎）
+    FORMULA_SHARED_ADDUCT_ENUMERATION = True
+    # 提供 M+1 / M+2 观测强度时，按同位素峰型得分只保留前 N 条候选
+    FORMULA_ISOTOPE_TOP_N = 300
+    # 单次分析未指定 engine 时使用的枚举引擎：'library' 先在预计算分子式库中二分查找，库未覆盖该查询时改用向量化枚举
+    FORMULA_GENERATION_ENGINE = 'library'
+    # 启动时在后台构建（已存在则复用）的预计算分子式库：元素上限（-1 为不限）与质量上限（Da）；元素为空时不构建
+    FORMULA_LIBRARY_ELEMENTS = {'C': -1, 'H': -1, 'N': -1, 'O': -1, 'S': -1, 'P': -1}
+    FORMULA_LIBRARY_MW_LIMIT = 500.0
+    # 枚举时应用 chem_element_config.json 中 heuristic_rules 的启发式筛选（元素比例、SENIOR 规则）的默认值；
+    # 页面上可逐次开关，开关状态与规则阈值写入结果的 input_params
+    FORMULA_HEURISTIC_FILTER = False
+    # 单次分析结果的导出格式：'json' 便于与其他程序交换；大结果集可改为列式二进制 'npz' / 'parquet'（需安装 pyarrow）
+    FORMULA_GENERATION_EXPORT_FORMAT = 'json'
+    # 单次分析结果的保存方式：'sync' 写完文件再返回，'async' 先返回结果、由后台线程写出，'manual' 只在手动保存时写出
+    FORMULA_GENERATION_SAVE_MODE = 'sync'
+    # 流式分析的导出格式：'json' / 'csv' / 'csv.gz'
+    FORMULA_STREAM_EXPORT_FORMAT = 'json'
+
     # PubChem 检索策略（服务层）
     PUBCHEM_MAX_RETRIES = 3
     PUBCHEM_RETRY_BASE_DELAY_SEC = 2
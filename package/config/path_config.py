@@ -123,6 +123,11 @@ class PathManager:
         self.formula_generation_cache_path = _get_cache_path(self.mass_finding_cache_path, 'formula_generation_cache')
         return self.formula_generation_cache_path
     
+    def get_formula_library_path(self) -> Path:
+        formula_generation_cache_path = self.get_formula_generation_cache_path()
+        self.formula_library_path = _get_cache_path(formula_generation_cache_path, 'formula_library')
+        return self.formula_library_path
+
     def get_formula_search_cache_path(self) -> Path:
         if not hasattr(self, 'mass_finding_cache_path'):
             self.get_mass_finding_cache_path()
@@ -0,0 +1,78 @@
+import atexit
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class BackgroundWriter:
+    """后台写出线程：按提交顺序逐个执行文件写出任务，不占用分析与界面线程。
+
+    线程在首次提交时创建；shutdown 会先写完队列中剩余的任务再返回，进程退出时由 atexit 兜底调用。
+    """
+    _instance = None
+    _thread = None
+    _queue = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+            atexit.register(cls._instance.shutdown)
+        return cls._instance
+
+    def _ensure_thread(self) -> queue.Queue:
+        with self._lock:
+            if BackgroundWriter._thread is None:
+                BackgroundWriter._queue = queue.Queue()
+                BackgroundWriter._thread = threading.Thread(target=self._worker, args=(BackgroundWriter._queue,), name='BackgroundWriter', daemon=True)
+                BackgroundWriter._thread.start()
+            return BackgroundWriter._queue
+
+    @staticmethod
+    def _worker(task_queue: queue.Queue) -> None:
+        while True:
+            task = task_queue.get()
+            try:
+                if task is None:
+                    return
+                future, fn, args, kwargs = task
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as ex:
+                    logging.error(f'后台写出失败: {ex}', exc_info=True)
+                    future.set_exception(ex)
+            finally:
+                task_queue.task_done()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        self._ensure_thread().put((future, fn, args, kwargs))
+        return future
+
+    def pending(self) -> int:
+        task_queue = BackgroundWriter._queue
+        return task_queue.unfinished_tasks if task_queue is not None else 0
+
+    def flush(self) -> None:
+        # 阻塞到目前已提交的任务全部写完
+        task_queue = BackgroundWriter._queue
+        if task_queue is not None:
+            task_queue.join()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            thread = BackgroundWriter._thread
+            task_queue = BackgroundWriter._queue
+            BackgroundWriter._thread = None
+            BackgroundWriter._queue = None
+        if thread is None:
+            return
+        remaining = task_queue.unfinished_tasks
+        if remaining:
+            logging.info(f'正在写出剩余的 {remaining} 个结果文件')
+        # 结束标记排在已提交任务之后，线程写完全部任务后才退出
+        task_queue.put(None)
+        thread.join()
@@ -0,0 +1,78 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from ..config.base_config import BaseConfig
+
+
+class ProcessPool:
+    """常驻进程池：首次使用时创建，跨多次分析复用，退出时统一关闭"""
+    _instance = None
+    _executor = None
+    _manager = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    @property
+    def max_workers(self) -> int:
+        configured = int(BaseConfig.FORMULA_GENERATION_WORKERS or 0)
+        return configured if configured > 0 else max(1, os.cpu_count() or 1)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if ProcessPool._executor is None:
+                ProcessPool._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                logging.info(f'进程池已创建，工作进程数={self.max_workers}')
+            return ProcessPool._executor
+
+    def _get_manager(self):
+        with self._lock:
+            if ProcessPool._manager is None:
+                ProcessPool._manager = multiprocessing.Manager()
+            return ProcessPool._manager
+
+    def create_queue(self, maxsize: int = 0):
+        # 可随任务参数传递给工作进程的有界队列，用于分块回传结果
+        return self._get_manager().Queue(maxsize)
+
+    def create_event(self):
+        return self._get_manager().Event()
+
+    def submit(self, fn, *args, **kwargs):
+        try:
+            return self._get_executor().submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            # 工作进程异常退出后进程池不可再用，丢弃并重建一次
+            logging.warning('进程池已损坏，正在重建')
+            self.shutdown()
+            return self._get_executor().submit(fn, *args, **kwargs)
+
+    def warm_up(self, fn, *args):
+        # 每个工作进程各投递一个预热任务，提前完成解释器启动与模块导入
+        return [self.submit(fn, *args) for _ in range(self.max_workers)]
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor = ProcessPool._executor
+            manager = ProcessPool._manager
+            ProcessPool._executor = None
+            ProcessPool._manager = None
+        if executor is not None:
+            # 取消排队任务并结束仍在计算的进程，避免关闭窗口后等待长时间搜索
+            processes = list((getattr(executor, '_processes', None) or {}).values())
+            executor.shutdown(wait=False, cancel_futures=True)
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            logging.info('进程池已关闭')
+        # 工作进程退出后再关闭队列所在的 manager 进程
+        if manager is not None:
+            manager.shutdown()
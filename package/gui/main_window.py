@@ -14,6 +14,7 @@ import platform
 from PIL import Image, ImageTk
 from ..config.path_config import PathManager
 from ..service.cache_index_service import sync_formula_index_cache
+from ..service.formula_generation_service import shutdown_result_writer, shutdown_worker_pool, start_formula_library_build, warm_up_worker_pool
 
 class APP(tk.Tk):
     def __init__(self):
@@ -21,6 +22,8 @@ class APP(tk.Tk):
         self._right_ratio = (1, 1)
         self.path_manager = PathManager()
         self._sync_formula_indexes_on_startup()
+        self._warm_up_formula_workers()
+        self._build_formula_library_in_background()
         self._init_window()
         self._init_components()
         self._setup_layout()
@@ -40,6 +43,18 @@ class APP(tk.Tk):
         except Exception as ex:
             logging.warning(f"启动阶段同步 formula 索引失败: {ex}")
 
+    def _warm_up_formula_workers(self):
+        try:
+            warm_up_worker_pool()
+        except Exception as ex:
+            logging.warning(f"启动阶段预热分子式生成进程池失败: {ex}")
+
+    def _build_formula_library_in_background(self):
+        try:
+            start_formula_library_build()
+        except Exception as ex:
+            logging.warning(f"启动阶段构建分子式库失败: {ex}")
+
     def _init_window(self):
         super().__init__()
         self.current_status_text = "done"
@@ -461,6 +476,15 @@ class APP(tk.Tk):
             )
             if not should_close:
                 return
+        try:
+            shutdown_worker_pool()
+        except Exception as ex:
+            logging.warning(f"关闭分子式生成进程池失败: {ex}")
+        try:
+            # 等待后台队列中的结果文件写完，避免关闭窗口丢失尚未落盘的结果
+            shutdown_result_writer()
+        except Exception as ex:
+            logging.warning(f"写出剩余结果文件失败: {ex}")
         self.destroy()
 
     def _setup_initial_page(self):
@@ -3,7 +3,9 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from .base_page import BasePage
 from ...core.thread_pool import ThreadPool
-from ...service.formulaGeneration import start_analysis
+from ...service.formulaGeneration import save_analysis_result, start_analysis
+from ...service.formula_result_table_service import FormulaResultTable
+from ...service.public import read_formula_generation_columns
 from ...utils.data_validator import DataValidator
 from ...utils.widget_factory import WidgetFactory
 from ...config.AppUI_config import AppUIConfig
@@ -15,7 +17,17 @@ import json
 import tkinter.font as tkFont
 from pathlib import Path
 import re
+import threading
 from functools import partial
+import numpy as np
+
+# 虚拟滚动时在可见行之外额外渲染的行数
+_VIRTUAL_ROW_BUFFER = 2
+# 后台筛选每块扫描的行数；每块之间检查取消标记并回报进度
+_FILTER_BLOCK_ROWS = 65536
+# 累计命中达到该行数后先把已有结果推送到表格，不等整表扫描完成
+_FILTER_PREVIEW_ROWS = 200
+
 
 class FormulaGenerationPage(BasePage):
 
@@ -53,7 +65,12 @@ class FormulaGenerationPage(BasePage):
         self._setup_buttons()
 
         # 数据存储
-        self.data = []
+        self.table_model = FormulaResultTable.empty()
+        # 表格当前按顺序显示的模型行下标
+        self.displayed_rows = np.zeros(0, dtype=np.int64)
+        self.last_result = None
+        # last_result 正在后台写出时的 Future，避免重复提交写出
+        self._result_save_future = None
 
         # 线程池实例
         self.thread_pool = ThreadPool()
@@ -218,6 +235,29 @@ class FormulaGenerationPage(BasePage):
         entry = self.widget_factory.create_entry(error_da_frame, textvariable=self.error_da, **AppUIConfig.FunctionZone.FormulaGenerationPage.input_entry)
         entry.pack(**AppUIConfig.FunctionZone.FormulaGenerationPage.padding)
 
+        # 第三行：误差范围（ppm），按 m/z 等比缩放
+        error_ppm_frame = create_grid_input_frame(params_frame, "误差范围 (ppm)", 2, 0)
+        self.error_ppm = tk.DoubleVar(value=0.0)
+        entry = self.widget_factory.create_entry(error_ppm_frame, textvariable=self.error_ppm, **AppUIConfig.FunctionZone.FormulaGenerationPage.input_entry)
+        entry.pack(**AppUIConfig.FunctionZone.FormulaGenerationPage.padding)
+
+        # 同位素观测强度（相对 M 峰 %），填写后按峰型得分只保留得分最高的候选；0 表示不使用
+        isotope_m1_frame = create_grid_input_frame(params_frame, "M+1 强度 (%)", 2, 1)
+        self.isotope_m1 = tk.DoubleVar(value=0.0)
+        entry = self.widget_factory.create_entry(isotope_m1_frame, textvariable=self.isotope_m1, **AppUIConfig.FunctionZone.FormulaGenerationPage.input_entry)
+        entry.pack(**AppUIConfig.FunctionZone.FormulaGenerationPage.padding)
+
+        isotope_m2_frame = create_grid_input_frame(params_frame, "M+2 强度 (%)", 3, 0)
+        self.isotope_m2 = tk.DoubleVar(value=0.0)
+        entry = self.widget_factory.create_entry(isotope_m2_frame, textvariable=self.isotope_m2, **AppUIConfig.FunctionZone.FormulaGenerationPage.input_entry)
+        entry.pack(**AppUIConfig.FunctionZone.FormulaGenerationPage.padding)
+
+        # 启发式筛选（元素比例、SENIOR 规则）会缩小结果集，默认值取 BaseConfig.FORMULA_HEURISTIC_FILTER
+        heuristic_frame = create_grid_input_frame(params_frame, "启发式筛选", 3, 1)
+        self.heuristic_filter = tk.BooleanVar(value=BaseConfig.FORMULA_HEURISTIC_FILTER)
+        cb = self.widget_factory.create_checkbutton(heuristic_frame, text="元素比例 / SENIOR", variable=self.heuristic_filter)
+        cb.pack(**AppUIConfig.FunctionZone.FormulaGenerationPage.padding)
+
         # 元素配置区优化
         elements = ["C", "N", "O", "S", "P", "Si", "F", "Cl", "Br", "I", "B", "Se"]
         self.element_vars = {
@@ -265,7 +305,7 @@ class FormulaGenerationPage(BasePage):
         table_frame.pack(side=tk.BOTTOM, fill=tk.BOTH, expand=True)
 
         self.filter_fields_order = [
-            "Adduct", "M/Z", "DBR", "C", "H", "N", "O", "S", "P", "Si", "F", "Cl", "Br", "I", "B", "Se", "Mol Weight"
+            "Adduct", "M/Z", "DBR", "C", "H", "N", "O", "S", "P", "Si", "F", "Cl", "Br", "I", "B", "Se", "Mol Weight", "Iso Score"
         ]
         self.element_filter_fields = {"C", "H", "N", "O", "S", "P", "Si", "F", "Cl", "Br", "I", "B", "Se"}
         self.integer_filter_fields = set(self.element_filter_fields) | {"DBR"}
@@ -278,8 +318,18 @@ class FormulaGenerationPage(BasePage):
         self.applied_conditions = []
         self.applied_conditions_signature = []
         self.is_filter_dirty = False
+        self._filter_request_id = 0
+        self._filter_cancel_event = None
+        self._filter_preview_request_id = None
+        # 点击表头排序的状态；排序只重排 displayed_rows，不重新执行筛选
+        self._sort_column = None
+        self._sort_descending = False
         self._current_table_context = {"row_id": "", "column_name": "", "cell_value": ""}
         self._table_selection_anchor = None
+        # 虚拟滚动状态：窗口首行在 displayed_rows 中的位置，以及按位置记录的选中行
+        self._view_top = 0
+        self._selected_positions = set()
+        self._is_rendering_view = False
 
         # 筛选行视觉样式（局部样式，不影响其他页面）
         self.filter_row_even_bg = "#fafafa"
@@ -328,7 +378,8 @@ class FormulaGenerationPage(BasePage):
         columns = list(self.filter_fields_order)
 
         # 表格部分
-        vsb = tk.Scrollbar(table_frame, orient=tk.VERTICAL)
+        # 虚拟滚动：Treeview 只保留可见窗口内的行，纵向滚动条按 displayed_rows 的总行数换算
+        self.table_vsb = tk.Scrollbar(table_frame, orient=tk.VERTICAL, command=self._on_table_yscroll)
         hsb = tk.Scrollbar(table_frame, orient=tk.HORIZONTAL)
         self.table = ttk.Treeview(
             table_frame,
@@ -337,11 +388,9 @@ class FormulaGenerationPage(BasePage):
             show="headings",
             selectmode="extended",
             xscrollcommand=hsb.set,
-            yscrollcommand=vsb.set
         )
-        vsb.config(command=self.table.yview)
         hsb.config(command=self.table.xview)
-        vsb.pack(side=tk.RIGHT, fill=tk.Y)
+        self.table_vsb.pack(side=tk.RIGHT, fill=tk.Y)
         hsb.pack(side=tk.BOTTOM, fill=tk.X)
         self.table.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
 
@@ -355,7 +404,7 @@ class FormulaGenerationPage(BasePage):
         )
 
         for col in columns:
-            self.table.heading(col, text=col)
+            self.table.heading(col, text=col, command=partial(self._on_table_heading_click, col))
             self.table.column(col, minwidth=50, anchor=tk.CENTER, stretch=False)
 
         self.table_popup_menu = self.widget_factory.create_menu(self.table, tearoff=0)
@@ -370,6 +419,14 @@ class FormulaGenerationPage(BasePage):
 
         self.table.bind("<Double-1>", self._on_table_double_click)
         self.table.bind("<Delete>", self._on_delete_shortcut)
+        self.table.bind("<MouseWheel>", self._on_table_mousewheel)
+        # Linux/X11 下滚轮事件为 Button-4 / Button-5，不产生 <MouseWheel>
+        self.table.bind("<Button-4>", self._on_table_mousewheel)
+        self.table.bind("<Button-5>", self._on_table_mousewheel)
+        self.table.bind("<Configure>", lambda _event: self._render_visible_rows())
+        self.table.bind("<<TreeviewSelect>>", self._on_table_select, add="+")
+        for key, step in (("<Up>", -1), ("<Down>", 1), ("<Prior>", "-page"), ("<Next>", "page"), ("<Home>", "home"), ("<End>", "end")):
+            self.table.bind(key, partial(self._on_table_key_scroll, step))
 
         self.result_stats_label = self.widget_factory.create_label(
             self.right_frame,
@@ -403,7 +460,7 @@ class FormulaGenerationPage(BasePage):
 
     def _build_filter_field_meta(self):
         numeric_fields = [
-            "M/Z", "DBR", "C", "H", "N", "O", "S", "P", "Si", "F", "Cl", "Br", "I", "B", "Se", "Mol Weight"
+            "M/Z", "DBR", "C", "H", "N", "O", "S", "P", "Si", "F", "Cl", "Br", "I", "B", "Se", "Mol Weight", "Iso Score"
         ]
         meta = {
             "Adduct": {
@@ -898,34 +955,125 @@ class FormulaGenerationPage(BasePage):
         if not applying:
             self._refresh_filter_field_options()
 
-    def _filter_data_chunked(self, source_data, conditions, chunk_size=500):
-        matched_rows = []
-        for idx in range(0, len(source_data), chunk_size):
-            chunk = source_data[idx: idx + chunk_size]
-            for item in chunk:
-                if all(self._item_match_condition(item, condition) for condition in conditions):
-                    matched_rows.append(item)
-            if idx + chunk_size < len(source_data):
-                self.update_idletasks()
-        return matched_rows
-
-    def _render_rows_chunked(self, rows, start_idx=0, chunk_size=300):
-        end_idx = min(start_idx + chunk_size, len(rows))
-        for item in rows[start_idx:end_idx]:
-            values = [item[col] for col in self.table["columns"]]
-            self.table.insert("", "end", values=values, tags=(json.dumps(item),))
-        if end_idx < len(rows):
-            self.after(1, partial(self._render_rows_chunked, rows, end_idx, chunk_size))
+    def _render_rows(self, rows, keep_view=False):
+        # rows 为模型中的行下标；只渲染可见窗口，耗时与结果总数无关
+        if not keep_view:
+            self._view_top = 0
+            self._selected_positions = set()
+        self._render_visible_rows()
+        self._show_empty_result_guidance(len(rows) == 0)
+        self._set_filter_action_state(False)
+
+    def _visible_row_capacity(self):
+        row_height = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        # 表头约占一行；另外多渲染 _VIRTUAL_ROW_BUFFER 行作为缓冲，避免底部露出空白
+        return max(1, self.table.winfo_height() // row_height - 1) + _VIRTUAL_ROW_BUFFER
+
+    def _render_visible_rows(self):
+        total = len(self.displayed_rows)
+        capacity = self._visible_row_capacity()
+        page_size = max(1, capacity - _VIRTUAL_ROW_BUFFER)
+        self._view_top = max(0, min(self._view_top, total - page_size))
+        top = self._view_top
+        window = self.displayed_rows[top: top + capacity].tolist()
+
+        self._is_rendering_view = True
+        try:
+            self.table.delete(*self.table.get_children())
+            selected = []
+            for offset, (index, values) in enumerate(zip(window, self.table_model.format_rows(window, self.table["columns"]))):
+                # 行 id 即模型中的行下标，交互时直接由 id 取回数据
+                row_id = self.table.insert("", "end", iid=str(index), values=values)
+                if top + offset in self._selected_positions:
+                    selected.append(row_id)
+            self.table.selection_set(selected)
+            self.table.yview_moveto(0)
+        finally:
+            self._is_rendering_view = False
+
+        if total:
+            self.table_vsb.set(top / total, min(1.0, (top + page_size) / total))
         else:
-            self._show_empty_result_guidance(len(rows) == 0)
-            self._set_filter_action_state(False)
+            self.table_vsb.set(0.0, 1.0)
+
+    def _scroll_view_to(self, top):
+        if top != self._view_top:
+            self._view_top = top
+            self._render_visible_rows()
+
+    def _on_table_yscroll(self, action, amount, unit=None):
+        page_size = max(1, self._visible_row_capacity() - _VIRTUAL_ROW_BUFFER)
+        if action == "moveto":
+            top = int(float(amount) * len(self.displayed_rows))
+        elif unit == "pages":
+            top = self._view_top + int(amount) * page_size
+        else:
+            top = self._view_top + int(amount)
+        self._scroll_view_to(max(0, top))
+
+    def _on_table_mousewheel(self, event):
+        # Windows/macOS 用 delta 表示滚动方向（macOS 的 delta 可能小于 120）；X11 用 num 4（向上）/ 5（向下）
+        num = getattr(event, "num", None)
+        if num == 4:
+            notches = 1
+        elif num == 5:
+            notches = -1
+        else:
+            delta = getattr(event, "delta", 0) or 0
+            notches = int(delta / 120) or (1 if delta > 0 else -1 if delta < 0 else 0)
+        self._scroll_view_to(max(0, self._view_top - notches * 3))
+        return "break"
+
+    def _on_table_key_scroll(self, step, _event=None):
+        # 焦点行到达窗口边缘时滚动窗口，而不是让 Treeview 在已渲染的少量行内移动
+        if not len(self.displayed_rows):
+            return "break"
+        page_size = max(1, self._visible_row_capacity() - _VIRTUAL_ROW_BUFFER)
+        children = self.table.get_children()
+        focus = self.table.focus()
+        position = self._view_top + (children.index(focus) if focus in children else 0)
+        target = {
+            "home": 0,
+            "end": len(self.displayed_rows) - 1,
+            "page": position + page_size,
+            "-page": position - page_size,
+        }.get(step, position + step if isinstance(step, int) else position)
+        target = max(0, min(target, len(self.displayed_rows) - 1))
+        if target < self._view_top:
+            self._view_top = target
+        elif target >= self._view_top + page_size:
+            self._view_top = target - page_size + 1
+        self._selected_positions = {target}
+        self._render_visible_rows()
+        children = self.table.get_children()
+        offset = target - self._view_top
+        if 0 <= offset < len(children):
+            self.table.focus(children[offset])
+        return "break"
+
+    def _selected_model_rows(self):
+        # 选中行（含已滚出窗口的行）对应的模型行下标，按显示顺序排列
+        self._on_table_select()
+        positions = sorted(position for position in self._selected_positions if position < len(self.displayed_rows))
+        return self.displayed_rows[positions].tolist()
+
+    def _on_table_select(self, _event=None):
+        # 只更新窗口内各行的选中状态，窗口外已选中的行保持不变
+        if self._is_rendering_view:
+            return
+        children = self.table.get_children()
+        selected = set(self.table.selection())
+        window = range(self._view_top, self._view_top + len(children))
+        self._selected_positions.difference_update(window)
+        self._selected_positions.update(self._view_top + offset for offset, row_id in enumerate(children) if row_id in selected)
 
     def _get_current_adduct_filter_options(self):
         mode_adducts = self._get_adduct_config().get(self.ms_mode.get(), [])
+        table_model = getattr(self, 'table_model', None)
         data_adducts = [
-            str(item.get("Adduct", "")).strip()
-            for item in getattr(self, 'data', [])
-            if str(item.get("Adduct", "")).strip()
+            str(adduct).strip()
+            for adduct in (table_model.present_adducts() if table_model is not None else [])
+            if str(adduct).strip()
         ]
         return list(dict.fromkeys(mode_adducts + data_adducts))
 
@@ -934,25 +1082,25 @@ class FormulaGenerationPage(BasePage):
         for col in self.table["columns"]:
             if col in visible_cols:
                 continue
-            if any(str(item.get(col, 0)) not in ("0", "0.0", "") for item in self.data):
+            if self.table_model.has_values(col):
                 visible_cols.append(col)
         self.table["displaycolumns"] = visible_cols
 
     def auto_resize_columns(self):
-        """更新列宽计算逻辑以适应新格式"""
+        """按列统计中最长的几个显示字符串计算列宽，耗时与行数无关"""
+        font = tkFont.Font()
         for col in self.table["columns"]:
             current_width = self.table.column(col, "width")
             if current_width <= 0:
                 continue
             
-            font = tkFont.Font()
             title_width = font.measure(col) + 20  # 标题宽度
             
-            # 计算内容最大宽度（已格式化为4位小数）
+            # 内容宽度只测量该列最长的若干个不同显示字符串（已格式化为4位小数）
             content_width = max(
-                font.measure(str(item.get(col, ""))) 
-                for item in self.data
-            ) if self.data else 0
+                (font.measure(text) for text in self.table_model.widest_strings(col)),
+                default=0
+            )
             
             new_width = max(title_width, content_width)
             self.table.column(col, width=new_width, minwidth=new_width, stretch=False)
@@ -975,9 +1123,9 @@ class FormulaGenerationPage(BasePage):
                 logging.warning(f"切换导入目录失败，将仅使用默认目录参数: {ex}")
 
             file_path = filedialog.askopenfilename(
-                title="选择JSON文件",
+                title="选择结果文件",
                 initialdir=str(initial_dir),
-                filetypes=[("JSON文件", "*.json"), ("所有文件", "*.*")]
+                filetypes=[("结果文件", "*.json *.npz *.parquet"), ("JSON文件", "*.json"), ("列式结果文件", "*.npz *.parquet"), ("所有文件", "*.*")]
             )
         finally:
             try:
@@ -986,19 +1134,24 @@ class FormulaGenerationPage(BasePage):
                 logging.warning(f"恢复工作目录失败: {ex}")
         if file_path:
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                required_keys = ["metadata", "input_params", "results"]
-                if not all(key in data for key in required_keys):
-                    raise ValueError("JSON文件缺少必要结构: {}".format(
-                        ", ".join([k for k in required_keys if k not in data])
-                    ))
-                
-                if not isinstance(data["results"], list):
-                    raise TypeError("results字段必须为数组类型")
-                
-                self.data = self._map_data(data["results"])
+                if Path(file_path).suffix.lower() in (".npz", ".parquet"):
+                    # 列式结果文件：各列整体读出，不逐条解析
+                    data = read_formula_generation_columns(file_path)
+                    self.table_model = FormulaResultTable.from_columns(data["columns"])
+                else:
+                    with open(file_path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+
+                    required_keys = ["metadata", "input_params", "results"]
+                    if not all(key in data for key in required_keys):
+                        raise ValueError("JSON文件缺少必要结构: {}".format(
+                            ", ".join([k for k in required_keys if k not in data])
+                        ))
+
+                    if not isinstance(data["results"], list):
+                        raise TypeError("results字段必须为数组类型")
+
+                    self.table_model = FormulaResultTable.from_records(data["results"])
                 self._refresh_adduct_filter_options()
                 self._apply_filters()
                 self.auto_resize_columns()
@@ -1024,6 +1177,9 @@ class FormulaGenerationPage(BasePage):
                 logging.info(f"- m/z: {data['input_params']['m2z']}")
                 logging.info(f"- 误差范围: ±{data['input_params']['error_pct']}%")
                 logging.info(f"- 误差范围: ±{data['input_params'].get('error_da', 0)} Da")
+                logging.info(f"- 误差范围: ±{data['input_params'].get('error_ppm', 0)} ppm")
+                if data['input_params'].get('isotope_m1') or data['input_params'].get('isotope_m2'):
+                    logging.info(f"- 同位素强度: M+1 {data['input_params'].get('isotope_m1', 0)}%, M+2 {data['input_params'].get('isotope_m2', 0)}%")
                 logging.info(f"- 电荷数: {data['input_params']['charge']}")
                 logging.info(f"- 元素配置: {element_config_str}")
                 
@@ -1076,17 +1232,44 @@ class FormulaGenerationPage(BasePage):
         )
         btn_refresh.grid(row=1, column=0, sticky="ew", padx=(0, BaseConfig.PADDING_A), pady=(BaseConfig.PADDING_A, 0))
 
-        btn_placeholder = self.widget_factory.create_rounded_button(
+        btn_save = self.widget_factory.create_rounded_button(
             btn_frame,
-            text="",
-            command=lambda: None,
-            cooldown=0,
-            width=10,
-            height=34,
-            hover_bg=BaseConfig.PRIMARY_COLOR,
+            text="保存结果",
+            command=self._save_results,
+            **common_button_kwargs,
         )
-        btn_placeholder.config(state=tk.DISABLED)
-        btn_placeholder.grid(row=1, column=1, sticky="ew", padx=(BaseConfig.PADDING_A, 0), pady=(BaseConfig.PADDING_A, 0))
+        btn_save.grid(row=1, column=1, sticky="ew", padx=(BaseConfig.PADDING_A, 0), pady=(BaseConfig.PADDING_A, 0))
+
+    def _save_results(self):
+        # 结果文件只由服务层写出一次：已保存或正在后台写出时只报告路径，尚未保存（manual 模式）时才提交写出
+        result = self.last_result
+        if not result:
+            logging.warning("当前没有可保存的分析结果")
+            return
+        if result.get("results_path"):
+            logging.info(f"结果已保存: {result['results_path']}")
+            return
+        future = self._result_save_future
+        if future is None:
+            try:
+                future = save_analysis_result(result)
+            except Exception as ex:
+                logging.error(f"保存结果失败: {ex}")
+                return
+            self._result_save_future = future
+        if not future.done():
+            logging.info("结果正在后台保存...")
+        future.add_done_callback(lambda done: self._on_result_saved(result, done))
+
+    def _on_result_saved(self, result, future):
+        if future.exception() is not None:
+            logging.error(f"保存结果失败: {future.exception()}")
+            # 写出失败后允许再次点击保存重试
+            if self._result_save_future is future:
+                self._result_save_future = None
+            return
+        result["results_path"] = future.result()
+        logging.info(f"结果已保存: {result['results_path']}")
 
     def _refresh_page(self):
         self.event_mgr.publish(
@@ -1099,7 +1282,11 @@ class FormulaGenerationPage(BasePage):
         self.m2z.set(100)
         self.error_pct.set(0.1)
         self.error_da.set(0.0)
+        self.error_ppm.set(0.0)
+        self.isotope_m1.set(0.0)
+        self.isotope_m2.set(0.0)
         self.charge.set(1)
+        self.heuristic_filter.set(BaseConfig.FORMULA_HEURISTIC_FILTER)
         
         # 2. 重置元素配置
         for elem in self.element_vars:
@@ -1110,9 +1297,14 @@ class FormulaGenerationPage(BasePage):
         self._on_ms_mode_change()  # 触发模式变化以重建加合物选项
         
         # 4. 清空表格数据
-        self.data = []
+        self.table_model = FormulaResultTable.empty()
+        self.displayed_rows = np.zeros(0, dtype=np.int64)
+        self.last_result = None
+        self._result_save_future = None
         self._refresh_adduct_filter_options()
-        self.table.delete(*self.table.get_children())
+        self._view_top = 0
+        self._selected_positions = set()
+        self._render_visible_rows()
         
         # 5. 清除筛选条件
         self._clear_filter_conditions(reapply=False)
@@ -1134,8 +1326,12 @@ class FormulaGenerationPage(BasePage):
             "m2z": self.m2z.get(),
             "error_pct": self.error_pct.get(),
             "error_da": self.error_da.get(),
+            "error_ppm": self.error_ppm.get(),
+            "isotope_m1": self.isotope_m1.get(),
+            "isotope_m2": self.isotope_m2.get(),
             "charge": self.charge.get(),
-            "elements": {k: v.get() for k, v in self.element_vars.items()}
+            "elements": {k: v.get() for k, v in self.element_vars.items()},
+            "heuristic_filter": bool(self.heuristic_filter.get())
         }
 
         validator = DataValidator()
@@ -1172,7 +1368,16 @@ class FormulaGenerationPage(BasePage):
     def _run_analysis_background(self, params):
         try:
             result = start_analysis(params)
-            self.data = self._map_data(result["results"])
+            # async 保存模式下服务层已提交写出，页面只持有其 Future，不再重复写出
+            self._result_save_future = result.pop("save_future", None)
+            self.last_result = result if result.get("result_count") or result.get("results") else None
+            if "columns" in result:
+                table_model = FormulaResultTable.from_columns(result["columns"])
+            else:
+                table_model = FormulaResultTable.from_records(result["results"])
+            # 列统计在后台线程中算好，界面线程上的列宽与隐藏列计算只读缓存
+            table_model.compute_column_stats()
+            self.table_model = table_model
             self.after(0, self._refresh_adduct_filter_options)
             self.after(0, self._apply_filters)
             self.after(0, self.auto_resize_columns)
@@ -1182,47 +1387,6 @@ class FormulaGenerationPage(BasePage):
         finally:
             self.after(0, self.event_mgr.publish, EventType.STATUS_UPDATE, {"status_text": "done"})
 
-    def _map_data(self, raw_data):
-        mapped = []
-        for item in raw_data:
-            formula_data = item.get("formula", item.get("elements", {})) or {}
-            row = {
-                "M/Z": self._format_float(item["calculated_properties"].get("predicted_mz", "")),
-                "Adduct": item["adduct_type"],
-                "Mol Weight": self._format_float(item["calculated_properties"].get("molecular_weight", "")),
-                "DBR": item["calculated_properties"].get("dbr", ""),
-                "C": self._normalize_element_count(formula_data.get("C", 0)),
-                "H": self._normalize_element_count(formula_data.get("H", 0)),
-                "N": self._normalize_element_count(formula_data.get("N", 0)),
-                "O": self._normalize_element_count(formula_data.get("O", 0)),
-                "S": self._normalize_element_count(formula_data.get("S", 0)),
-                "P": self._normalize_element_count(formula_data.get("P", 0)),
-                "Si": self._normalize_element_count(formula_data.get("Si", 0)),
-                "F": self._normalize_element_count(formula_data.get("F", 0)),
-                "Cl": self._normalize_element_count(formula_data.get("Cl", 0)),
-                "Br": self._normalize_element_count(formula_data.get("Br", 0)),
-                "I": self._normalize_element_count(formula_data.get("I", 0)),
-                "B": self._normalize_element_count(formula_data.get("B", 0)),
-                "Se": self._normalize_element_count(formula_data.get("Se", 0)),
-            }
-            mapped.append(row)
-        return mapped
-
-    def _normalize_element_count(self, value):
-        if value in ("", None):
-            return 0
-        try:
-            return int(float(value))
-        except (ValueError, TypeError):
-            return 0
-
-    def _format_float(self, value):
-        """统一浮点数格式化方法"""
-        try:
-            return f"{float(value):.4f}"  # 强制保留4位小数（自动四舍五入）
-        except (ValueError, TypeError):
-            return str(value)  # 非数值类型直接转字符串
-    
     def _apply_filters(self, *args):
         self.filter_feedback_label.configure(text="")
         conditions = self._collect_filter_conditions()
@@ -1230,14 +1394,106 @@ class FormulaGenerationPage(BasePage):
             return
 
         self._set_filter_action_state(True)
-        self.table.delete(*self.table.get_children())
-        filtered_rows = self._filter_data_chunked(self.data, conditions)
+        # 条件编译为按列合并的掩码表达式，在线程池中分块求值，结果经 after 回到 Tk 线程渲染
+        table_model = self.table_model
+        compiled_filter = table_model.compile_filter(conditions)
+        # 新的筛选请求取消仍在扫描的旧请求
+        if self._filter_cancel_event is not None:
+            self._filter_cancel_event.set()
+        cancel_event = threading.Event()
+        self._filter_cancel_event = cancel_event
+        self._filter_request_id += 1
+        request = (self._filter_request_id, table_model, conditions, self._serialize_draft_conditions())
+        try:
+            self.thread_pool.submit(self._run_filter_background, request, compiled_filter, cancel_event)
+        except Exception as ex:
+            logging.error(f"提交筛选任务失败: {ex}")
+            self._set_filter_action_state(False)
+
+    def _run_filter_background(self, request, compiled_filter, cancel_event):
+        try:
+            total = len(compiled_filter.table)
+            blocks = []
+            matched_count = 0
+            preview_sent = False
+            for scanned, block_rows in compiled_filter.iter_matches(_FILTER_BLOCK_ROWS):
+                if cancel_event.is_set():
+                    return
+                blocks.append(block_rows)
+                matched_count += len(block_rows)
+                if scanned >= total:
+                    break
+                # 命中数首次达到阈值时推送已有结果，之后每块只回报扫描进度与命中数
+                preview_rows = None
+                if not preview_sent and matched_count >= _FILTER_PREVIEW_ROWS:
+                    preview_rows = np.concatenate(blocks)
+                    preview_sent = True
+                self.after(0, self._on_filter_progress, request, preview_rows, scanned, matched_count)
+            filtered_rows = np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.int64)
+        except Exception as ex:
+            logging.error(f"筛选失败: {ex}")
+            filtered_rows = None
+        self.after(0, self._on_filter_done, request, filtered_rows)
+
+    def _on_filter_progress(self, request, preview_rows, scanned, matched_count):
+        request_id, table_model = request[0], request[1]
+        if request_id != self._filter_request_id or table_model is not self.table_model:
+            return
+        if preview_rows is not None:
+            if table_model.deleted_count:
+                preview_rows = preview_rows[~table_model.deleted[preview_rows]]
+            self.displayed_rows = self._sorted_rows(preview_rows)
+            self._filter_preview_request_id = request_id
+            self._view_top = 0
+            self._selected_positions = set()
+            self._render_visible_rows()
+        self.filter_feedback_label.configure(text=f"筛选中: 已扫描 {scanned}/{len(table_model)} 行，已命中 {matched_count} 行")
+
+    def _on_filter_done(self, request, filtered_rows):
+        request_id, table_model, conditions, signature = request
+        # 结果返回前又提交了新的筛选，或结果表已被替换时，丢弃过期结果
+        if request_id != self._filter_request_id or table_model is not self.table_model:
+            return
+        self._filter_cancel_event = None
+        if filtered_rows is None:
+            self._set_filter_action_state(False)
+            return
+
+        if self.table_model.deleted_count:
+            # 求值期间可能有行被删除
+            filtered_rows = filtered_rows[~self.table_model.deleted[filtered_rows]]
+        # 未排序时预览结果是最终结果的前缀，保留用户在预览中滚动到的位置与选中行
+        keep_view = self._filter_preview_request_id == request_id and self._sort_column is None
+        self._filter_preview_request_id = None
+        filtered_rows = self._sorted_rows(filtered_rows)
+        self.displayed_rows = filtered_rows
         self.applied_conditions = conditions
-        self.applied_conditions_signature = self._serialize_draft_conditions()
-        self.is_filter_dirty = False
+        self.applied_conditions_signature = signature
+        self.is_filter_dirty = self._serialize_draft_conditions() != signature
         self._update_filter_dirty_state()
-        self._update_result_summary(total=len(self.data), matched=len(filtered_rows))
-        self._render_rows_chunked(filtered_rows)
+        self._update_result_summary(total=self.table_model.live_count(), matched=len(filtered_rows))
+        self._render_rows(filtered_rows, keep_view=keep_view)
+
+    def _on_table_heading_click(self, column):
+        # 再次点击同一列在升序/降序间切换
+        if self._sort_column == column:
+            self._sort_descending = not self._sort_descending
+        else:
+            if self._sort_column is not None:
+                self.table.heading(self._sort_column, text=self._sort_column)
+            self._sort_column = column
+            self._sort_descending = False
+        self.table.heading(column, text=f"{column} {'▼' if self._sort_descending else '▲'}")
+
+        self.displayed_rows = self._sorted_rows(self.displayed_rows)
+        self._view_top = 0
+        self._selected_positions = set()
+        self._render_visible_rows()
+
+    def _sorted_rows(self, rows):
+        if self._sort_column is None or not len(rows):
+            return rows
+        return self.table_model.sort_rows(rows, self._sort_column, self._sort_descending)
 
     def _collect_filter_conditions(self):
         conditions = []
@@ -1303,38 +1559,6 @@ class FormulaGenerationPage(BasePage):
                     return None
         return conditions
 
-    def _item_match_condition(self, item, condition):
-        field_name = condition["field"]
-        cell_value = item.get(field_name, "")
-
-        if condition["type"] == "text":
-            cell_text = str(cell_value).strip().lower()
-            target_text = str(condition["value"]).strip().lower()
-            if condition["operator"] == "等于":
-                return cell_text == target_text
-            return target_text in cell_text
-
-        try:
-            cell_number = float(cell_value)
-        except (ValueError, TypeError):
-            return False
-
-        operator = condition["operator"]
-        target = condition["value"]
-        if operator == ">":
-            return cell_number > target
-        if operator == ">=":
-            return cell_number >= target
-        if operator == "=":
-            return cell_number == target
-        if operator == "<=":
-            return cell_number <= target
-        if operator == "<":
-            return cell_number < target
-        if operator == "区间":
-            return target <= cell_number <= condition["second_value"]
-        return True
-
     def _clear_filter_conditions(self, reapply=True):
         self._is_clearing_filter_rows = True
         for row in self.filter_condition_rows:
@@ -1391,21 +1615,25 @@ class FormulaGenerationPage(BasePage):
         item = self.table.selection()
         if not item:
             return
-        item = item[0]
-        tags = self.table.item(item, 'tags')
-        if not tags:
-            return
-        try:
-            data = json.loads(tags[0])
-        except Exception as e:
-            logging.error(f"无法解析数据项: {e}")
+        model_index = self._model_row_of(item[0])
+        if model_index is None:
             return
 
-        formula_str = self._formula_from_row_data(data)
+        formula_str = self.table_model.formula(model_index)
 
         # 发送事件
         self.event_mgr.publish(EventType.ADD_FORMULA, data=formula_str, priority=EventPriority.NORMAL)
 
+    def _model_row_of(self, row_id):
+        # 表格行 id 为模型行下标（见 _render_visible_rows）
+        try:
+            model_index = int(row_id)
+        except (TypeError, ValueError):
+            return None
+        if not 0 <= model_index < len(self.table_model) or self.table_model.deleted[model_index]:
+            return None
+        return model_index
+
     def _resolve_table_column_name(self, column_token):
         if not column_token or not str(column_token).startswith("#"):
             return ""
@@ -1473,23 +1701,14 @@ class FormulaGenerationPage(BasePage):
         return "break"
 
     def _send_selected_row_to_bus(self):
-        selected_items = self.table.selection()
-        if not selected_items:
+        selected_rows = self._selected_model_rows()
+        if not selected_rows:
             messagebox.showwarning("发送失败", "请先选中要发送的分子式")
             return
 
         formulas_to_send = []
-        for row_id in selected_items:
-            tags = self.table.item(row_id, 'tags')
-            if not tags:
-                continue
-            try:
-                data = json.loads(tags[0])
-            except Exception as e:
-                logging.error(f"无法解析数据项: {e}")
-                continue
-
-            formula_str = self._formula_from_row_data(data)
+        for model_index in selected_rows:
+            formula_str = self.table_model.formula(model_index)
             if formula_str and formula_str not in formulas_to_send:
                 formulas_to_send.append(formula_str)
 
@@ -1503,25 +1722,16 @@ class FormulaGenerationPage(BasePage):
         messagebox.showinfo("发送成功", f"已发送 {len(formulas_to_send)} 个分子式到分子式 bus")
 
     def _delete_selected_row(self):
-        selected_row_ids = self.table.selection()
-        if not selected_row_ids:
+        selected_rows = self._selected_model_rows()
+        if not selected_rows:
             messagebox.showwarning("删除失败", "请先选中要删除的行")
             return
 
         selected_formulas = []
-        selected_tags = []
-        for row_id in selected_row_ids:
-            tags = self.table.item(row_id, 'tags')
-            if not tags:
-                continue
-            selected_tags.append(tags[0])
-            try:
-                data = json.loads(tags[0])
-                formula_str = self._formula_from_row_data(data)
-                if formula_str:
-                    selected_formulas.append(formula_str)
-            except Exception as e:
-                logging.error(f"无法解析数据项: {e}")
+        for model_index in selected_rows:
+            formula_str = self.table_model.formula(model_index)
+            if formula_str:
+                selected_formulas.append(formula_str)
 
         preview_text = chr(10).join(selected_formulas[:10]) if selected_formulas else ""
         if len(selected_formulas) > 10:
@@ -1530,38 +1740,11 @@ class FormulaGenerationPage(BasePage):
         if not messagebox.askyesno("确认删除", f"是否删除选中的分子式？{chr(10)}{preview_text}"):
             return
 
-        if selected_tags:
-            remaining_data = []
-            pending_tags = list(selected_tags)
-            for data_item in self.data:
-                encoded = json.dumps(data_item, ensure_ascii=False)
-                if encoded in pending_tags:
-                    pending_tags.remove(encoded)
-                    continue
-                remaining_data.append(data_item)
-            self.data = remaining_data
-
-        for row_id in selected_row_ids:
-            self.table.delete(row_id)
-        self._apply_filters()
-        logging.info(f"删除分子式 {len(selected_row_ids)} 条")
-
-    def _formula_from_row_data(self, data):
-        elements_order = ['C', 'H', 'N', 'O', 'S', 'P', 'Si', 'F', 'Cl', 'Br', 'I', 'B', 'Se']
-        formula = []
-        for elem in elements_order:
-            raw_count = data.get(elem, 0)
-            if raw_count in ("", None):
-                count = 0
-            else:
-                try:
-                    count = int(float(raw_count))
-                except (ValueError, TypeError):
-                    count = 0
-
-            if count > 0:
-                if count == 1:
-                    formula.append(f'{elem}')
-                else:
-                    formula.append(f"{elem}{count}")
-        return ''.join(formula)
+        # 模型中只标记删除，显示中的行去掉被删除的行即可，无需重新筛选
+        deleted_count = self.table_model.delete_rows(selected_rows)
+        self.displayed_rows = self.displayed_rows[~self.table_model.deleted[self.displayed_rows]]
+        self._selected_positions = set()
+        self._render_visible_rows()
+        self._show_empty_result_guidance(len(self.displayed_rows) == 0)
+        self._update_result_summary(total=self.table_model.live_count(), matched=len(self.displayed_rows))
+        logging.info(f"删除分子式 {deleted_count} 条")
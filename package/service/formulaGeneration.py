@@ -1 +1 @@
-from .formula_generation_service import start_analysis
+from .formula_generation_service import save_analysis_result, start_analysis, start_batch_analysis, start_streaming_analysis
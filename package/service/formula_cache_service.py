@@ -0,0 +1,211 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from ..config.base_config import BaseConfig
+from ..config.path_config import PathManager
+from ..core.background_writer import BackgroundWriter
+from ..service.vectorized_generation_service import FormulaColumns
+
+
+_QUERY_CACHE_DIRNAME = 'query_cache'
+_QUERY_CACHE_PREFIX = 'query_'
+# 缓存条目的格式版本：列布局或枚举语义变化时递增，旧条目的键随之失效
+_QUERY_CACHE_SCHEMA_VERSION = 2
+
+
+class FormulaQueryCache:
+    """分子式枚举结果缓存：内存 LRU + 容量受限的磁盘存储，按中性分子结果缓存，加合物 m/z 在命中后再计算"""
+
+    def __init__(self, cache_dir: Optional[Path] = None, memory_entries: Optional[int] = None, disk_limit_bytes: Optional[int] = None):
+        self._cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.memory_entries = memory_entries if memory_entries is not None else BaseConfig.FORMULA_QUERY_CACHE_MEMORY_ENTRIES
+        self.disk_limit_bytes = disk_limit_bytes if disk_limit_bytes is not None else BaseConfig.FORMULA_QUERY_CACHE_DISK_MB * 1024 * 1024
+        self._memory: 'OrderedDict[str, FormulaColumns]' = OrderedDict()
+        self._lock = threading.Lock()
+        # 磁盘条目索引 {路径: 字节数}，按最近访问排序；首次使用时扫描一次目录，之后随写入与淘汰增量维护
+        self._disk_entries: Optional['OrderedDict[Path, int]'] = None
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+
+    @property
+    def cache_dir(self) -> Path:
+        if self._cache_dir is None:
+            self._cache_dir = PathManager().get_formula_generation_cache_path() / _QUERY_CACHE_DIRNAME
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        return self._cache_dir
+
+    @staticmethod
+    def make_key(elements_order: List[tuple], element_categories: Dict[str, List[str]], h_weight: float, base_mw: float, tolerance_mw: Optional[float] = None, heuristics: Optional[dict] = None) -> str:
+        # tolerance_mw 为 None 时得到仅由元素与 base_mw 决定的键，用于窗口复用；
+        # heuristics 为启发式筛选规则，启用筛选与否的结果分开缓存。
+        # 元素表未声明 H 时仍会按 h_weight 补 H，因此 H 原子量单独计入键
+        payload = {
+            'schema': _QUERY_CACHE_SCHEMA_VERSION,
+            'elements': [[elem, weight, -1 if max_count == float('inf') else int(max_count)] for elem, weight, max_count in elements_order],
+            'h_weight': h_weight,
+            'element_categories': {key: sorted(value) for key, value in element_categories.items()},
+            'base_mw': float(base_mw).hex(),
+            'tolerance_mw': float(tolerance_mw).hex() if tolerance_mw is not None else None,
+        }
+        if heuristics is not None:
+            payload['heuristics'] = heuristics
+        return hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _disk_path(self, key: str) -> Path:
+        return self.cache_dir / f'{_QUERY_CACHE_PREFIX}{key}.npz'
+
+    def _remember(self, key: str, columns: FormulaColumns) -> None:
+        self._memory[key] = columns
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[FormulaColumns]:
+        with self._lock:
+            columns = self._memory.get(key)
+            if columns is not None:
+                self._memory.move_to_end(key)
+                return columns
+
+            disk_path = self._disk_path(key)
+            if not disk_path.exists():
+                return None
+            try:
+                with np.load(disk_path) as data:
+                    columns = FormulaColumns(
+                        elements=data['elements'].tolist(),
+                        counts=data['counts'],
+                        mass=data['mass'],
+                        mz=data['mass'],
+                        dbr=data['dbr'],
+                    )
+                # 更新访问时间，磁盘淘汰按最近访问顺序进行（新实例按修改时间重建索引）
+                os.utime(disk_path)
+            except (OSError, ValueError, KeyError) as ex:
+                logging.warning(f'分子式查询缓存读取失败，已忽略: {disk_path}，{ex}')
+                return None
+            with self._disk_lock:
+                disk_entries = self._disk_index()
+                if disk_path in disk_entries:
+                    disk_entries.move_to_end(disk_path)
+            self._remember(key, columns)
+            return columns
+
+    def put(self, key: str, columns: FormulaColumns) -> None:
+        with self._lock:
+            self._remember(key, columns)
+        # 磁盘写入与容量淘汰交给后台写出线程，不占用分析路径；写完之前同一进程内的查询由内存 LRU 命中
+        BackgroundWriter().submit(self._write_disk, key, columns)
+
+    def flush(self) -> None:
+        # 阻塞到已提交的磁盘写入全部完成
+        BackgroundWriter().flush()
+
+    def _write_disk(self, key: str, columns: FormulaColumns) -> None:
+        disk_path = self._disk_path(key)
+        try:
+            tmp_path = disk_path.with_suffix('.tmp.npz')
+            np.savez(
+                tmp_path,
+                elements=np.asarray(columns.elements, dtype=str),
+                counts=columns.counts,
+                mass=columns.mass,
+                dbr=columns.dbr,
+            )
+            os.replace(tmp_path, disk_path)
+            size = disk_path.stat().st_size
+        except OSError as ex:
+            logging.warning(f'分子式查询缓存写入失败: {ex}')
+            return
+        with self._disk_lock:
+            disk_entries = self._disk_index()
+            self._disk_bytes += size - disk_entries.pop(disk_path, 0)
+            disk_entries[disk_path] = size
+            self._evict_disk()
+
+    def _disk_index(self) -> 'OrderedDict[Path, int]':
+        if self._disk_entries is None:
+            entries = []
+            for path in self.cache_dir.glob(f'{_QUERY_CACHE_PREFIX}*.npz'):
+                if path.name.endswith('.tmp.npz'):
+                    continue
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+            entries.sort(key=lambda entry: entry[0])
+            self._disk_entries = OrderedDict((path, size) for _, path, size in entries)
+            self._disk_bytes = sum(self._disk_entries.values())
+        return self._disk_entries
+
+    def _evict_disk(self) -> None:
+        # 按索引中的最近访问顺序淘汰，直到总大小回到上限以内；不再逐次扫描目录
+        while self._disk_bytes > self.disk_limit_bytes and self._disk_entries:
+            path, size = self._disk_entries.popitem(last=False)
+            self._disk_bytes -= size
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                continue
+            except OSError as ex:
+                logging.warning(f'分子式查询缓存清理失败: {path}，{ex}')
+
+    def clear_memory(self) -> None:
+        with self._lock:
+            self._memory.clear()
+
+
+class WindowEnumerationStore:
+    """按 (元素, base_mw) 保留最近一次枚举的质量窗口与结果，供放宽 / 收窄误差时增量复用"""
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = max_entries if max_entries is not None else BaseConfig.FORMULA_WINDOW_STORE_ENTRIES
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[tuple]:
+        """返回 (mw_min, mw_max, columns)；columns 恰为该闭区间内的全部结果"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, mw_min: float, mw_max: float, columns: FormulaColumns) -> None:
+        with self._lock:
+            self._entries[key] = (mw_min, mw_max, columns)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_QUERY_CACHE: Optional[FormulaQueryCache] = None
+_QUERY_CACHE_LOCK = threading.Lock()
+
+
+def get_formula_query_cache() -> FormulaQueryCache:
+    global _QUERY_CACHE
+    with _QUERY_CACHE_LOCK:
+        if _QUERY_CACHE is None:
+            _QUERY_CACHE = FormulaQueryCache()
+        return _QUERY_CACHE
+
+
+_WINDOW_STORE: Optional[WindowEnumerationStore] = None
+
+
+def get_window_enumeration_store() -> WindowEnumerationStore:
+    global _WINDOW_STORE
+    with _QUERY_CACHE_LOCK:
+        if _WINDOW_STORE is None:
+            _WINDOW_STORE = WindowEnumerationStore()
+        return _WINDOW_STORE
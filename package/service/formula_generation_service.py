@@ -1,14 +1,27 @@
-import concurrent.futures
+import importlib.util
 import logging
+import math
 import os
+import queue as queue_module
+import threading
 import time
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import Future
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterator, List, Optional, Any, Sequence, Tuple
 
+import numpy as np
+
+from ..config.base_config import BaseConfig
 from ..config.path_config import PathManager
+from ..core.background_writer import BackgroundWriter
+from ..core.process_pool import ProcessPool
+from ..service.formula_cache_service import FormulaQueryCache, WindowEnumerationStore, get_formula_query_cache, get_window_enumeration_store
+from ..service.formula_heuristics_service import HeuristicFilter
+from ..service.formula_library_service import FormulaLibrary, build_formula_library, find_formula_library
+from ..service.isotope_pattern_service import IsotopePatternCalculator, observed_isotope_intensities, rank_isotope_candidates
 from ..service.public import ExporterFactory, ReadChemElementConfig
+from ..service.vectorized_generation_service import FormulaColumns, HeavyAtomTable, vectorized_search, vectorized_search_windows
 
 
 @dataclass
@@ -70,39 +83,317 @@ def normalize_elements(elements: Dict[str, int], atomic_weights: Dict[str, float
     return items
 
 
-def backtrack_search(target_mw: float, tolerance_mw: float, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]]) -> List[FormulaCandidate]:
-    mw_min = target_mw - tolerance_mw
-    mw_max = target_mw + tolerance_mw
+@dataclass
+class SearchStats:
+    nodes_visited: int = 0
+    nodes_pruned: int = 0
+    candidates: int = 0
+    # 启发式规则筛除的候选数，按规则名统计
+    rejected: Dict[str, int] = field(default_factory=dict)
+
+    def summary(self) -> str:
+        total = self.nodes_visited + self.nodes_pruned
+        ratio = self.nodes_pruned / total * 100 if total else 0.0
+        text = f'访问节点={self.nodes_visited}, 剪枝节点={self.nodes_pruned} ({ratio:.1f}%), 候选数={self.candidates}'
+        if self.rejected:
+            text += ', 规则筛除=' + ', '.join(f'{name}:{count}' for name, count in self.rejected.items())
+        return text
+
+    def merge(self, other: 'SearchStats') -> None:
+        self.nodes_visited += other.nodes_visited
+        self.nodes_pruned += other.nodes_pruned
+        self.candidates += other.candidates
+        for name, count in other.rejected.items():
+            self.rejected[name] = self.rejected.get(name, 0) + count
+
+
+# 剪枝比较时的浮点余量，避免因累加顺序不同误剪边界上的候选
+_PRUNE_EPSILON = 1e-9
+
+
+def _build_suffix_mass_tables(non_h_elements: List[tuple], h_weight: float, h_max: float) -> List[float]:
+    # max_suffix[i]：non_h_elements[i:] 加上 H 能贡献的最大剩余质量。
+    # 元素计数没有下限（分片下限由循环边界处理），最小剩余质量恒为 0，超出上限的计数已由循环上界排除
+    h_mass_max = h_max * h_weight if h_max != float('inf') else float('inf')
+    max_suffix = [0.0] * (len(non_h_elements) + 1)
+    max_suffix[-1] = h_mass_max
+    for index in range(len(non_h_elements) - 1, -1, -1):
+        _, weight, max_count = non_h_elements[index]
+        max_suffix[index] = max_suffix[index + 1] + weight * max_count
+    return max_suffix
+
+
+def _valency_deltas(element_categories: Dict[str, List[str]]) -> Dict[str, int]:
+    # 每个原子对 2*DBR = 2*valency_4 + 2 + valency_3 - valency_1 的贡献
+    deltas = {}
+    for elem in element_categories.get('valency_1', []):
+        deltas[elem] = deltas.get(elem, 0) - 1
+    for elem in element_categories.get('valency_3', []):
+        deltas[elem] = deltas.get(elem, 0) + 1
+    for elem in element_categories.get('valency_4', []):
+        deltas[elem] = deltas.get(elem, 0) + 2
+    return deltas
+
+
+def _hydrogen_dbr_range(unsaturation: int, h_delta: int, min_h: int, max_h: int) -> range:
+    # 给定重原子部分的 2*DBR，求满足 DBR 为非负整数的 H 计数：步长为 2 的等差数列
+    if h_delta % 2:
+        if (unsaturation - min_h) % 2:
+            min_h += 1
+        step = 2
+    elif unsaturation % 2:
+        return range(0)
+    else:
+        step = 1
+    if h_delta < 0:
+        max_h = min(max_h, unsaturation // -h_delta)
+    elif unsaturation < 0:
+        if h_delta == 0:
+            return range(0)
+        min_h = max(min_h, -(unsaturation // h_delta))
+    return range(min_h, max_h + 1, step)
+
+
+def backtrack_search(target_mw: float, tolerance_mw: float, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], stats: Optional[SearchStats] = None, propagate_valency: bool = True, prefix_ranges: Sequence[Tuple[int, int]] = (), sink=None, heuristics: Optional[HeuristicFilter] = None) -> List[FormulaCandidate]:
+    """深度优先枚举候选分子式。
+
+    propagate_valency 为 True 时，DBR 非负且为整数的约束在枚举中传播：叶子节点只生成
+    满足约束的 H 计数（步长为 2 的等差数列），不再为注定被拒绝的组合构造候选对象；
+    返回结果与 False（叶子节点逐个校验）完全一致。
+
+    prefix_ranges 依次限定前几层重原子的计数闭区间，用于把一次搜索切分为多个分片并行执行。
+
+    sink 为支持 append/len 的对象时，候选直接写入 sink 而不在内存中累积，函数返回该 sink。
+
+    heuristics 不为 None 时在叶子节点构造候选对象之前应用启发式规则，筛除数按规则计入 stats.rejected。
+    """
+    windows = [(target_mw - tolerance_mw, target_mw + tolerance_mw)]
+    sinks = [[] if sink is None else sink]
+    return backtrack_search_windows(windows, elements_order, atomic_weights, element_categories, stats=stats, propagate_valency=propagate_valency, prefix_ranges=prefix_ranges, sinks=sinks, heuristics=heuristics)[0]
+
+
+def backtrack_search_windows(windows: Sequence[Tuple[float, float]], elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], stats: Optional[SearchStats] = None, propagate_valency: bool = True, prefix_ranges: Sequence[Tuple[int, int]] = (), sinks: Optional[list] = None, heuristics: Optional[HeuristicFilter] = None) -> List[list]:
+    """对多个质量闭区间 [mw_min, mw_max] 只做一次深度优先枚举。
+
+    重原子部分按所有窗口的并集剪枝并共享遍历，叶子节点再分别求解每个窗口内的 H 计数，
+    返回与 windows 一一对应的候选列表；每个列表与对该窗口单独调用 backtrack_search 的结果一致。
+    """
+    union_min = min(mw_min for mw_min, _ in windows)
+    union_max = max(mw_max for _, mw_max in windows)
     h_weight = atomic_weights.get('H', 1.0)
-    results: List[FormulaCandidate] = []
+    results = [[] for _ in windows] if sinks is None else sinks
 
     h_max = next((count for elem, _, count in elements_order if elem == 'H'), float('inf'))
     non_h_elements = [(elem, weight, max_count) for elem, weight, max_count in elements_order if elem != 'H']
+    max_suffix = _build_suffix_mass_tables(non_h_elements, h_weight, h_max)
+    deltas = _valency_deltas(element_categories)
+    h_delta = deltas.get('H', 0)
+    visited = 0
+    pruned = 0
+    rejected: Dict[str, int] = {}
 
-    def dfs(index: int, current_mw: float, current: Dict[str, int]):
+    def dfs(index: int, current_mw: float, current: Dict[str, int], unsaturation: int):
+        # visited 只统计通过剪枝检查、实际展开的节点；被剪掉的节点只计入 pruned
+        nonlocal visited, pruned
         if index >= len(non_h_elements):
-            min_h = int(max(0, (mw_min - current_mw) / h_weight))
-            if current_mw + min_h * h_weight < mw_min:
-                min_h += 1
-
-            max_h = int((mw_max - current_mw) / h_weight)
-            if h_max != float('inf'):
-                max_h = min(max_h, int(h_max))
-
-            if max_h < min_h:
-                return
-
-            for h_count in range(min_h, max_h + 1):
-                candidate = FormulaCandidate(
-                    formula={**current, 'H': h_count},
-                    atomic_weights=atomic_weights,
-                    element_categories=element_categories
-                )
-                if candidate.validate_valency() and mw_min <= candidate.predicted_mw <= mw_max:
-                    results.append(candidate)
+            visited += 1
+            # 同一叶子可能落入多个重叠窗口，候选对象按 H 计数复用
+            leaf_candidates: Dict[int, FormulaCandidate] = {}
+            if heuristics is not None:
+                heavy_rule = heuristics.heavy_rejection(current)
+                h_limits = heuristics.hydrogen_limits(current)
+            for (mw_min, mw_max), window_results in zip(windows, results):
+                min_h = int(max(0, (mw_min - current_mw) / h_weight))
+                if current_mw + min_h * h_weight < mw_min:
+                    min_h += 1
+
+                max_h = int((mw_max - current_mw) / h_weight)
+                if h_max != float('inf'):
+                    max_h = min(max_h, int(h_max))
+
+                if max_h < min_h:
+                    continue
+
+                h_counts = _hydrogen_dbr_range(unsaturation, h_delta, min_h, max_h) if propagate_valency else range(min_h, max_h + 1)
+                for h_count in h_counts:
+                    if heuristics is not None:
+                        rule = heavy_rule or heuristics.hydrogen_rejection(h_limits, h_count)
+                        if rule is not None:
+                            rejected[rule] = rejected.get(rule, 0) + 1
+                            continue
+                    candidate = leaf_candidates.get(h_count)
+                    if candidate is None:
+                        candidate = leaf_candidates[h_count] = FormulaCandidate(
+                            formula={**current, 'H': h_count},
+                            atomic_weights=atomic_weights,
+                            element_categories=element_categories
+                        )
+                    if candidate.validate_valency() and mw_min <= candidate.predicted_mw <= mw_max:
+                        window_results.append(candidate)
             return
 
         elem, weight, max_count = non_h_elements[index]
+        elem_delta = deltas.get(elem, 0)
+        remaining_budget = union_max - current_mw
+        # 剩余元素全部取满仍达不到任一窗口下限，或已超过所有窗口上限，整棵子树无解
+        if remaining_budget < 0 or current_mw + max_suffix[index] < union_min - _PRUNE_EPSILON:
+            pruned += 1
+            return
+        visited += 1
+
+        max_possible = int(remaining_budget / weight) if weight > 0 else 0
+        if max_count != float('inf'):
+            max_possible = min(max_possible, int(max_count))
+
+        # 当前元素计数过少时，后续元素取满也无法达到最低的窗口下限，直接收紧循环下界
+        min_needed = 0
+        if max_suffix[index + 1] != float('inf') and weight > 0:
+            min_needed = max(0, math.ceil((union_min - current_mw - max_suffix[index + 1]) / weight) - 1)
+            pruned += min(min_needed, max_possible + 1)
+
+        if index < len(prefix_ranges):
+            low, high = prefix_ranges[index]
+            min_needed = max(min_needed, low)
+            max_possible = min(max_possible, high)
+
+        for count in range(max_possible, min_needed - 1, -1):
+            next_mw = current_mw + count * weight
+            if next_mw > union_max:
+                continue
+            dfs(index + 1, next_mw, {**current, elem: count}, unsaturation + elem_delta * count)
+
+    dfs(0, 0.0, {}, 2)
+    if stats is not None:
+        stats.nodes_visited += visited
+        stats.nodes_pruned += pruned
+        stats.candidates += sum(len(window_results) for window_results in results)
+        for name, count in rejected.items():
+            stats.rejected[name] = stats.rejected.get(name, 0) + count
+    return results
+
+
+# 整数质量基准单位：约 0.001 Da（按 H 原子量微调，见 dp_search）
+_DP_MASS_BLOWUP = 1000
+
+
+def _build_residue_table(int_masses: List[int]) -> tuple:
+    # 扩展余数表（money-changing DP，round-robin 算法）：
+    # residues[r] 为仅用 int_masses 中元素可拼出、且模最小质量余 r 的最小整数质量
+    base = min(int_masses)
+    residues = [math.inf] * base
+    residues[0] = 0
+    for mass in int_masses:
+        if mass == base:
+            continue
+        step = math.gcd(base, mass)
+        for p in range(step):
+            n = min(residues[q] for q in range(p, base, step))
+            if n == math.inf:
+                continue
+            for _ in range(base // step - 1):
+                n += mass
+                r = n % base
+                n = min(n, residues[r])
+                residues[r] = n
+    # 超过该值的整数质量均可被拼出
+    frobenius = max(residues) - base
+    return base, residues, frobenius
+
+
+def _build_reachable_flags(table: tuple, limit: int) -> bytearray:
+    # flags[v] 标记整数质量 v 是否可被拼出；每个余数类从其最小可达质量起按 base 步长全部可达
+    base, residues, frobenius = table
+    size = int(min(limit, frobenius)) + 1
+    flags = bytearray(size)
+    for r, start in enumerate(residues):
+        if start < size:
+            flags[start::base] = b'\x01' * len(range(start, size, base))
+    return flags
+
+
+def dp_search(target_mw: float, tolerance_mw: float, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], stats: Optional[SearchStats] = None, prefix_ranges: Sequence[Tuple[int, int]] = (), sink=None, heuristics: Optional[HeuristicFilter] = None) -> List[FormulaCandidate]:
+    """整数质量 DP 剪枝枚举，结果与 backtrack_search 一致"""
+    mw_min = target_mw - tolerance_mw
+    mw_max = target_mw + tolerance_mw
+    h_weight = atomic_weights.get('H', 1.0)
+    results = [] if sink is None else sink
+
+    h_max = next((count for elem, _, count in elements_order if elem == 'H'), float('inf'))
+    non_h_elements = [(elem, weight, max_count) for elem, weight, max_count in elements_order if elem != 'H']
+    names = [elem for elem, _, _ in non_h_elements]
+
+    # H 在叶子节点总是可用，因此每个后缀集合都包含 H
+    # H 原子数通常最多，选取放大系数使 H 的整数质量无舍入误差，以收紧误差界
+    weights = [weight for _, weight, _ in non_h_elements] + [h_weight]
+    blowup = _DP_MASS_BLOWUP * max(1, round(h_weight)) / h_weight
+    int_masses = [max(1, round(weight * blowup)) for weight in weights]
+    rel_errors = [(m - w * blowup) / (w * blowup) for m, w in zip(int_masses, weights)]
+    rel_low = min(0.0, min(rel_errors))
+    rel_high = max(0.0, max(rel_errors))
+    high_limit = math.ceil(mw_max * blowup * (1 + rel_high)) + 1
+    tables = [
+        _build_reachable_flags(_build_residue_table(int_masses[index:]), high_limit)
+        for index in range(len(non_h_elements))
+    ]
+
+    scale_low = blowup * (1 + rel_low)
+    scale_high = blowup * (1 + rel_high)
+
+    def reachable(index: int, residual_min: float, residual_max: float) -> bool:
+        # 真实质量区间换算到整数质量区间时按相对舍入误差放宽，保证剪枝保守
+        if residual_max < 0:
+            return False
+        low = max(0, math.floor(residual_min * scale_low) - 1)
+        flags = tables[index]
+        if low >= len(flags):
+            return True
+        high = math.ceil(residual_max * scale_high) + 1
+        # 超出 flags 长度的部分已越过 Frobenius 数，必然可达
+        return high >= len(flags) or flags.find(1, low, high + 1) != -1
+
+    deltas = _valency_deltas(element_categories)
+    non_h_deltas = [deltas.get(elem, 0) for elem in names]
+    h_delta = deltas.get('H', 0)
+    counts = [0] * len(non_h_elements)
+    last_index = len(non_h_elements) - 1
+    visited = 0
+    pruned = 0
+    rejected: Dict[str, int] = {}
+
+    def emit_leaf(current_mw: float):
+        min_h = int(max(0, (mw_min - current_mw) / h_weight))
+        if current_mw + min_h * h_weight < mw_min:
+            min_h += 1
+
+        max_h = int((mw_max - current_mw) / h_weight)
+        if h_max != float('inf'):
+            max_h = min(max_h, int(h_max))
+
+        unsaturation = 2 + sum(delta * count for delta, count in zip(non_h_deltas, counts))
+        heavy = dict(zip(names, counts))
+        if heuristics is not None:
+            heavy_rule = heuristics.heavy_rejection(heavy)
+            h_limits = heuristics.hydrogen_limits(heavy)
+        for h_count in _hydrogen_dbr_range(unsaturation, h_delta, min_h, max_h):
+            if heuristics is not None:
+                rule = heavy_rule or heuristics.hydrogen_rejection(h_limits, h_count)
+                if rule is not None:
+                    rejected[rule] = rejected.get(rule, 0) + 1
+                    continue
+            formula = dict(heavy)
+            formula['H'] = h_count
+            candidate = FormulaCandidate(
+                formula=formula,
+                atomic_weights=atomic_weights,
+                element_categories=element_categories
+            )
+            if candidate.validate_valency() and mw_min <= candidate.predicted_mw <= mw_max:
+                results.append(candidate)
+
+    def dfs(index: int, current_mw: float):
+        nonlocal visited, pruned
+        visited += 1
+        _, weight, max_count = non_h_elements[index]
         remaining_budget = mw_max - current_mw
         if remaining_budget < 0:
             return
@@ -111,53 +402,448 @@ def backtrack_search(target_mw: float, tolerance_mw: float, elements_order: List
         if max_count != float('inf'):
             max_possible = min(max_possible, int(max_count))
 
-        for count in range(max_possible, -1, -1):
+        min_count = 0
+        if index < len(prefix_ranges):
+            min_count, high = prefix_ranges[index]
+            max_possible = min(max_possible, high)
+
+        if index == last_index:
+            # 后缀仅剩 H：直接判断 H 区间是否为空，避免逐个计数进入叶子
+            for count in range(max_possible, min_count - 1, -1):
+                next_mw = current_mw + count * weight
+                if next_mw > mw_max:
+                    continue
+                if next_mw + int((mw_max - next_mw) / h_weight) * h_weight < mw_min:
+                    pruned += 1
+                    continue
+                counts[index] = count
+                emit_leaf(next_mw)
+            counts[index] = 0
+            return
+
+        for count in range(max_possible, min_count - 1, -1):
             next_mw = current_mw + count * weight
             if next_mw > mw_max:
                 continue
-            dfs(index + 1, next_mw, {**current, elem: count})
+            if reachable(index + 1, mw_min - next_mw, mw_max - next_mw):
+                counts[index] = count
+                dfs(index + 1, next_mw)
+            else:
+                pruned += 1
+        counts[index] = 0
 
-    dfs(0, 0.0, {})
+    if not non_h_elements:
+        emit_leaf(0.0)
+    elif reachable(0, mw_min, mw_max):
+        dfs(0, 0.0)
+    if stats is not None:
+        stats.nodes_visited += visited
+        stats.nodes_pruned += pruned
+        stats.candidates += len(results)
+        for name, count in rejected.items():
+            stats.rejected[name] = stats.rejected.get(name, 0) + count
     return results
 
 
+# 每个工作进程分到的分片数：分片多于进程数，先完成的进程可以继续领取，负载更均衡
+_SHARDS_PER_WORKER = 4
+# 估算叶子数低于该值的搜索不再切分，避免进程间传输开销超过计算本身
+_MIN_SHARD_WORK = 20000.0
+
+
+def _estimate_subtree_work(residual_mw: float, weights: List[float]) -> float:
+    # 剩余质量预算下后续各层计数组合数的单纯形体积近似：r^m / (m! * Πw)
+    work = 1.0
+    for depth, weight in enumerate(weights, start=1):
+        work *= max(residual_mw, 0.0) / weight / depth
+    return work + 1.0
+
+
+def _level_count_range(remaining_mw: float, weight: float, max_count: float) -> int:
+    max_possible = int(remaining_mw / weight) if weight > 0 else 0
+    if max_count != float('inf'):
+        max_possible = min(max_possible, int(max_count))
+    return max_possible
+
+
+def plan_search_shards(target_mw: float, tolerance_mw: float, elements_order: List[tuple], shard_count: int) -> List[List[Tuple[int, int]]]:
+    """把一次枚举按前一到两层重原子的计数切分为工作量相近的分片。
+
+    返回的每个分片是一组 prefix_ranges；按列表顺序依次执行并拼接结果，与不分片的
+    深度优先顺序完全一致。
+    """
+    mw_max = target_mw + tolerance_mw
+    non_h_elements = [(elem, weight, max_count) for elem, weight, max_count in elements_order if elem != 'H']
+    if shard_count <= 1 or not non_h_elements or mw_max < 0:
+        return [[]]
+
+    weights = [weight for _, weight, _ in non_h_elements]
+    _, weight, max_count = non_h_elements[0]
+    # 与 DFS 相同的计数降序；每个单元为 (前缀区间, 估算工作量)
+    units = [
+        ([(count, count)], _estimate_subtree_work(mw_max - count * weight, weights[1:]))
+        for count in range(_level_count_range(mw_max, weight, max_count), -1, -1)
+    ]
+    total_work = sum(work for _, work in units)
+    shard_count = min(shard_count, max(1, int(total_work / _MIN_SHARD_WORK)))
+    if shard_count <= 1:
+        return [[]]
+    target_work = total_work / shard_count
+
+    # 单个计数的子树超过平均分片工作量时，再按第二层计数细分
+    if len(non_h_elements) > 1:
+        _, next_weight, next_max_count = non_h_elements[1]
+        split_units = []
+        for prefix, work in units:
+            if work <= target_work:
+                split_units.append((prefix, work))
+                continue
+            count = prefix[0][0]
+            remaining_mw = mw_max - count * weight
+            split_units.extend(
+                ([(count, count), (next_count, next_count)], _estimate_subtree_work(remaining_mw - next_count * next_weight, weights[2:]))
+                for next_count in range(_level_count_range(remaining_mw, next_weight, next_max_count), -1, -1)
+            )
+        units = split_units
+
+    # 合并相邻且同属一个父节点的单元，得到连续计数区间
+    shards: List[List[Tuple[int, int]]] = []
+    current: Optional[List[Tuple[int, int]]] = None
+    current_work = 0.0
+    for prefix, work in units:
+        mergeable = (
+            current is not None
+            and len(current) == len(prefix)
+            and current[:-1] == prefix[:-1]
+            and current_work + work <= target_work
+        )
+        if mergeable:
+            current[-1] = (prefix[-1][0], current[-1][1])
+            current_work += work
+            continue
+        if current is not None:
+            shards.append(current)
+        current = list(prefix)
+        current_work = work
+    if current is not None:
+        shards.append(current)
+    return shards
+
+
+SEARCH_ENGINES = {
+    'backtrack': backtrack_search,
+    'dp': dp_search,
+}
+
+
+# 流式枚举每块回传的候选数，以及队列中每个工作进程最多缓存的块数（超出时生产者阻塞）
+_STREAM_CHUNK_SIZE = 2000
+_STREAM_QUEUE_CHUNKS_PER_WORKER = 2
+_STREAM_POLL_INTERVAL_SEC = 0.1
+
+
+class _StreamCancelled(Exception):
+    pass
+
+
+def _put_chunk(result_queue, cancel_event, item) -> None:
+    # 队列满时等待消费者；消费者放弃迭代后通过 cancel_event 让生产者尽快退出
+    while True:
+        if cancel_event.is_set():
+            raise _StreamCancelled()
+        try:
+            result_queue.put(item, timeout=_STREAM_POLL_INTERVAL_SEC * 5)
+            return
+        except queue_module.Full:
+            continue
+
+
+class _QueueSink:
+    """按块把候选写入跨进程队列，仅保留当前块；len 返回累计写入的候选数"""
+
+    def __init__(self, result_queue, cancel_event, task_index: int, chunk_size: int):
+        self.result_queue = result_queue
+        self.cancel_event = cancel_event
+        self.task_index = task_index
+        self.chunk_size = chunk_size
+        self.buffer: List[tuple] = []
+        self.count = 0
+
+    def append(self, candidate: FormulaCandidate) -> None:
+        self.buffer.append((candidate.to_dict()['formula'], candidate.dbr, candidate.predicted_mw))
+        self.count += 1
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            _put_chunk(self.result_queue, self.cancel_event, (self.task_index, self.buffer))
+            self.buffer = []
+
+    def __len__(self) -> int:
+        return self.count
+
+
+def _run_stream_task(result_queue, cancel_event, task_index: int, engine: str, target_mw: float, tolerance_mw: float, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], prefix_ranges: Sequence[Tuple[int, int]], chunk_size: int, heuristics: Optional[HeuristicFilter] = None) -> SearchStats:
+    # 子进程入口：边枚举边分块回传，不在子进程内累积完整结果
+    stats = SearchStats()
+    try:
+        if engine == 'vectorized':
+            columns = vectorized_search(target_mw, tolerance_mw, elements_order, atomic_weights, element_categories, prefix_ranges=prefix_ranges)
+            if heuristics is not None:
+                columns = heuristics.filter_columns(columns, stats.rejected)
+            stats.candidates = len(columns)
+            for start in range(0, len(columns), chunk_size):
+                rows = columns.take(slice(start, start + chunk_size)).to_dicts('')
+                _put_chunk(result_queue, cancel_event, (task_index, [(row['formula'], row['dbr'], row['predicted_mw']) for row in rows]))
+        else:
+            sink = _QueueSink(result_queue, cancel_event, task_index, chunk_size)
+            SEARCH_ENGINES[engine](target_mw, tolerance_mw, elements_order, atomic_weights, element_categories, stats=stats, prefix_ranges=prefix_ranges, sink=sink, heuristics=heuristics)
+            sink.flush()
+    except _StreamCancelled:
+        logging.info('流式枚举已被消费者取消')
+    return stats
+
+
+def _build_result_row(formula: Dict[str, int], dbr: float, predicted_mw: float, adduct: str, charge: int, ion_weight: float) -> dict:
+    return {
+        'formula': formula,
+        'dbr': dbr,
+        'predicted_mw': predicted_mw,
+        'adduct_type': adduct,
+        'calculated_properties': {
+            'dbr': dbr,
+            'predicted_mz': (predicted_mw + charge * ion_weight) / charge,
+            'molecular_weight': predicted_mw,
+        }
+    }
+
+
+def _group_overlapping_windows(windows: List[tuple]) -> List[List[tuple]]:
+    # 按窗口下限排序后合并相互重叠的窗口，每组对应一个连续的质量带
+    groups: List[List[tuple]] = []
+    group_max = None
+    for window in sorted(windows, key=lambda window: window[2] - window[3]):
+        _, _, base_mw, tolerance, _ = window
+        if groups and base_mw - tolerance <= group_max:
+            groups[-1].append(window)
+            group_max = max(group_max, base_mw + tolerance)
+        else:
+            groups.append([window])
+            group_max = base_mw + tolerance
+    return groups
+
+
+# 工作进程内缓存的重原子组合表：(元素配置键, HeavyAtomTable)，同一进程处理的后续批量任务直接复用
+_WORKER_HEAVY_TABLE: Optional[tuple] = None
+
+
+def _worker_heavy_table(elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], mw_max: float) -> HeavyAtomTable:
+    # 元素配置不变且已展开到足够的质量时复用；否则按 mw_max 重新展开并替换缓存
+    global _WORKER_HEAVY_TABLE
+    key = (
+        tuple(elements_order),
+        atomic_weights.get('H', 1.0),
+        tuple(sorted((name, tuple(sorted(members))) for name, members in element_categories.items())),
+    )
+    if _WORKER_HEAVY_TABLE is not None and _WORKER_HEAVY_TABLE[0] == key and _WORKER_HEAVY_TABLE[1].mw_max >= mw_max:
+        return _WORKER_HEAVY_TABLE[1]
+    _WORKER_HEAVY_TABLE = None
+    table = HeavyAtomTable(elements_order, atomic_weights, element_categories, mw_max)
+    _WORKER_HEAVY_TABLE = (key, table)
+    return table
+
+
+def _run_batch_task(bands: List[List[tuple]], elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], charge: int, heuristics: Optional[HeuristicFilter] = None, table_mw_max: Optional[float] = None) -> tuple:
+    # 子进程入口：重原子组合表按整批的最大质量（table_mw_max）在每个工作进程中只展开一次，分到同一进程的各块复用；
+    # 每个质量带（相互重叠的窗口）只搜索一次，再按各窗口的精确边界拆分结果；启发式规则的筛除数按规则名随结果返回
+    chunk_max = max(base_mw + tolerance for band in bands for _, _, base_mw, tolerance, _ in band)
+    table = _worker_heavy_table(elements_order, atomic_weights, element_categories, max(chunk_max, table_mw_max or 0.0))
+    parts = []
+    peak_index = []
+    adduct_index = []
+    rejected: Dict[str, int] = {}
+    for band in bands:
+        band_min = min(base_mw - tolerance for _, _, base_mw, tolerance, _ in band)
+        band_max = max(base_mw + tolerance for _, _, base_mw, tolerance, _ in band)
+        if len(band) > 1:
+            margin = _PRUNE_EPSILON * max(1.0, band_max)
+            center = (band_min + band_max) / 2
+            half_width = min((band_max - band_min) / 2 + margin, table.mw_max - center)
+            band_columns = table.search(center, half_width)
+            if heuristics is not None:
+                band_columns = heuristics.filter_columns(band_columns, rejected)
+        for peak_idx, adduct_idx, base_mw, tolerance, ion_weight in band:
+            if len(band) > 1:
+                mw_min = base_mw - tolerance
+                mw_max = base_mw + tolerance
+                columns = band_columns.take((band_columns.mass >= mw_min) & (band_columns.mass <= mw_max)).with_adduct(charge, ion_weight)
+            else:
+                columns = table.search(base_mw, tolerance, charge, ion_weight)
+                if heuristics is not None:
+                    columns = heuristics.filter_columns(columns, rejected)
+            parts.append(columns)
+            peak_index.append(np.full(len(columns), peak_idx, dtype=np.int32))
+            adduct_index.append(np.full(len(columns), adduct_idx, dtype=np.int16))
+    return FormulaColumns.concat(parts, table.elements), np.concatenate(peak_index), np.concatenate(adduct_index), rejected
+
+
+# 支持多个质量窗口共享一次枚举的引擎；dp 的可达性剪枝依赖单一窗口，仍逐窗口枚举
+_SHARED_WINDOW_ENGINES = ('backtrack', 'vectorized')
+
+
+def _candidates_to_columns(candidates: Sequence[FormulaCandidate], element_names: List[str]) -> FormulaColumns:
+    return FormulaColumns.from_formulas(
+        [candidate.formula for candidate in candidates],
+        [candidate.predicted_mw for candidate in candidates],
+        [candidate.dbr for candidate in candidates],
+        element_names,
+    )
+
+
+def _run_windows_task(engine: str, windows: Sequence[Tuple[float, float]], elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], prefix_ranges: Sequence[Tuple[int, int]] = (), heuristics: Optional[HeuristicFilter] = None) -> tuple:
+    # 子进程入口：返回与 windows 对应的列式结果；任一引擎的结果都在子进程内转为列式数组，回传时不再序列化逐条候选对象
+    # 启发式规则也在子进程内应用，被筛除的候选不再经过进程间传输
+    element_names = [elem for elem, _, _ in elements_order if elem != 'H'] + ['H']
+    stats = SearchStats()
+    if engine == 'vectorized':
+        parts = vectorized_search_windows(windows, elements_order, atomic_weights, element_categories, prefix_ranges=prefix_ranges)
+        if heuristics is not None:
+            parts = [heuristics.filter_columns(part, stats.rejected) for part in parts]
+        stats.candidates = sum(len(part) for part in parts)
+        return parts, stats
+    if engine == 'backtrack':
+        window_candidates = backtrack_search_windows(windows, elements_order, atomic_weights, element_categories, stats=stats, prefix_ranges=prefix_ranges, heuristics=heuristics)
+    else:
+        window_candidates = [
+            SEARCH_ENGINES[engine]((mw_min + mw_max) / 2, (mw_max - mw_min) / 2, elements_order, atomic_weights, element_categories, stats=stats, prefix_ranges=prefix_ranges, heuristics=heuristics)
+            for mw_min, mw_max in windows
+        ]
+    return [_candidates_to_columns(candidates, element_names) for candidates in window_candidates], stats
+
+
+def _warm_up_worker() -> int:
+    # 预热任务：反序列化本函数时子进程已导入本模块及 numpy，此处只需返回进程号
+    return os.getpid()
+
+
+def warm_up_worker_pool() -> list:
+    """应用启动时预热分子式生成进程池，不阻塞调用方；返回各预热任务的 future"""
+    return ProcessPool().warm_up(_warm_up_worker)
+
+
+def shutdown_worker_pool() -> None:
+    ProcessPool().shutdown()
+
+
+def build_configured_formula_library() -> Optional[FormulaLibrary]:
+    """按 BaseConfig.FORMULA_LIBRARY_ELEMENTS / FORMULA_LIBRARY_MW_LIMIT 构建分子式库（已存在则直接复用）"""
+    if not BaseConfig.FORMULA_LIBRARY_ELEMENTS:
+        return None
+    generator = FormulaGenerator(use_query_cache=False)
+    order = normalize_elements(BaseConfig.FORMULA_LIBRARY_ELEMENTS, generator.atomic_weights)
+    return build_formula_library(order, generator.atomic_weights, generator.element_categories, float(BaseConfig.FORMULA_LIBRARY_MW_LIMIT))
+
+
+def _build_configured_formula_library_quietly() -> None:
+    try:
+        build_configured_formula_library()
+    except Exception as ex:
+        logging.warning(f'分子式库构建失败，查询将改用枚举: {ex}', exc_info=True)
+
+
+def start_formula_library_build() -> threading.Thread:
+    """应用启动时在后台线程中构建分子式库，不阻塞调用方；构建完成前的查询按库未覆盖处理"""
+    thread = threading.Thread(target=_build_configured_formula_library_quietly, name='formula-library-build', daemon=True)
+    thread.start()
+    return thread
+
+
 class FormulaGenerator:
-    def __init__(self, config_path: Optional[Path] = None):
+    def __init__(self, config_path: Optional[Path] = None, use_query_cache: bool = True, heuristic_filter: Optional[bool] = None):
         config_path = config_path or PathManager().chem_element_config_path
         self.config = ReadChemElementConfig(config_path).config
         self.atomic_weights = self.config['atomic_weights']
         self.element_categories = self.config['element_categories']
         self.ion_weights = self.config['ion_weights']
         self.adducts = self.config['adducts']
+        # 旧版配置文件没有 isotopes 时不做同位素打分
+        self.isotope_calculator: Optional[IsotopePatternCalculator] = IsotopePatternCalculator(self.config['isotopes'], self.atomic_weights) if 'isotopes' in self.config else None
+        self.query_cache: Optional[FormulaQueryCache] = get_formula_query_cache() if use_query_cache else None
+        self.window_store: Optional[WindowEnumerationStore] = get_window_enumeration_store() if use_query_cache else None
+        # 为 True 时各加合物的质量窗口合并为一次枚举，叶子节点再把中性分子式分配给包含它的窗口
+        self.shared_adduct_enumeration = BaseConfig.FORMULA_SHARED_ADDUCT_ENUMERATION
+        # 启发式规则在工作进程内、构造候选之前应用；配置文件没有 heuristic_rules 或开关关闭时不筛选
+        # heuristic_filter 为 None 时取 BaseConfig.FORMULA_HEURISTIC_FILTER
+        if heuristic_filter is None:
+            heuristic_filter = BaseConfig.FORMULA_HEURISTIC_FILTER
+        self.heuristic_filter: Optional[HeuristicFilter] = HeuristicFilter.from_config(self.config) if heuristic_filter else None
 
-    def build_formula_results(self, m2z: float, error_pct: float, error_da: float, charge: int, ms_mode: str, selected_adducts: List[str], elements: Dict[str, int]) -> Dict[str, List[dict]]:
-        order = normalize_elements(elements, self.atomic_weights)
+    def _lookup_cached(self, order: List[tuple], tasks: List[tuple], mw_tolerance: float) -> tuple:
+        # 按 (元素顺序, base_mw, 误差) 查缓存；返回命中结果与仍需计算的任务（附带缓存键）
+        cached: Dict[str, FormulaColumns] = {}
+        pending = []
+        for adduct, base_mw, ion_weight in tasks:
+            key = FormulaQueryCache.make_key(order, self.element_categories, self.atomic_weights.get('H', 1.0), base_mw, mw_tolerance, self._heuristics_key())
+            columns = self.query_cache.get(key) if self.query_cache is not None else None
+            if columns is None:
+                pending.append((adduct, base_mw, ion_weight, key))
+            else:
+                logging.info(f'adduct {adduct} 命中查询缓存，共 {len(columns)} 条候选')
+                cached[adduct] = columns
+        return cached, pending
+
+    def _heuristics_key(self) -> Optional[dict]:
+        return self.heuristic_filter.cache_key() if self.heuristic_filter is not None else None
+
+    def heuristic_params(self) -> Dict[str, Any]:
+        """实际生效的启发式筛选设置，写入结果的 input_params 以便复现"""
+        rules = self._heuristics_key()
+        return {'heuristic_filter': rules is not None, 'heuristic_rules': rules}
+
+    def _store_cached(self, key: str, columns: FormulaColumns) -> None:
+        if self.query_cache is not None:
+            self.query_cache.put(key, columns)
+
+    def _resolve_mw_tolerance(self, m2z: float, error_pct: float, error_da: float, charge: int, error_ppm: float = 0.0, verbose: bool = True) -> float:
+        # 三种误差（%、Da、ppm）分别换算为 m/z 窗口后取最大值；% 与 ppm 随 m/z 等比缩放
         pct_tolerance_mz = m2z * (max(error_pct, 0.0) / 100.0)
         da_tolerance_mz = max(error_da, 0.0)
+        ppm_tolerance_mz = m2z * (max(error_ppm, 0.0) / 1e6)
         pct_tolerance_mw = pct_tolerance_mz * charge
         da_tolerance_mw = da_tolerance_mz * charge
-        mw_tolerance = max(pct_tolerance_mw, da_tolerance_mw)
+        ppm_tolerance_mw = ppm_tolerance_mz * charge
+        mw_tolerance = max(pct_tolerance_mw, da_tolerance_mw, ppm_tolerance_mw)
 
         if mw_tolerance <= 0:
-            logging.warning('误差范围无效：error_pct 与 error_da 不能同时小于等于0。')
-            return {}
+            logging.warning('误差范围无效：error_pct、error_da 与 error_ppm 不能同时小于等于0。')
+            return 0.0
+        if not verbose:
+            return mw_tolerance
 
-        tolerance_source = 'error_pct(%)' if pct_tolerance_mw >= da_tolerance_mw else 'error_da(Da)'
+        if mw_tolerance == pct_tolerance_mw:
+            tolerance_source = 'error_pct(%)'
+        elif mw_tolerance == da_tolerance_mw:
+            tolerance_source = 'error_da(Da)'
+        else:
+            tolerance_source = 'error_ppm(ppm)'
         logging.info(
-            '误差窗口计算：m/z=%.4f, charge=%d, %%窗口=±%.4f m/z(±%.4f MW), Da窗口=±%.4f m/z(±%.4f MW), 最终采用=%s, 最终窗口=±%.4f m/z(±%.4f MW)',
+            '误差窗口计算：m/z=%.4f, charge=%d, %%窗口=±%.4f m/z(±%.4f MW), Da窗口=±%.4f m/z(±%.4f MW), ppm窗口=±%.4f m/z(±%.4f MW), 最终采用=%s, 最终窗口=±%.4f m/z(±%.4f MW)',
             m2z,
             charge,
             pct_tolerance_mz,
             pct_tolerance_mw,
             da_tolerance_mz,
             da_tolerance_mw,
+            ppm_tolerance_mz,
+            ppm_tolerance_mw,
             tolerance_source,
             mw_tolerance / charge,
             mw_tolerance,
         )
+        return mw_tolerance
 
-        results: Dict[str, List[dict]] = {}
-
+    def _build_adduct_tasks(self, m2z: float, charge: int, ms_mode: str, selected_adducts: List[str]) -> List[tuple]:
         tasks = []
         for adduct, ion_key in self.adducts.get(ms_mode, {}).items():
             if adduct not in selected_adducts:
@@ -167,56 +853,299 @@ class FormulaGenerator:
             if base_mw <= 0:
                 continue
             tasks.append((adduct, base_mw, ion_weight))
+        return tasks
+
+    def build_formula_results(self, m2z: float, error_pct: float, error_da: float, charge: int, ms_mode: str, selected_adducts: List[str], elements: Dict[str, int], engine: str = 'backtrack', error_ppm: float = 0.0) -> Dict[str, List[dict]]:
+        columns = self.build_formula_columns(m2z, error_pct, error_da, charge, ms_mode, selected_adducts, elements, engine=engine, error_ppm=error_ppm)
+        return {adduct: adduct_columns.to_dicts(adduct) for adduct, adduct_columns in columns.items()}
+
+    def rank_by_isotope_pattern(self, columns: Dict[str, FormulaColumns], observed: Dict[int, float], limit: Optional[int] = None) -> Dict[str, List[dict]]:
+        """按观测的 M+1 / M+2 强度对全部加合物的候选统一打分，只保留得分最高的 limit 条；各加合物内按得分降序"""
+        limit = BaseConfig.FORMULA_ISOTOPE_TOP_N if limit is None else limit
+        adducts = list(columns)
+        ranked = rank_isotope_candidates(self.isotope_calculator, [columns[adduct] for adduct in adducts], observed, limit)
+        rows_by_adduct = {adduct: columns[adduct].to_dicts(adduct) for adduct in adducts}
+        results: Dict[str, List[dict]] = {}
+        for part, row, score, m1, m2 in ranked:
+            item = rows_by_adduct[adducts[part]][row]
+            item['calculated_properties'].update({
+                'isotope_score': score,
+                'predicted_m1': m1,
+                'predicted_m2': m2,
+            })
+            results.setdefault(adducts[part], []).append(item)
+        total = sum(len(adduct_columns) for adduct_columns in columns.values())
+        logging.info(f'同位素峰型打分：{total} 条候选，保留得分最高的 {len(ranked)} 条')
+        return {adduct: results[adduct] for adduct in adducts if adduct in results}
 
+    def _plan_window_searches(self, order: List[tuple], base_mw: float, mw_tolerance: float) -> tuple:
+        """对照上次保留的同一 (元素, base_mw) 枚举，返回 (可复用的旧结果, 仍需枚举的区间列表, 窗口键)。
+
+        区间为 (下界, 上界, 含下界, 含上界)：放宽时只枚举两侧新增的边缘区间，收窄时不再枚举。
+        """
+        mw_min = base_mw - mw_tolerance
+        mw_max = base_mw + mw_tolerance
+        full_window = [(mw_min, mw_max, True, True)]
+        if self.window_store is None:
+            return None, full_window, None
+
+        window_key = FormulaQueryCache.make_key(order, self.element_categories, self.atomic_weights.get('H', 1.0), base_mw, heuristics=self._heuristics_key())
+        entry = self.window_store.get(window_key)
+        if entry is None:
+            return None, full_window, window_key
+        old_min, old_max, old_columns = entry
+        if old_max < mw_min or old_min > mw_max:
+            return None, full_window, window_key
+
+        retained = old_columns.take((old_columns.mass >= mw_min) & (old_columns.mass <= mw_max))
+        bands = []
+        if mw_min < old_min:
+            bands.append((mw_min, old_min, True, False))
+        if mw_max > old_max:
+            bands.append((old_max, mw_max, False, True))
+        return retained, bands, window_key
+
+    def build_formula_columns(self, m2z: float, error_pct: float, error_da: float, charge: int, ms_mode: str, selected_adducts: List[str], elements: Dict[str, int], engine: str = 'vectorized', error_ppm: float = 0.0) -> Dict[str, FormulaColumns]:
+        """按加合物返回列式结果，依次尝试：查询缓存、预计算分子式库（engine='library'）、上次枚举窗口的增量复用，最后才分发到进程池枚举"""
+        if engine not in ('vectorized', 'library') and engine not in SEARCH_ENGINES:
+            raise ValueError(f'未知的分子式枚举引擎: {engine}')
+
+        order = normalize_elements(elements, self.atomic_weights)
+        mw_tolerance = self._resolve_mw_tolerance(m2z, error_pct, error_da, charge, error_ppm)
+        if mw_tolerance <= 0:
+            return {}
+
+        results: Dict[str, FormulaColumns] = {}
+
+        tasks = self._build_adduct_tasks(m2z, charge, ms_mode, selected_adducts)
         if not tasks:
             return results
 
-        max_workers = max(1, os.cpu_count() // 2)
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            futures = {
-                executor.submit(backtrack_search, base_mw, mw_tolerance, order, self.atomic_weights, self.element_categories): (adduct, ion_weight)
-                for adduct, base_mw, ion_weight in tasks
-            }
-            for future in concurrent.futures.as_completed(futures):
-                adduct, ion_weight = futures[future]
+        cached, pending = self._lookup_cached(order, tasks, mw_tolerance)
+        results.update(cached)
+
+        if engine == 'library' and pending:
+            library = find_formula_library(order, self.atomic_weights, self.element_categories, max(base_mw for _, base_mw, _, _ in pending) + mw_tolerance)
+            if library is not None:
+                rejected: Dict[str, int] = {}
+                for adduct, base_mw, _, _ in pending:
+                    columns = library.search(base_mw, mw_tolerance, order)
+                    results[adduct] = columns if self.heuristic_filter is None else self.heuristic_filter.filter_columns(columns, rejected)
+                if rejected:
+                    logging.info(f'分子式库结果规则筛除：{rejected}')
+                pending = []
+            else:
+                logging.info('未找到覆盖本次查询的分子式库，改用向量化枚举')
+        search_engine = 'vectorized' if engine == 'library' else engine
+
+        jobs = []
+        for adduct, base_mw, _, key in pending:
+            retained, bands, window_key = self._plan_window_searches(order, base_mw, mw_tolerance)
+            if retained is not None:
+                logging.info(f'adduct {adduct} 复用上次枚举窗口，保留 {len(retained)} 条，新增枚举 {len(bands)} 个边缘区间')
+            jobs.append((adduct, base_mw, key, retained, window_key, bands))
+
+        # 所有待枚举区间：共享模式下合并为一组只遍历一次，否则每个区间单独成组
+        all_bands = [(job_index, band) for job_index, job in enumerate(jobs) for band in job[5]]
+        if self.shared_adduct_enumeration and search_engine in _SHARED_WINDOW_ENGINES and len(all_bands) > 1:
+            groups = [all_bands]
+            logging.info(f'{len(jobs)} 个加合物的 {len(all_bands)} 个质量区间合并为一次枚举')
+        else:
+            groups = [[item] for item in all_bands]
+        group_futures = [self._submit_window_group(search_engine, order, group) for group in groups]
+
+        element_names = [elem for elem, _, _ in order if elem != 'H'] + ['H']
+        job_parts = [[retained] if retained is not None else [] for _, _, _, retained, _, _ in jobs]
+        job_stats = [SearchStats() for _ in jobs]
+        failed = set()
+        for group, futures in zip(groups, group_futures):
+            try:
+                shard_results = []
+                for future in futures:
+                    shard_columns, shard_stats = future.result()
+                    shard_results.append(shard_columns)
+                    # 共享枚举的统计无法按加合物拆分，记在组内第一个任务上
+                    job_stats[group[0][0]].merge(shard_stats)
+                for position, (job_index, (low, high, include_low, include_high)) in enumerate(group):
+                    band = FormulaColumns.concat([parts[position] for parts in shard_results], element_names)
+                    keep = (band.mass >= low if include_low else band.mass > low) & (band.mass <= high if include_high else band.mass < high)
+                    job_parts[job_index].append(band.take(keep))
+            except Exception as ex:
+                failed.update(job_index for job_index, _ in group)
+                logging.error(f'adduct {", ".join(jobs[job_index][0] for job_index, _ in group)} 计算失败: {ex}', exc_info=True)
+
+        for job_index, (adduct, base_mw, key, retained, window_key, bands) in enumerate(jobs):
+            if job_index in failed:
+                continue
+            if bands:
+                logging.info(f'adduct {adduct} 枚举统计：{job_stats[job_index].summary()}')
+            columns = FormulaColumns.concat(job_parts[job_index], element_names)
+            if retained is not None:
+                columns = columns.dfs_sorted()
+            self._store_cached(key, columns)
+            if window_key is not None:
+                self._remember_window(window_key, base_mw - mw_tolerance, base_mw + mw_tolerance, columns)
+            results[adduct] = columns
+
+        # 与任务顺序保持一致，缓存命中与否不影响结果的键顺序
+        return {
+            adduct: results[adduct].with_adduct(charge, ion_weight)
+            for adduct, _, ion_weight in tasks
+            if adduct in results and len(results[adduct])
+        }
+
+    def _submit_window_group(self, engine: str, order: List[tuple], group: List[tuple]) -> list:
+        # 区间两端略微放宽后枚举，再由调用方按精确开闭边界过滤，避免浮点误差漏掉边界上的候选
+        windows = []
+        for _, (low, high, _, _) in group:
+            margin = _PRUNE_EPSILON * max(1.0, abs(high))
+            windows.append((low - margin, high + margin))
+        union_min = min(low for low, _ in windows)
+        union_max = max(high for _, high in windows)
+        pool = ProcessPool()
+        shards = plan_search_shards((union_min + union_max) / 2, (union_max - union_min) / 2, order, pool.max_workers * _SHARDS_PER_WORKER)
+        return [
+            pool.submit(_run_windows_task, engine, windows, order, self.atomic_weights, self.element_categories, prefix, self.heuristic_filter)
+            for prefix in shards
+        ]
+
+    def _remember_window(self, window_key: str, mw_min: float, mw_max: float, columns: FormulaColumns) -> None:
+        # 新窗口被旧窗口完全包含时保留更宽的旧结果，便于之后再次放宽
+        entry = self.window_store.get(window_key)
+        if entry is not None and entry[0] <= mw_min and mw_max <= entry[1]:
+            return
+        self.window_store.put(window_key, mw_min, mw_max, columns)
+
+    def build_batch_columns(self, peaks: Sequence[float], error_pct: float, error_da: float, charge: int, ms_mode: str, selected_adducts: List[str], elements: Dict[str, int], error_ppm: float = 0.0) -> Dict[str, Any]:
+        """批量峰列表：所有窗口按质量排序后切成连续质量段分发给进程池，每段只展开一次重原子组合。
+
+        返回合并后的列式结果及逐行的 peak_index（peaks 中的原始下标）与 adduct_index（adducts 中的下标），
+        rejected 为各任务按规则名合并的启发式筛除数。
+        """
+        order = normalize_elements(elements, self.atomic_weights)
+        adducts = [adduct for adduct in self.adducts.get(ms_mode, {}) if adduct in selected_adducts]
+        element_names = [elem for elem, _, _ in order if elem != 'H'] + ['H']
+
+        windows = []
+        for peak_idx, m2z in enumerate(peaks):
+            mw_tolerance = self._resolve_mw_tolerance(m2z, error_pct, error_da, charge, error_ppm, verbose=False)
+            if mw_tolerance <= 0:
+                continue
+            for adduct, base_mw, ion_weight in self._build_adduct_tasks(m2z, charge, ms_mode, selected_adducts):
+                windows.append((peak_idx, adducts.index(adduct), base_mw, mw_tolerance, ion_weight))
+
+        result = {
+            'adducts': adducts,
+            'columns': FormulaColumns.empty(element_names),
+            'peak_index': np.zeros(0, dtype=np.int32),
+            'adduct_index': np.zeros(0, dtype=np.int16),
+            'rejected': {},
+        }
+        if not windows:
+            return result
+
+        # 相互重叠的窗口（如 ppm 误差下相邻的峰）归为同一质量带一起搜索；按窗口数把质量带均分为若干块，质量带不跨块拆分。
+        # 各工作进程按整批最大质量展开一次重原子组合表，之后分到该进程的块都复用，因此可以切成多于进程数的块以均衡负载
+        bands = _group_overlapping_windows(windows)
+        pool = ProcessPool()
+        table_mw_max = max(base_mw + tolerance for _, _, base_mw, tolerance, _ in windows)
+        chunk_size = math.ceil(len(windows) / min(len(bands), pool.max_workers * _SHARDS_PER_WORKER))
+        chunks = [[]]
+        chunk_windows = 0
+        for band in bands:
+            if chunk_windows >= chunk_size:
+                chunks.append([])
+                chunk_windows = 0
+            chunks[-1].append(band)
+            chunk_windows += len(band)
+        futures = [
+            pool.submit(_run_batch_task, chunk, order, self.atomic_weights, self.element_categories, charge, self.heuristic_filter, table_mw_max)
+            for chunk in chunks
+        ]
+        parts = [future.result() for future in futures]
+        result['columns'] = FormulaColumns.concat([columns for columns, _, _, _ in parts], element_names)
+        result['peak_index'] = np.concatenate([peak_index for _, peak_index, _, _ in parts])
+        result['adduct_index'] = np.concatenate([adduct_index for _, _, adduct_index, _ in parts])
+        for _, _, _, rejected in parts:
+            for name, count in rejected.items():
+                result['rejected'][name] = result['rejected'].get(name, 0) + count
+        logging.info(f'批量枚举完成：{len(peaks)} 个峰，{len(windows)} 个窗口合并为 {len(bands)} 个质量带，{len(futures)} 个任务，共 {len(result["columns"])} 条候选')
+        return result
+
+    def iter_formula_candidates(self, m2z: float, error_pct: float, error_da: float, charge: int, ms_mode: str, selected_adducts: List[str], elements: Dict[str, int], engine: str = 'backtrack', chunk_size: int = _STREAM_CHUNK_SIZE, error_ppm: float = 0.0) -> Iterator[List[dict]]:
+        """流式枚举：工作进程经有界队列分块回传，逐块产出与 build_formula_results 同结构的字典列表。
+
+        消费者处理较慢时生产者阻塞，峰值内存与结果总数无关；块的先后顺序取决于各分片的完成顺序。
+        """
+        if engine != 'vectorized' and engine not in SEARCH_ENGINES:
+            raise ValueError(f'未知的分子式枚举引擎: {engine}')
+
+        order = normalize_elements(elements, self.atomic_weights)
+        mw_tolerance = self._resolve_mw_tolerance(m2z, error_pct, error_da, charge, error_ppm)
+        if mw_tolerance <= 0:
+            return
+        tasks = self._build_adduct_tasks(m2z, charge, ms_mode, selected_adducts)
+        if not tasks:
+            return
+
+        pool = ProcessPool()
+        result_queue = pool.create_queue(pool.max_workers * _STREAM_QUEUE_CHUNKS_PER_WORKER)
+        cancel_event = pool.create_event()
+        futures = []
+        for task_index, (adduct, base_mw, _) in enumerate(tasks):
+            for prefix in plan_search_shards(base_mw, mw_tolerance, order, pool.max_workers * _SHARDS_PER_WORKER):
+                futures.append((task_index, pool.submit(
+                    _run_stream_task, result_queue, cancel_event, task_index, engine, base_mw, mw_tolerance,
+                    order, self.atomic_weights, self.element_categories, prefix, chunk_size, self.heuristic_filter
+                )))
+
+        try:
+            while True:
                 try:
-                    candidates = future.result()
-                    if not candidates:
-                        continue
-                    results[adduct] = [
-                        {
-                            **candidate.to_dict(),
-                            'adduct_type': adduct,
-                            'calculated_properties': {
-                                'dbr': candidate.dbr,
-                                'predicted_mz': (candidate.predicted_mw + charge * ion_weight) / charge,
-                                'molecular_weight': candidate.predicted_mw,
-                            }
-                        }
-                        for candidate in candidates
-                    ]
-                except Exception as ex:
-                    logging.error(f'adduct {adduct} 计算失败: {ex}', exc_info=True)
-        return results
+                    task_index, rows = result_queue.get(timeout=_STREAM_POLL_INTERVAL_SEC)
+                except queue_module.Empty:
+                    # 子进程先写队列再结束，全部完成后队列仍为空即表示没有剩余数据
+                    if all(future.done() for _, future in futures) and result_queue.empty():
+                        break
+                    continue
+                adduct, _, ion_weight = tasks[task_index]
+                yield [_build_result_row(formula, dbr, predicted_mw, adduct, charge, ion_weight) for formula, dbr, predicted_mw in rows]
+        finally:
+            cancel_event.set()
+            for _, future in futures:
+                future.cancel()
+
+        stats = [SearchStats() for _ in tasks]
+        for task_index, future in futures:
+            try:
+                stats[task_index].merge(future.result())
+            except Exception as ex:
+                logging.error(f'adduct {tasks[task_index][0]} 计算失败: {ex}', exc_info=True)
+        for (adduct, _, _), adduct_stats in zip(tasks, stats):
+            logging.info(f'adduct {adduct} 流式枚举统计：{adduct_stats.summary()}')
 
 
 def start_analysis(input_data: Dict[str, Any]) -> Dict[str, Any]:
     start_time = time.time()
     try:
-        generator = FormulaGenerator()
+        generator = FormulaGenerator(heuristic_filter=input_data.get('heuristic_filter'))
         ms_mode = input_data['ms_mode']
         selected_adducts = input_data.get('adduct_model', [])
         m2z = float(input_data['m2z'])
-        error_pct = float(input_data['error_pct'])
+        error_pct = float(input_data.get('error_pct', 0.0))
         error_da = float(input_data.get('error_da', 0.0))
+        error_ppm = float(input_data.get('error_ppm', 0.0))
         charge = int(input_data['charge'])
         elements = input_data['elements']
+        engine = input_data.get('engine', BaseConfig.FORMULA_GENERATION_ENGINE)
+        observed_isotopes = observed_isotope_intensities(input_data.get('isotope_m1'), input_data.get('isotope_m2'))
 
         if not selected_adducts:
             logging.warning('未选择任何离子类型。')
             return {
                 'input_params': {
                     **input_data,
+                    **generator.heuristic_params(),
                     'adduct_model': []
                 },
                 'results': []
@@ -225,17 +1154,40 @@ def start_analysis(input_data: Dict[str, Any]) -> Dict[str, Any]:
         result = {
             'input_params': {
                 **input_data,
+                **generator.heuristic_params(),
                 'adduct_model': selected_adducts
             },
-            'formulas': generator.build_formula_results(m2z, error_pct, error_da, charge, ms_mode, selected_adducts, elements)
+            'formulas': {}
         }
+        export_format = _resolve_export_format(BaseConfig.FORMULA_GENERATION_EXPORT_FORMAT)
+        if observed_isotopes and generator.isotope_calculator is not None:
+            columns = generator.build_formula_columns(m2z, error_pct, error_da, charge, ms_mode, selected_adducts, elements, engine=engine, error_ppm=error_ppm)
+            result['formulas'] = generator.rank_by_isotope_pattern(columns, observed_isotopes)
+        elif export_format == 'json':
+            result['formulas'] = generator.build_formula_results(m2z, error_pct, error_da, charge, ms_mode, selected_adducts, elements, engine=engine, error_ppm=error_ppm)
+        else:
+            # 列式导出直接写出 FormulaColumns，不构造逐行字典
+            columns = generator.build_formula_columns(m2z, error_pct, error_da, charge, ms_mode, selected_adducts, elements, engine=engine, error_ppm=error_ppm)
+            columns = {adduct: adduct_columns for adduct, adduct_columns in columns.items() if len(adduct_columns)}
+            if columns:
+                result['columns'] = columns
 
-        if result['formulas']:
-            json_exporter = ExporterFactory.get_exporter('json_formulaGeneration')
-            if json_exporter is None:
+        if result['formulas'] or 'columns' in result:
+            exporter = ExporterFactory.get_exporter(f'{export_format}_formulaGeneration')
+            if exporter is None:
                 raise ValueError('未找到生成结果导出器')
-            data_to_save = json_exporter.export(result)
-            logging.info(f'分析完成，结果已保存。耗时 {time.time() - start_time:.2f} 秒')
+            data_to_save = exporter.build(result)
+            # 结果文件只在这里写出一次：sync 返回 results_path，async 返回写出完成后得到路径的 save_future
+            save_mode = BaseConfig.FORMULA_GENERATION_SAVE_MODE
+            if save_mode == 'sync':
+                results_path = exporter.write(data_to_save)
+                logging.info(f'分析完成，结果已保存。耗时 {time.time() - start_time:.2f} 秒')
+                return {**data_to_save, 'results_path': results_path}
+            if save_mode == 'async':
+                future = BackgroundWriter().submit(exporter.write, data_to_save)
+                logging.info(f'分析完成，结果文件在后台写出。耗时 {time.time() - start_time:.2f} 秒')
+                return {**data_to_save, 'save_future': future}
+            logging.info(f'分析完成，结果未保存（可手动保存）。耗时 {time.time() - start_time:.2f} 秒')
             return data_to_save
 
         logging.warning('未找到符合条件的分子式')
@@ -249,3 +1201,115 @@ def start_analysis(input_data: Dict[str, Any]) -> Dict[str, Any]:
             'input_params': input_data,
             'results': []
         }
+
+
+def _resolve_export_format(export_format: str) -> str:
+    if export_format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        logging.warning('未安装 pyarrow，结果改为 npz 格式导出')
+        return 'npz'
+    return export_format
+
+
+def save_analysis_result(data_to_save: Dict[str, Any]) -> Future:
+    """'manual' 保存模式下把 start_analysis 返回的结果交给后台写出线程保存，返回写出完成后得到文件路径的 Future"""
+    # 列式结果只能写成 npz / parquet，逐条记录的结果写成 JSON
+    if 'columns' in data_to_save:
+        export_format = _resolve_export_format(BaseConfig.FORMULA_GENERATION_EXPORT_FORMAT)
+        export_format = 'npz' if export_format == 'json' else export_format
+    else:
+        export_format = 'json'
+    exporter = ExporterFactory.get_exporter(f'{export_format}_formulaGeneration')
+    if exporter is None:
+        raise ValueError('未找到生成结果导出器')
+    return BackgroundWriter().submit(exporter.write, data_to_save)
+
+
+def shutdown_result_writer() -> None:
+    # 写完队列中尚未落盘的结果文件后再返回
+    BackgroundWriter().shutdown()
+
+
+def start_streaming_analysis(input_data: Dict[str, Any]) -> Dict[str, Any]:
+    """流式分析：边枚举边写出 JSON / CSV 文件，不在内存中保留完整结果；返回导出文件路径与结果数"""
+    start_time = time.time()
+    try:
+        generator = FormulaGenerator(heuristic_filter=input_data.get('heuristic_filter'))
+        selected_adducts = input_data.get('adduct_model', [])
+        input_params = {
+            **input_data,
+            **generator.heuristic_params(),
+            'adduct_model': selected_adducts
+        }
+        if not selected_adducts:
+            logging.warning('未选择任何离子类型。')
+            return {'input_params': input_params, 'results_path': None, 'result_count': 0}
+
+        chunks = generator.iter_formula_candidates(
+            float(input_data['m2z']),
+            float(input_data.get('error_pct', 0.0)),
+            float(input_data.get('error_da', 0.0)),
+            int(input_data['charge']),
+            input_data['ms_mode'],
+            selected_adducts,
+            input_data['elements'],
+            engine=input_data.get('engine', 'backtrack'),
+            error_ppm=float(input_data.get('error_ppm', 0.0)),
+        )
+        stream_format = BaseConfig.FORMULA_STREAM_EXPORT_FORMAT
+        if stream_format in ('csv', 'csv.gz'):
+            exporter = ExporterFactory.get_exporter('csv_formulaGeneration')
+            if exporter is None:
+                raise ValueError('未找到生成结果导出器')
+            summary = exporter.export_stream(input_params, chunks, compress=stream_format == 'csv.gz')
+        else:
+            exporter = ExporterFactory.get_exporter('json_formulaGeneration')
+            if exporter is None:
+                raise ValueError('未找到生成结果导出器')
+            summary = exporter.export_stream(input_params, chunks)
+        if summary['result_count']:
+            logging.info(f'流式分析完成，共 {summary["result_count"]} 条结果。耗时 {time.time() - start_time:.2f} 秒')
+        else:
+            logging.warning('未找到符合条件的分子式')
+        return summary
+    except Exception as ex:
+        logging.exception(f'分析失败: {ex}')
+        return {'input_params': input_data, 'results_path': None, 'result_count': 0}
+
+
+def start_batch_analysis(peaks: List[float], input_data: Dict[str, Any]) -> Dict[str, Any]:
+    """峰列表批量分析：共用元素顺序与进程池，所有峰的结果写入同一个带 peak_index 列的列式文件"""
+    start_time = time.time()
+    try:
+        generator = FormulaGenerator(heuristic_filter=input_data.get('heuristic_filter'))
+        selected_adducts = input_data.get('adduct_model', [])
+        peaks = [float(peak) for peak in peaks]
+        input_params = {
+            **input_data,
+            **generator.heuristic_params(),
+            'adduct_model': selected_adducts
+        }
+        if not selected_adducts:
+            logging.warning('未选择任何离子类型。')
+            return {'input_params': input_params, 'peaks': peaks, 'results_path': None, 'result_count': 0}
+
+        batch = generator.build_batch_columns(
+            peaks,
+            float(input_data.get('error_pct', 0.0)),
+            float(input_data.get('error_da', 0.0)),
+            int(input_data['charge']),
+            input_data['ms_mode'],
+            selected_adducts,
+            input_data['elements'],
+            error_ppm=float(input_data.get('error_ppm', 0.0)),
+        )
+        npz_exporter = ExporterFactory.get_exporter('npz_formulaGenerationBatch')
+        if npz_exporter is None:
+            raise ValueError('未找到批量生成结果导出器')
+        summary = npz_exporter.export({'input_params': input_params, 'peaks': peaks, **batch})
+        if batch['rejected']:
+            logging.info(f'批量分析规则筛除：{batch["rejected"]}')
+        logging.info(f'批量分析完成，{len(peaks)} 个峰共 {summary["result_count"]} 条结果。耗时 {time.time() - start_time:.2f} 秒')
+        return {**summary, 'rejected': batch['rejected']}
+    except Exception as ex:
+        logging.exception(f'批量分析失败: {ex}')
+        return {'input_params': input_data, 'peaks': list(peaks), 'results_path': None, 'result_count': 0}
@@ -0,0 +1,114 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ..service.vectorized_generation_service import FormulaColumns
+
+
+SENIOR_RULE = 'SENIOR'
+
+
+def _ratio_rule(elem: str) -> str:
+    return f'{elem}/C'
+
+
+class HeuristicFilter:
+    """枚举阶段的启发式筛选（Seven Golden Rules 中的元素比例规则与 SENIOR 价态规则）。
+
+    - 元素比例：X/C 须落在配置的闭区间内；不含 C 的分子式不做比例检查
+    - SENIOR：价电子总数不小于最大价态的两倍（奇偶性与 DBR 非负已由 DBR 校验保证）
+
+    规则按固定顺序检查，被拒绝的候选只计入第一条不满足的规则，保证各引擎的计数一致。
+    """
+
+    def __init__(self, element_ratios: Dict[str, Tuple[float, float]], senior: bool, element_categories: Dict[str, List[str]]):
+        self.element_ratios = {elem: (float(low), float(high)) for elem, (low, high) in element_ratios.items() if elem != 'C'}
+        self.senior = senior
+        self.valences: Dict[str, int] = {}
+        for valence, key in ((1, 'valency_1'), (3, 'valency_3'), (4, 'valency_4')):
+            for elem in element_categories.get(key, []):
+                self.valences[elem] = valence
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional['HeuristicFilter']:
+        rules = config.get('heuristic_rules')
+        if not rules:
+            return None
+        return cls(rules.get('element_ratios', {}), bool(rules.get('senior', True)), config['element_categories'])
+
+    def valence(self, elem: str) -> int:
+        # 未归类的元素（O、S、Se）按二价处理
+        return self.valences.get(elem, 2)
+
+    def cache_key(self) -> Dict[str, Any]:
+        return {'element_ratios': self.element_ratios, 'senior': self.senior}
+
+    def heavy_rejection(self, heavy: Dict[str, int]) -> Optional[str]:
+        """只依赖重原子计数的规则：返回第一条不满足的杂原子比例规则，全部满足时返回 None"""
+        carbon = heavy.get('C', 0)
+        if not carbon:
+            return None
+        for elem, (low, high) in self.element_ratios.items():
+            if elem == 'H':
+                continue
+            count = heavy.get(elem, 0)
+            if count < low * carbon or count > high * carbon:
+                return _ratio_rule(elem)
+        return None
+
+    def hydrogen_limits(self, heavy: Dict[str, int]) -> tuple:
+        """叶子节点预先计算 H 计数的界限：(H/C 下限, H/C 上限, SENIOR 下限)"""
+        carbon = heavy.get('C', 0)
+        hc_low, hc_high = 0.0, float('inf')
+        if carbon and 'H' in self.element_ratios:
+            low, high = self.element_ratios['H']
+            hc_low, hc_high = low * carbon, high * carbon
+        senior_low = float('-inf')
+        if self.senior:
+            present = [self.valence(elem) for elem, count in heavy.items() if count]
+            valence_sum = sum(self.valence(elem) * count for elem, count in heavy.items())
+            senior_low = 2 * max(present + [1]) - valence_sum
+        return hc_low, hc_high, senior_low
+
+    @staticmethod
+    def hydrogen_rejection(limits: tuple, h_count: int) -> Optional[str]:
+        hc_low, hc_high, senior_low = limits
+        if h_count < hc_low or h_count > hc_high:
+            return _ratio_rule('H')
+        if h_count < senior_low:
+            return SENIOR_RULE
+        return None
+
+    def filter_columns(self, columns: FormulaColumns, rejected: Optional[Dict[str, int]] = None) -> FormulaColumns:
+        """向量化版本：返回满足全部规则的行，被拒绝的行按第一条不满足的规则计入 rejected"""
+        if len(columns) == 0:
+            return columns
+        counts = columns.counts.astype(np.int64)
+        column = {elem: counts[:, index] for index, elem in enumerate(columns.elements)}
+        zeros = np.zeros(len(columns), dtype=np.int64)
+        carbon = column.get('C', zeros)
+        has_carbon = carbon > 0
+        keep = np.ones(len(columns), dtype=bool)
+
+        def reject(name: str, failed: np.ndarray) -> None:
+            nonlocal keep
+            failed = failed & keep
+            if rejected is not None and failed.any():
+                rejected[name] = rejected.get(name, 0) + int(failed.sum())
+            keep &= ~failed
+
+        for elem, (low, high) in self.element_ratios.items():
+            if elem == 'H':
+                continue
+            count = column.get(elem, zeros)
+            reject(_ratio_rule(elem), has_carbon & ((count < low * carbon) | (count > high * carbon)))
+        if 'H' in self.element_ratios:
+            low, high = self.element_ratios['H']
+            count = column.get('H', zeros)
+            reject(_ratio_rule('H'), has_carbon & ((count < low * carbon) | (count > high * carbon)))
+        if self.senior:
+            valences = np.array([self.valence(elem) for elem in columns.elements], dtype=np.int64)
+            valence_sum = counts @ valences
+            max_valence = np.where(counts > 0, valences, 1).max(axis=1)
+            reject(SENIOR_RULE, valence_sum < 2 * max_valence)
+        return columns.take(keep)
@@ -0,0 +1,299 @@
+import hashlib
+import json
+import logging
+import math
+import shutil
+import threading
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from ..config.path_config import PathManager
+from ..core.process_pool import ProcessPool
+from ..service.vectorized_generation_service import FormulaColumns, attach_hydrogen_bounded, mass_sorted_heavy_atoms
+
+
+# 构建时每个质量段的宽度（Da）：各段由工作进程写入临时文件，主进程按质量顺序拼接
+_LIBRARY_BAND_DA = 25.0
+_LIBRARY_DIR_PREFIX = 'formula_library_'
+_META_FILENAME = 'meta.json'
+_COUNTS_FILENAME = 'counts.bin'
+_MASS_FILENAME = 'mass.bin'
+_DBR_FILENAME = 'dbr.bin'
+# 构建期间的重原子组合表（按质量排序的内存映射文件），构建完成后删除
+_HEAVY_DIRNAME = 'heavy'
+_HEAVY_COUNTS_FILENAME = 'heavy_counts.bin'
+_HEAVY_MASS_FILENAME = 'heavy_mass.bin'
+_HEAVY_H_LIMIT_FILENAME = 'heavy_h_limit.bin'
+# 单个子段展开 H 的最多行数（重原子行 × H 计数），控制工作进程的峰值内存
+_BAND_EXPAND_ROWS = 500_000
+
+# 已打开的库（按目录缓存），避免每次查询重新读取元数据与建立内存映射
+_OPENED_LIBRARIES: Dict[Path, 'FormulaLibrary'] = {}
+# 同一进程内的构建串行执行（启动时的后台构建与手动构建可能同时发起）
+_BUILD_LOCK = threading.Lock()
+
+
+def _cap_to_json(max_count: float) -> int:
+    return -1 if max_count == float('inf') else int(max_count)
+
+
+def _cap_from_json(max_count: int) -> float:
+    return float('inf') if max_count == -1 else max_count
+
+
+def _library_key(elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], mw_limit: float) -> str:
+    payload = {
+        'elements': [[elem, weight, _cap_to_json(max_count)] for elem, weight, max_count in elements_order],
+        'h_weight': atomic_weights.get('H', 1.0),
+        'element_categories': {key: sorted(value) for key, value in element_categories.items()},
+        'mw_limit': mw_limit,
+    }
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def _write_heavy_table(heavy_dir: Path, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], mw_limit: float) -> int:
+    # 重原子组合只在主进程中按 mw_limit 展开一次，按质量排序后写入内存映射文件供各质量段共享
+    heavy_counts, heavy_mass, h_limit = mass_sorted_heavy_atoms(elements_order, element_categories, mw_limit)
+    heavy_dir.mkdir(parents=True)
+    np.ascontiguousarray(heavy_counts, dtype=np.int16).tofile(heavy_dir / _HEAVY_COUNTS_FILENAME)
+    np.ascontiguousarray(heavy_mass, dtype=np.float64).tofile(heavy_dir / _HEAVY_MASS_FILENAME)
+    np.ascontiguousarray(h_limit, dtype=np.int32).tofile(heavy_dir / _HEAVY_H_LIMIT_FILENAME)
+    return len(heavy_mass)
+
+
+def _open_heavy_table(heavy_dir: Path, heavy_count: int, heavy_elements: int) -> tuple:
+    if not heavy_count:
+        return np.zeros((0, heavy_elements), dtype=np.int16), np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.int32)
+    return (
+        np.memmap(heavy_dir / _HEAVY_COUNTS_FILENAME, dtype=np.int16, mode='r', shape=(heavy_count, heavy_elements)),
+        np.memmap(heavy_dir / _HEAVY_MASS_FILENAME, dtype=np.float64, mode='r', shape=(heavy_count,)),
+        np.memmap(heavy_dir / _HEAVY_H_LIMIT_FILENAME, dtype=np.int32, mode='r', shape=(heavy_count,)),
+    )
+
+
+def _build_library_band(heavy_dir: Path, heavy_count: int, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], band_low: float, band_high: float, include_high: bool, band_prefix: Path) -> tuple:
+    """子进程入口：枚举质量落在 [band_low, band_high) 内的全部合法分子式，按质量排序后写入 band_prefix 开头的三个文件。
+
+    只读取加满 H 仍能达到 band_low 的重原子行，H 计数同时受质量段与 DBR 上限约束；
+    展开量超过 _BAND_EXPAND_ROWS 时再按质量切分为子段逐段排序追加。返回 (写出的行数, 读取的重原子行数)。
+    """
+    h_weight = atomic_weights.get('H', 1.0)
+    elements = [elem for elem, _, _ in elements_order if elem != 'H'] + ['H']
+    heavy_counts, heavy_mass, heavy_h_limit = _open_heavy_table(heavy_dir, heavy_count, len(elements) - 1)
+
+    # 重原子质量有序：质量不超过 band_high 的行是一个前缀，再按“加满 H 的最大质量”筛出能到达本段的行
+    stop = int(np.searchsorted(heavy_mass, band_high, side='right'))
+    prefix_mass = np.asarray(heavy_mass[:stop])
+    prefix_limit = np.asarray(heavy_h_limit[:stop], dtype=np.int64)
+    rows = np.flatnonzero(prefix_mass + prefix_limit * h_weight >= band_low - 1e-6)
+    mass = prefix_mass[rows]
+    h_limit = prefix_limit[rows]
+    reach = mass + h_limit * h_weight
+
+    # 本段内 (重原子行, H 计数) 的展开总数，决定切分的子段数，使单个子段的内存与库的规模无关
+    min_h = np.ceil(np.maximum(0.0, (band_low - mass) / h_weight))
+    max_h = np.minimum(np.floor((band_high - mass) / h_weight), h_limit)
+    expand_rows = int(np.maximum(max_h - min_h + 1, 0).sum())
+    edges = np.linspace(band_low, band_high, max(1, math.ceil(expand_rows / _BAND_EXPAND_ROWS)) + 1)
+
+    count = 0
+    with open(f'{band_prefix}{_COUNTS_FILENAME}', 'wb') as counts_file, \
+            open(f'{band_prefix}{_MASS_FILENAME}', 'wb') as mass_file, \
+            open(f'{band_prefix}{_DBR_FILENAME}', 'wb') as dbr_file:
+        for index in range(len(edges) - 1):
+            sub_low, sub_high = float(edges[index]), float(edges[index + 1])
+            include_sub_high = include_high and index == len(edges) - 2
+            sub_rows = rows[(mass <= sub_high) & (reach >= sub_low - 1e-6)]
+            columns = attach_hydrogen_bounded(
+                heavy_counts[sub_rows], heavy_mass[sub_rows], heavy_h_limit[sub_rows], sub_low, sub_high + 1e-7,
+                elements_order, atomic_weights, element_categories,
+            )
+            keep = (columns.mass >= sub_low) & ((columns.mass <= sub_high) if include_sub_high else (columns.mass < sub_high))
+            columns = columns.take(keep)
+            # 子段按质量递增，逐段排序后追加即整体有序
+            order = np.argsort(columns.mass, kind='stable')
+            counts_file.write(np.ascontiguousarray(columns.counts[order], dtype=np.int16).tobytes())
+            mass_file.write(np.ascontiguousarray(columns.mass[order], dtype=np.float64).tobytes())
+            dbr_file.write(np.ascontiguousarray(columns.dbr[order], dtype=np.float64).tobytes())
+            count += len(columns)
+    return count, len(rows)
+
+
+def _append_file(target, source_path: str) -> None:
+    with open(source_path, 'rb') as source:
+        shutil.copyfileobj(source, target)
+    Path(source_path).unlink()
+
+
+class FormulaLibrary:
+    """按质量排序、内存映射的分子式库：给定元素表与上限一次枚举，查询只需二分定位质量区间"""
+
+    def __init__(self, library_dir: Path):
+        self.library_dir = Path(library_dir)
+        with open(self.library_dir / _META_FILENAME, 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        self.elements: List[str] = self.meta['elements']
+        self.caps = {elem: _cap_from_json(cap) for elem, cap in zip(self.elements, self.meta['caps'])}
+        self.weights = dict(zip(self.elements, self.meta['weights']))
+        self.mw_limit = float(self.meta['mw_limit'])
+        self.element_categories = self.meta['element_categories']
+        count = int(self.meta['count'])
+        if count:
+            self.counts = np.memmap(self.library_dir / _COUNTS_FILENAME, dtype=np.int16, mode='r', shape=(count, len(self.elements)))
+            self.mass = np.memmap(self.library_dir / _MASS_FILENAME, dtype=np.float64, mode='r', shape=(count,))
+            self.dbr = np.memmap(self.library_dir / _DBR_FILENAME, dtype=np.float64, mode='r', shape=(count,))
+        else:
+            self.counts = np.zeros((0, len(self.elements)), dtype=np.int16)
+            self.mass = np.zeros(0, dtype=np.float64)
+            self.dbr = np.zeros(0, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return int(self.mass.shape[0])
+
+    def covers(self, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], mw_max: float) -> bool:
+        if mw_max > self.mw_limit or self.weights['H'] != atomic_weights.get('H', 1.0):
+            return False
+        categories = {key: sorted(value) for key, value in element_categories.items()}
+        if categories != self.element_categories:
+            return False
+        for elem, weight, max_count in elements_order:
+            if elem not in self.caps or self.weights[elem] != weight or max_count > self.caps[elem]:
+                return False
+        # 查询未声明 H 时按无上限处理（与 backtrack_search 一致）
+        if not any(elem == 'H' for elem, _, _ in elements_order) and self.caps.get('H') != float('inf'):
+            return False
+        return True
+
+    def search(self, target_mw: float, tolerance_mw: float, elements_order: List[tuple]) -> FormulaColumns:
+        """二分定位 [target-tol, target+tol] 的行，再按查询元素上限过滤并还原深度优先顺序"""
+        start = int(np.searchsorted(self.mass, target_mw - tolerance_mw, side='left'))
+        stop = int(np.searchsorted(self.mass, target_mw + tolerance_mw, side='right'))
+        counts = np.asarray(self.counts[start:stop])
+        mass = np.asarray(self.mass[start:stop])
+        dbr = np.asarray(self.dbr[start:stop])
+
+        query_caps = {elem: max_count for elem, _, max_count in elements_order}
+        query_caps.setdefault('H', float('inf'))
+        keep = np.ones(len(mass), dtype=bool)
+        for col, elem in enumerate(self.elements):
+            if elem not in query_caps:
+                keep &= counts[:, col] == 0
+            elif query_caps[elem] != float('inf'):
+                keep &= counts[:, col] <= query_caps[elem]
+
+        query_elements = [elem for elem, _, _ in elements_order if elem != 'H'] + ['H']
+        return FormulaColumns(
+            elements=query_elements,
+            counts=counts[keep][:, [self.elements.index(elem) for elem in query_elements]],
+            mass=mass[keep],
+            mz=mass[keep],
+            dbr=dbr[keep],
+        ).dfs_sorted()
+
+
+def build_formula_library(elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], mw_limit: float, library_root: Optional[Path] = None) -> FormulaLibrary:
+    """按 normalize_elements 给出的元素顺序与上限枚举全部合法分子式，写入缓存目录下的内存映射文件"""
+    library_root = Path(library_root) if library_root is not None else PathManager().get_formula_library_path()
+    key = _library_key(elements_order, atomic_weights, element_categories, mw_limit)
+    library_dir = library_root / f'{_LIBRARY_DIR_PREFIX}{key}'
+    with _BUILD_LOCK:
+        if (library_dir / _META_FILENAME).exists():
+            logging.info(f'分子式库已存在，直接复用: {library_dir}')
+            return open_formula_library(library_dir)
+        return _build_library_files(library_root, library_dir, key, elements_order, atomic_weights, element_categories, mw_limit)
+
+
+def _build_library_files(library_root: Path, library_dir: Path, key: str, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], mw_limit: float) -> FormulaLibrary:
+
+    elements = [elem for elem, _, _ in elements_order if elem != 'H'] + ['H']
+    weights = {elem: weight for elem, weight, _ in elements_order}
+    weights.setdefault('H', atomic_weights.get('H', 1.0))
+    caps = {elem: max_count for elem, _, max_count in elements_order}
+    caps.setdefault('H', float('inf'))
+
+    # 先写入临时目录，全部完成后再改名，避免中断的构建被当作可用库
+    building_dir = library_root / f'{_LIBRARY_DIR_PREFIX}{key}.building'
+    shutil.rmtree(building_dir, ignore_errors=True)
+    building_dir.mkdir(parents=True)
+
+    heavy_dir = building_dir / _HEAVY_DIRNAME
+    heavy_count = _write_heavy_table(heavy_dir, elements_order, atomic_weights, element_categories, mw_limit)
+
+    pool = ProcessPool()
+    bands = []
+    band_low = 0.0
+    while band_low < mw_limit:
+        band_high = min(band_low + _LIBRARY_BAND_DA, mw_limit)
+        bands.append((band_low, band_high, band_high >= mw_limit))
+        band_low = band_high
+    # 各质量段由工作进程直接写入临时文件，主进程按顺序拼接；限制同时在途的质量段数量，临时文件不会无限堆积
+    max_in_flight = pool.max_workers * 2
+    futures = deque()
+    pending_bands = iter(enumerate(bands))
+
+    def submit_next() -> None:
+        item = next(pending_bands, None)
+        if item is not None:
+            band_index, band = item
+            band_prefix = building_dir / f'band_{band_index:05d}_'
+            futures.append((band_prefix, pool.submit(_build_library_band, heavy_dir, heavy_count, elements_order, atomic_weights, element_categories, *band, band_prefix)))
+
+    for _ in range(max_in_flight):
+        submit_next()
+
+    count = 0
+    with open(building_dir / _COUNTS_FILENAME, 'wb') as counts_file, \
+            open(building_dir / _MASS_FILENAME, 'wb') as mass_file, \
+            open(building_dir / _DBR_FILENAME, 'wb') as dbr_file:
+        # 按质量段顺序追加，文件整体即按质量有序
+        while futures:
+            band_prefix, future = futures.popleft()
+            band_count, _ = future.result()
+            submit_next()
+            _append_file(counts_file, f'{band_prefix}{_COUNTS_FILENAME}')
+            _append_file(mass_file, f'{band_prefix}{_MASS_FILENAME}')
+            _append_file(dbr_file, f'{band_prefix}{_DBR_FILENAME}')
+            count += band_count
+    shutil.rmtree(heavy_dir)
+
+    meta = {
+        'key': key,
+        'elements': elements,
+        'weights': [weights[elem] for elem in elements],
+        'caps': [_cap_to_json(caps[elem]) for elem in elements],
+        'element_categories': {k: sorted(v) for k, v in element_categories.items()},
+        'mw_limit': mw_limit,
+        'count': count,
+    }
+    with open(building_dir / _META_FILENAME, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=4)
+    building_dir.rename(library_dir)
+    logging.info(f'分子式库构建完成: {library_dir}，共 {count} 条分子式')
+    return open_formula_library(library_dir)
+
+
+def open_formula_library(library_dir: Path) -> FormulaLibrary:
+    library_dir = Path(library_dir)
+    if library_dir not in _OPENED_LIBRARIES:
+        _OPENED_LIBRARIES[library_dir] = FormulaLibrary(library_dir)
+    return _OPENED_LIBRARIES[library_dir]
+
+
+def find_formula_library(elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], mw_max: float, library_root: Optional[Path] = None) -> Optional[FormulaLibrary]:
+    """在缓存目录中查找能覆盖该查询（元素、上限与质量范围）的库；有多个时取条目最少者"""
+    library_root = Path(library_root) if library_root is not None else PathManager().get_formula_library_path()
+    candidates = []
+    for meta_path in library_root.glob(f'{_LIBRARY_DIR_PREFIX}*/{_META_FILENAME}'):
+        if meta_path.parent.suffix == '.building':
+            continue
+        try:
+            library = open_formula_library(meta_path.parent)
+        except (OSError, ValueError, KeyError) as ex:
+            logging.warning(f'分子式库读取失败，已忽略: {meta_path.parent}，{ex}')
+            continue
+        if library.covers(elements_order, atomic_weights, element_categories, mw_max):
+            candidates.append(library)
+    return min(candidates, key=len) if candidates else None
@@ -0,0 +1,365 @@
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# 结果表中的元素列（顺序即分子式字符串中的书写顺序）
+ELEMENT_COLUMNS = ("C", "H", "N", "O", "S", "P", "Si", "F", "Cl", "Br", "I", "B", "Se")
+# 按 4 位小数显示的列；NaN 表示该行没有值（显示为空）
+DECIMAL_COLUMNS = ("M/Z", "Mol Weight", "Iso Score")
+TEXT_COLUMNS = ("Adduct",)
+# 计算列宽时每列只格式化并测量最长的若干个不同显示字符串
+WIDEST_STRING_SAMPLES = 5
+
+
+class FormulaResultTable:
+    """分子式生成结果的列式内存模型：每列一个 numpy 数组，Adduct 列以整数编码存储。
+
+    显示字符串只在渲染可见行时格式化；数值筛选直接在数组上求布尔掩码，
+    4 位小数列按显示精度比较，与界面上看到的数值一致。
+    行下标在模型生命周期内保持不变：删除只在 deleted 掩码上做标记，不移动其余行。
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray], adducts: Sequence[str], deleted: Optional[np.ndarray] = None):
+        self.columns = columns
+        self.adducts = list(adducts)
+        self.deleted = deleted if deleted is not None else np.zeros(len(columns['Adduct']), dtype=bool)
+        self.deleted_count = int(self.deleted.sum())
+        self._rounded: Dict[str, np.ndarray] = {}
+        # 列统计缓存：{列名: (是否存在非 0 / 非空值, 最长的若干显示字符串)}，删除行后失效
+        self._column_stats: Dict[str, tuple] = {}
+        # 排序行序缓存：{(列名, 是否降序): 全表行序}；删除只打标记，不影响行序，故无需失效
+        self._sort_permutations: Dict[tuple, np.ndarray] = {}
+
+    @classmethod
+    def empty(cls) -> 'FormulaResultTable':
+        return cls.from_columns({
+            'elements': [],
+            'adducts': [],
+            'adduct_index': np.zeros(0, dtype=np.int32),
+            'counts': np.zeros((0, 0), dtype=np.int16),
+            'mass': np.zeros(0),
+            'mz': np.zeros(0),
+            'dbr': np.zeros(0),
+        })
+
+    @classmethod
+    def from_columns(cls, table: Dict[str, Any]) -> 'FormulaResultTable':
+        """由列式导出结果（ColumnarExporter_formulaGeneration / read_formula_generation_columns）构建，不逐行解析"""
+        row_count = len(table['adduct_index'])
+        element_index = {elem: index for index, elem in enumerate(table['elements'])}
+        columns = {
+            'Adduct': np.asarray(table['adduct_index'], dtype=np.int32),
+            'M/Z': np.asarray(table['mz'], dtype=np.float64),
+            'Mol Weight': np.asarray(table['mass'], dtype=np.float64),
+            'DBR': np.asarray(table['dbr'], dtype=np.float64),
+            'Iso Score': np.asarray(table['isotope_score'], dtype=np.float64) if 'isotope_score' in table else np.full(row_count, np.nan),
+        }
+        for elem in ELEMENT_COLUMNS:
+            index = element_index.get(elem)
+            columns[elem] = table['counts'][:, index].astype(np.int32) if index is not None else np.zeros(row_count, dtype=np.int32)
+        return cls(columns, table['adducts'])
+
+    @classmethod
+    def from_records(cls, records: Sequence[dict]) -> 'FormulaResultTable':
+        """由 JSON 结果记录（{formula, adduct_type, calculated_properties}）构建"""
+        adducts: Dict[str, int] = {}
+        adduct_codes = []
+        element_lists = {elem: [] for elem in ELEMENT_COLUMNS}
+        mz, mass, dbr, score = [], [], [], []
+        for item in records:
+            formula_data = item.get("formula", item.get("elements", {})) or {}
+            calc = item.get("calculated_properties", {})
+            adduct_codes.append(adducts.setdefault(item["adduct_type"], len(adducts)))
+            mz.append(_to_float(calc.get("predicted_mz")))
+            mass.append(_to_float(calc.get("molecular_weight")))
+            dbr.append(_to_float(calc.get("dbr")))
+            score.append(_to_float(calc.get("isotope_score")))
+            for elem, values in element_lists.items():
+                values.append(_to_count(formula_data.get(elem, 0)))
+        columns = {
+            'Adduct': np.array(adduct_codes, dtype=np.int32),
+            'M/Z': np.array(mz, dtype=np.float64),
+            'Mol Weight': np.array(mass, dtype=np.float64),
+            'DBR': np.array(dbr, dtype=np.float64),
+            'Iso Score': np.array(score, dtype=np.float64),
+        }
+        for elem, values in element_lists.items():
+            columns[elem] = np.array(values, dtype=np.int32)
+        return cls(columns, list(adducts))
+
+    def __len__(self) -> int:
+        return len(self.columns['Adduct'])
+
+    def live_count(self) -> int:
+        return len(self) - self.deleted_count
+
+    def take(self, index) -> 'FormulaResultTable':
+        return FormulaResultTable({name: values[index] for name, values in self.columns.items()}, self.adducts, self.deleted[index])
+
+    def delete_rows(self, indices: Sequence[int]) -> int:
+        """把给定行标记为已删除，返回新删除的行数；其余行的下标不变"""
+        indices = np.asarray(indices, dtype=np.int64)
+        newly_deleted = int(np.count_nonzero(~self.deleted[indices])) if len(indices) else 0
+        self.deleted[indices] = True
+        self.deleted_count += newly_deleted
+        if newly_deleted:
+            self._column_stats.clear()
+        return newly_deleted
+
+    def _live(self, values: np.ndarray) -> np.ndarray:
+        return values[~self.deleted] if self.deleted_count else values
+
+    def present_adducts(self) -> List[str]:
+        # 结果中实际出现的加合物，按编码顺序
+        codes = np.unique(self._live(self.columns['Adduct']))
+        return [self.adducts[code] for code in codes.tolist()]
+
+    def has_values(self, column: str) -> bool:
+        """该列是否存在非 0 / 非空的值（用于自动隐藏空列）"""
+        return self.column_stats(column)[0]
+
+    def widest_strings(self, column: str) -> List[str]:
+        """该列最长的若干个不同显示字符串（用于计算列宽），不逐行格式化"""
+        return self.column_stats(column)[1]
+
+    def sort_rows(self, rows: np.ndarray, column: str, descending: bool = False) -> np.ndarray:
+        """按列排序给定的行（如筛选结果），只按缓存的全表行序取子集，不重新排序"""
+        permutation = self.sort_permutation(column, descending)
+        selected = np.zeros(len(self), dtype=bool)
+        selected[rows] = True
+        return permutation[selected[permutation]]
+
+    def sort_permutation(self, column: str, descending: bool = False) -> np.ndarray:
+        """按列显示值稳定排序后的全表行序，空值始终排在最后"""
+        key = (column, descending)
+        permutation = self._sort_permutations.get(key)
+        if permutation is None:
+            permutation = np.argsort(self._sort_keys(column, descending), kind='stable')
+            self._sort_permutations[key] = permutation
+        return permutation
+
+    def _sort_keys(self, column: str, descending: bool) -> np.ndarray:
+        if column == 'Adduct':
+            # 加合物按名称排序：编码先映射为名称的字典序名次
+            rank = np.empty(len(self.adducts), dtype=np.int64)
+            rank[sorted(range(len(self.adducts)), key=self.adducts.__getitem__)] = np.arange(len(self.adducts))
+            keys = rank[self.columns['Adduct']] if len(self.adducts) else np.zeros(len(self), dtype=np.int64)
+        elif column in DECIMAL_COLUMNS:
+            # 与显示的 4 位小数一致，显示相同的值保持原有顺序
+            keys = self._display_values(column)
+        else:
+            keys = self.columns[column].astype(np.float64)
+        # 取负实现降序；NaN 取负仍为 NaN，argsort 中始终排在最后
+        return -keys if descending else keys
+
+    def compute_column_stats(self) -> None:
+        # 可在加载结果的后台线程中预先调用，界面线程上的列布局只读取缓存
+        for column in self.columns:
+            self.column_stats(column)
+
+    def column_stats(self, column: str) -> tuple:
+        stats = self._column_stats.get(column)
+        if stats is None:
+            stats = self._build_column_stats(column)
+            self._column_stats[column] = stats
+        return stats
+
+    def _build_column_stats(self, column: str) -> tuple:
+        values = self.columns.get(column)
+        if values is None:
+            return False, []
+        live_rows = np.flatnonzero(~self.deleted) if self.deleted_count else None
+        values = values[live_rows] if live_rows is not None else values
+        if not len(values):
+            return False, []
+        if column in TEXT_COLUMNS:
+            return True, [self.adducts[code] for code in np.unique(values).tolist()]
+
+        if values.dtype.kind == 'f':
+            has_values = bool(np.any((values != 0) & ~np.isnan(values)))
+        else:
+            has_values = bool(np.any(values != 0))
+
+        # 先按数值估算显示长度，只格式化估算最长（及次长，兼顾进位）的少量候选
+        lengths = self._estimated_text_lengths(column, values)
+        longest = int(lengths.max())
+        candidates = []
+        for length in (longest, longest - 1):
+            candidates.extend(np.flatnonzero(lengths == length)[:WIDEST_STRING_SAMPLES * 4].tolist())
+        rows = live_rows[candidates] if live_rows is not None else candidates
+        texts = {str(self.format_value(column, row)) for row in rows}
+        widest = sorted(texts, key=lambda text: (-len(text), text))[:WIDEST_STRING_SAMPLES]
+        return has_values, widest
+
+    @staticmethod
+    def _estimated_text_lengths(column: str, values: np.ndarray) -> np.ndarray:
+        if values.dtype.kind == 'f':
+            finite = np.isfinite(values)
+            magnitude = np.where(finite, np.abs(values), 0.0)
+            # 4 位小数列为 "整数位.xxxx"，DBR 为 "整数位.x"
+            decimals = 5 if column in DECIMAL_COLUMNS else 2
+        else:
+            finite = np.ones(len(values), dtype=bool)
+            magnitude = np.abs(values.astype(np.int64))
+            decimals = 0
+        integer_digits = np.floor(np.log10(np.maximum(magnitude, 1))) + 1
+        return np.where(finite, integer_digits + decimals + (values < 0), 0).astype(np.int64)
+
+    def _display_values(self, column: str) -> np.ndarray:
+        # 4 位小数列按显示精度取整后缓存，筛选比较的是界面上显示的数值
+        if column not in DECIMAL_COLUMNS:
+            return self.columns[column]
+        rounded = self._rounded.get(column)
+        if rounded is None:
+            rounded = _round_for_display(self.columns[column])
+            self._rounded[column] = rounded
+        return rounded
+
+    def format_value(self, column: str, index: int):
+        value = self.columns[column][index]
+        if column == 'Adduct':
+            return self.adducts[value]
+        if column in DECIMAL_COLUMNS:
+            return "" if value != value else f"{value:.4f}"
+        if column == 'DBR':
+            return "" if value != value else float(value)
+        return int(value)
+
+    def format_rows(self, indices: Sequence[int], column_names: Sequence[str]) -> List[tuple]:
+        """只为给定行格式化显示值，按 column_names 的顺序返回"""
+        return [tuple(self.format_value(column, index) for column in column_names) for index in indices]
+
+    def formula(self, index: int) -> str:
+        parts = []
+        for elem in ELEMENT_COLUMNS:
+            count = int(self.columns[elem][index])
+            if count > 0:
+                parts.append(elem if count == 1 else f"{elem}{count}")
+        return ''.join(parts)
+
+    def filter_mask(self, conditions: Sequence[dict]) -> np.ndarray:
+        """把 _collect_filter_conditions 的条件列表求成布尔掩码（各条件之间为 AND）"""
+        return self.compile_filter(conditions).evaluate()
+
+    def compile_filter(self, conditions: Sequence[dict]) -> 'CompiledFilter':
+        return CompiledFilter(self, conditions)
+
+
+class CompiledFilter:
+    """条件列表编译后的筛选：同一列上的数值条件合并为一个区间，文本条件合并为编码查找表。
+
+    求值时每列只比较一到两次，结果写入预分配的掩码缓冲区；区间为空时不再扫描数组。
+    """
+
+    def __init__(self, table: FormulaResultTable, conditions: Sequence[dict]):
+        self.table = table
+        self.unsatisfiable = False
+        # {列名: [下限, 含下限, 上限, 含上限]}
+        self.ranges: Dict[str, list] = {}
+        # {列名: 编码 -> 是否命中}
+        self.lookups: Dict[str, np.ndarray] = {}
+        for condition in conditions:
+            self._add(condition)
+
+    def _add(self, condition: dict) -> None:
+        field_name = condition["field"]
+        if field_name not in self.table.columns:
+            self.unsatisfiable = True
+            return
+
+        if condition["type"] == "text":
+            target_text = str(condition["value"]).strip().lower()
+            names = [str(name).strip().lower() for name in self.table.adducts]
+            if condition["operator"] == "等于":
+                lookup = np.array([name == target_text for name in names], dtype=bool)
+            else:
+                lookup = np.array([target_text in name for name in names], dtype=bool)
+            previous = self.lookups.get(field_name)
+            self.lookups[field_name] = lookup if previous is None else previous & lookup
+            return
+
+        operator = condition["operator"]
+        target = float(condition["value"])
+        bounds = {
+            ">": (target, False, None, True),
+            ">=": (target, True, None, True),
+            "=": (target, True, target, True),
+            "<=": (None, True, target, True),
+            "<": (None, True, target, False),
+            "区间": (target, True, float(condition["second_value"]) if condition.get("second_value") is not None else None, True),
+        }.get(operator)
+        if bounds is None:
+            return
+        low, low_inclusive, high, high_inclusive = bounds
+        current = self.ranges.setdefault(field_name, [None, True, None, True])
+        # 区间求交：取更大的下限、更小的上限，相等时开区间优先
+        if low is not None and (current[0] is None or low > current[0] or (low == current[0] and not low_inclusive)):
+            current[0], current[1] = low, low_inclusive
+        if high is not None and (current[2] is None or high < current[2] or (high == current[2] and not high_inclusive)):
+            current[2], current[3] = high, high_inclusive
+        low, low_inclusive, high, high_inclusive = current
+        if low is not None and high is not None and (low > high or (low == high and not (low_inclusive and high_inclusive))):
+            self.unsatisfiable = True
+
+    def evaluate(self, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """返回 [start, stop) 行范围内的匹配掩码，默认整表"""
+        stop = len(self.table) if stop is None else min(stop, len(self.table))
+        row_count = max(stop - start, 0)
+        if self.unsatisfiable or self.table.deleted_count == len(self.table):
+            return np.zeros(row_count, dtype=bool)
+        rows = slice(start, stop)
+        mask = ~self.table.deleted[rows] if self.table.deleted_count else np.ones(row_count, dtype=bool)
+        buffer = np.empty(row_count, dtype=bool)
+        for field_name, lookup in self.lookups.items():
+            mask &= lookup[self.table.columns[field_name][rows]] if len(lookup) else False
+        for field_name, (low, low_inclusive, high, high_inclusive) in self.ranges.items():
+            values = self.table._display_values(field_name)[rows]
+            # NaN（空值）与任何数值比较均为 False，与空字符串无法参与数值比较的行为一致
+            with np.errstate(invalid='ignore'):
+                if low is not None and low == high:
+                    np.equal(values, low, out=buffer)
+                    mask &= buffer
+                    continue
+                if low is not None:
+                    (np.greater_equal if low_inclusive else np.greater)(values, low, out=buffer)
+                    mask &= buffer
+                if high is not None:
+                    (np.less_equal if high_inclusive else np.less)(values, high, out=buffer)
+                    mask &= buffer
+        return mask
+
+    def iter_matches(self, block_rows: int) -> Iterator[Tuple[int, np.ndarray]]:
+        """按 block_rows 行分块求值，逐块产出 (已扫描行数, 本块命中的模型行下标)"""
+        row_count = len(self.table)
+        for start in range(0, row_count, block_rows):
+            stop = min(start + block_rows, row_count)
+            yield stop, np.flatnonzero(self.evaluate(start, stop)) + start
+
+
+def _round_for_display(values: np.ndarray) -> np.ndarray:
+    # np.round 先乘 1e4 再取整，在 .5 附近可能与 f"{value:.4f}" 的结果相差一位；
+    # 只对这些接近 .5 的值改用字符串格式化的结果，其余保持向量化
+    rounded = np.round(values, 4)
+    with np.errstate(invalid='ignore'):
+        scaled = values * 1e4
+        near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for index in np.flatnonzero(near_tie).tolist():
+        rounded[index] = float(f"{values[index]:.4f}")
+    return rounded
+
+
+def _to_float(value: Optional[Any]) -> float:
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return float('nan')
+
+
+def _to_count(value: Any) -> int:
+    if value in ("", None):
+        return 0
+    try:
+        return int(float(value))
+    except (ValueError, TypeError):
+        return 0
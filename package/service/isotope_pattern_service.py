@@ -0,0 +1,131 @@
+import math
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from ..service.vectorized_generation_service import FormulaColumns
+
+
+# 聚合峰型保留的名义质量偏移范围（相对单同位素峰 M）；B、Se 等含更轻同位素的元素会产生 M-1、M-2 峰
+_PATTERN_MIN_OFFSET = -4
+_PATTERN_MAX_OFFSET = 4
+# 卷积过程中相对丰度低于该值的项直接舍弃（剪枝），不影响 M+1 / M+2 的有效位数
+_PRUNE_ABUNDANCE = 1e-9
+# 打分时观测强度的相对误差与绝对误差（单位：相对 M 峰的百分比）
+_SCORE_RELATIVE_TOLERANCE = 0.2
+_SCORE_ABSOLUTE_TOLERANCE = 1.0
+
+
+class IsotopePatternCalculator:
+    """按元素同位素丰度计算候选分子式的聚合同位素峰型（名义质量分箱），并与观测的 M+1 / M+2 强度打分。
+
+    每个元素的 n 原子峰型（单原子丰度多项式的 n 次幂，按偏移范围截断并剪枝）预先计算成查找表；
+    候选矩阵按元素逐列查表后做截断多项式卷积，整个计算对候选数完全向量化。
+    """
+
+    def __init__(self, isotopes: Dict[str, List[List[float]]], atomic_weights: Dict[str, float], min_offset: int = _PATTERN_MIN_OFFSET, max_offset: int = _PATTERN_MAX_OFFSET):
+        self.min_offset = min_offset
+        self.max_offset = max_offset
+        self.bins = max_offset - min_offset + 1
+        self._atom_patterns: Dict[str, np.ndarray] = {}
+        for elem, entries in isotopes.items():
+            if elem not in atomic_weights:
+                continue
+            pattern = np.zeros(self.bins, dtype=np.float64)
+            for mass, abundance in entries:
+                # 以 atomic_weights 中的同位素为 M，其余同位素按名义质量差落入对应偏移
+                offset = int(round(mass - atomic_weights[elem]))
+                if min_offset <= offset <= max_offset:
+                    pattern[offset - min_offset] += abundance
+            self._atom_patterns[elem] = pattern / pattern[-min_offset]
+        self._tables: Dict[str, np.ndarray] = {}
+
+    def _is_monoisotopic(self, elem: str) -> bool:
+        pattern = self._atom_patterns.get(elem)
+        return pattern is None or np.count_nonzero(pattern) == 1
+
+    def _convolve(self, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+        # 截断多项式乘法：left、right 的列均对应偏移 min_offset..max_offset，超出范围的项舍弃
+        out = np.zeros(np.broadcast_shapes(left.shape, right.shape), dtype=np.float64)
+        for index in range(self.bins):
+            shift = index + self.min_offset
+            if shift >= 0:
+                out[..., shift:] += left[..., index:index + 1] * right[..., :self.bins - shift]
+            else:
+                out[..., :self.bins + shift] += left[..., index:index + 1] * right[..., -shift:]
+        return out
+
+    def _element_table(self, elem: str, max_count: int) -> np.ndarray:
+        # table[n] 为 n 个该元素原子的峰型，按需向更大的 n 扩展
+        table = self._tables.get(elem)
+        if table is None:
+            table = np.zeros((1, self.bins), dtype=np.float64)
+            table[0, -self.min_offset] = 1.0
+        if len(table) <= max_count:
+            rows = [table[-1]]
+            for _ in range(len(table), max_count + 1):
+                row = self._convolve(rows[-1], self._atom_patterns[elem])
+                row[row < _PRUNE_ABUNDANCE] = 0.0
+                rows.append(row)
+            table = np.vstack([table, np.array(rows[1:])])
+            self._tables[elem] = table
+        return table
+
+    def patterns(self, columns: FormulaColumns) -> np.ndarray:
+        """返回 (候选数, 偏移数) 的相对强度矩阵，M 峰（偏移 0）归一为 100"""
+        result = np.zeros((len(columns), self.bins), dtype=np.float64)
+        result[:, -self.min_offset] = 1.0
+        for col, elem in enumerate(columns.elements):
+            if self._is_monoisotopic(elem):
+                continue
+            counts = columns.counts[:, col].astype(np.int64)
+            if not len(counts) or not counts.any():
+                continue
+            table = self._element_table(elem, int(counts.max()))
+            result = self._convolve(result, table[counts])
+        # 含较轻同位素时 M 峰也会收到组合贡献（如 10B + 13C），按实测习惯以合并后的 M 峰为基准归一
+        return result / result[:, -self.min_offset:1 - self.min_offset] * 100.0
+
+    def offset_intensity(self, patterns: np.ndarray, offset: int) -> np.ndarray:
+        return patterns[:, offset - self.min_offset]
+
+    def score(self, patterns: np.ndarray, observed: Dict[int, float], relative_tolerance: float = _SCORE_RELATIVE_TOLERANCE, absolute_tolerance: float = _SCORE_ABSOLUTE_TOLERANCE) -> np.ndarray:
+        """observed 为 {偏移: 相对 M 峰的强度百分比}；返回 (0, 1] 的高斯相似度，观测与理论越接近越高"""
+        log_score = np.zeros(patterns.shape[0], dtype=np.float64)
+        for offset, intensity in observed.items():
+            sigma = max(intensity * relative_tolerance, absolute_tolerance)
+            log_score -= 0.5 * ((self.offset_intensity(patterns, offset) - intensity) / sigma) ** 2
+        return np.exp(log_score)
+
+
+def observed_isotope_intensities(m1_pct: Optional[float], m2_pct: Optional[float]) -> Dict[int, float]:
+    # 只有大于 0 的观测强度参与打分；都未提供时返回空字典，表示不做同位素打分
+    observed = {}
+    for offset, value in ((1, m1_pct), (2, m2_pct)):
+        if value is None:
+            continue
+        value = float(value)
+        if not math.isnan(value) and value > 0:
+            observed[offset] = value
+    return observed
+
+
+def rank_isotope_candidates(calculator: IsotopePatternCalculator, parts: Sequence[FormulaColumns], observed: Dict[int, float], limit: int) -> List[tuple]:
+    """对多组候选（如各加合物）统一打分，返回得分最高的 limit 条：[(组下标, 行下标, 得分, M+1, M+2)]，按得分降序"""
+    sizes = [len(part) for part in parts]
+    if not sum(sizes):
+        return []
+    elements = parts[0].elements
+    merged = FormulaColumns.concat(list(parts), elements)
+    patterns = calculator.patterns(merged)
+    scores = calculator.score(patterns, observed)
+    # 稳定排序：同分时保持原有的加合物与深度优先顺序
+    order = np.argsort(-scores, kind='stable')[:max(limit, 0)]
+    starts = np.cumsum([0] + sizes[:-1])
+    part_index = np.searchsorted(starts, order, side='right') - 1
+    m1 = calculator.offset_intensity(patterns, 1)
+    m2 = calculator.offset_intensity(patterns, 2)
+    return [
+        (int(part), int(row - starts[part]), float(scores[row]), float(m1[row]), float(m2[row]))
+        for part, row in zip(part_index.tolist(), order.tolist())
+    ]
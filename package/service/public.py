@@ -2,132 +2,460 @@ import os
 import logging
 import datetime
 import csv
+import gzip
 import json
+import struct
+import zipfile
+from operator import itemgetter
 from pathlib import Path
+
+import numpy as np
+
 from ..config.base_config import BaseConfig
 from ..config.path_config import PathManager
 
+# 列式导出中仅在做过同位素打分时存在的列
+_OPTIONAL_SCORE_COLUMNS = ('isotope_score', 'predicted_m1', 'predicted_m2')
+
 # ----------------------------   导出器工厂   ----------------------------
+# CSV 导出的元素列顺序（与表头一致）
+_CSV_ELEMENTS = ('C', 'H', 'O', 'N', 'S', 'P', 'Si', 'B', 'Se', 'F', 'Cl', 'Br', 'I')
+# 元素列之后的数值列：(表头, calculated_properties 中的键, 格式)
+_CSV_VALUE_COLUMNS = (('dbr', 'dbr', '{:.1f}'), ('predicted_mz', 'predicted_mz', '{:.4f}'), ('molecular_weight', 'molecular_weight', '{:.4f}'))
+# 流式 CSV 导出每累积多少行调用一次 writerows
+_CSV_WRITE_BATCH_ROWS = 10000
+
 class CSVExporter_formulaGeneration:
+    def _build_csv_path(self, compress: bool = False) -> str:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        path_manager = PathManager()
+        path_manager.get_mass_finding_cache_path()
+        suffix = 'csv.gz' if compress else 'csv'
+        return os.path.join(path_manager.get_formula_generation_cache_path(), f'mass_data_{timestamp}.{suffix}')
+
+    @staticmethod
+    def _build_param_row(input_params: dict) -> list:
+        return [
+            f"ms_mode: {input_params['ms_mode']}",
+            f"adduct_model: {', '.join(input_params['adduct_model'])}",
+            f"m/z: {input_params['m2z']}",
+            *CSVExporter_formulaGeneration._tolerance_fields(input_params),
+            *CSVExporter_formulaGeneration._isotope_fields(input_params),
+            f"charge: {input_params['charge']}",
+            f"elements: {input_params['elements']}",
+            *CSVExporter_formulaGeneration._heuristic_fields(input_params),
+        ]
+
+    @staticmethod
+    def _heuristic_fields(input_params: dict) -> list:
+        # 启发式筛选会改变结果集，开关状态与规则阈值一并写入参数行
+        rules = input_params.get('heuristic_rules')
+        if not input_params.get('heuristic_filter') or not rules:
+            return ["heuristic_filter: off"]
+        return ["heuristic_filter: on", f"heuristic_rules: {rules}"]
+
+    @staticmethod
+    def _isotope_fields(input_params: dict) -> list:
+        # 同位素观测强度只在给定（非 0）时写出，未做同位素打分的导出与原格式一致
+        return [f"{key}: {input_params[key]}%" for key in ('isotope_m1', 'isotope_m2') if input_params.get(key)]
+
+    @staticmethod
+    def _tolerance_fields(input_params: dict) -> list:
+        # 只写出实际给定的容差（百分比 / Da / ppm 可任选其一或组合），都未给定时写 0%
+        fields = []
+        for key, template in (('error_pct', 'error: {}%'), ('error_da', 'error_da: {}Da'), ('error_ppm', 'error_ppm: {}ppm')):
+            value = input_params.get(key)
+            if value:
+                fields.append(template.format(value))
+        return fields or ['error: 0%']
+
+    @staticmethod
+    def _resolve_columns(sample_item: dict) -> tuple:
+        """按首行确定元素计数所在的键与数值列的 (表头, 取值键, 格式)，整次导出复用；首行带 isotope_score 时才输出同位素得分列"""
+        counts_key = 'formula' if 'formula' in sample_item else 'elements'
+        value_columns = _CSV_VALUE_COLUMNS
+        if 'isotope_score' in sample_item['calculated_properties']:
+            value_columns += (('isotope_score', 'isotope_score', '{:.4f}'),)
+        return counts_key, value_columns
+
+    def _write(self, csv_path: str, input_params: dict, batches) -> int:
+        # batches 逐批产出 (adduct, 结果字典列表)；adduct 为 None 时取每行自带的 adduct_type。
+        # 列的取值方式由首个非空批解析一次，攒够 _CSV_WRITE_BATCH_ROWS 行后一次 writerows
+        opener = gzip.open if csv_path.endswith('.gz') else open
+        row_count = 0
+        with opener(csv_path, 'wt', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(self._build_param_row(input_params))
+            counts_key, value_columns = None, _CSV_VALUE_COLUMNS
+            pending = []
+            for adduct, formulas in batches:
+                if not formulas:
+                    continue
+                if counts_key is None:
+                    counts_key, value_columns = self._resolve_columns(formulas[0])
+                    writer.writerow(list(_CSV_ELEMENTS) + ['ion'] + [header for header, _, _ in value_columns])
+                ion = itemgetter('adduct_type') if adduct is None else (lambda item: adduct)
+                # 结果字典不含计数为 0 的元素
+                pending.extend(
+                    [item[counts_key].get(elem, 0) for elem in _CSV_ELEMENTS]
+                    + [ion(item)]
+                    + [fmt.format(item['calculated_properties'][key]) for _, key, fmt in value_columns]
+                    for item in formulas
+                )
+                if len(pending) >= _CSV_WRITE_BATCH_ROWS:
+                    writer.writerows(pending)
+                    row_count += len(pending)
+                    pending = []
+            if counts_key is None:
+                writer.writerow(list(_CSV_ELEMENTS) + ['ion'] + [header for header, _, _ in value_columns])
+            writer.writerows(pending)
+            row_count += len(pending)
+        return row_count
+
     def export(self, results: dict):
         try:
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            path_manager = PathManager()
-            path_manager.get_mass_finding_cache_path()
-            csv_path = os.path.join(path_manager.get_formula_generation_cache_path(), f'mass_data_{timestamp}.csv')
-
-            def _extract_formula_payload(formula_item: dict):
-                element_counts = formula_item.get('formula', formula_item.get('elements', {}))
-                calc = formula_item.get('calculated_properties', {})
-                dbr = calc.get('dbr', formula_item.get('dbr', 0.0))
-                predicted_mz = calc.get('predicted_mz', formula_item.get('mz', 0.0))
-                molecular_weight = calc.get('molecular_weight', formula_item.get('predicted_mw', 0.0))
-                return element_counts, dbr, predicted_mz, molecular_weight
-
-            # 修改编码为 utf-8-sig 解决中文乱码
-            with open(csv_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                
-                # 参数信息部分保持不变
-                input_params = results["input_params"]
-                writer.writerow([
-                    f"ms_mode: {input_params['ms_mode']}",
-                    f"adduct_model: {', '.join(input_params['adduct_model'])}",
-                    f"m/z: {input_params['m2z']}",
-                    f"error: {input_params['error_pct']}%",
-                    f"error_da: {input_params.get('error_da', 0)}Da",
-                    f"charge: {input_params['charge']}",
-                    f"elements: {input_params['elements']}",
-                    
-                ])
-                
-                # 更新表头添加 molecular_weight
-                writer.writerow([
-                    'C', 'H', 'O', 'N', 'S', 'P', 'Si', 'B', 'Se',
-                    'F', 'Cl', 'Br', 'I', 'ion', 'dbr', 
-                    'predicted_mz', 'molecular_weight'  # 新增列
-                ])
-
-                # 更新数据行添加分子量
-                for adduct, formulas in results["formulas"].items():
-                    for formula in formulas:
-                        element_counts, dbr, predicted_mz, molecular_weight = _extract_formula_payload(formula)
-                        writer.writerow([
-                            element_counts.get('C', 0),
-                            element_counts.get('H', 0),
-                            element_counts.get('O', 0), 
-                            element_counts.get('N', 0),
-                            element_counts.get('S', 0),
-                            element_counts.get('P', 0),
-                            element_counts.get('Si', 0),
-                            element_counts.get('B', 0),
-                            element_counts.get('Se', 0),
-                            element_counts.get('F', 0),
-                            element_counts.get('Cl', 0),
-                            element_counts.get('Br', 0),
-                            element_counts.get('I', 0),
-                            adduct,
-                            f"{float(dbr):.1f}",
-                            f"{float(predicted_mz):.4f}",
-                            f"{float(molecular_weight):.4f}"  # 新增分子量数据
-                        ])
-
+            csv_path = self._build_csv_path()
+            self._write(csv_path, results["input_params"], results["formulas"].items())
             logging.info(f"CSV 文件已成功导出: {csv_path}")
         except Exception as e:
             logging.error(f"CSV 导出失败: {e}")
             raise
 
-class JSONExporter_formulaGeneration:
-    def export(self, results: dict):
+    def export_stream(self, input_params: dict, chunks, compress: bool = False) -> dict:
+        """逐块写出结果（compress 时写 .csv.gz），内存中只保留当前块；返回文件路径与结果数"""
         try:
-            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-            path_manager = PathManager()
-            path_manager.get_mass_finding_cache_path()
-            json_path = os.path.join(path_manager.get_formula_generation_cache_path(), f'mass_data_{timestamp}.json')
+            csv_path = self._build_csv_path(compress)
+            result_count = self._write(csv_path, input_params, ((None, chunk) for chunk in chunks))
+            logging.info(f"CSV 文件已流式导出: {csv_path}，共 {result_count} 条结果")
+            return {
+                "input_params": input_params,
+                "results_path": csv_path,
+                "result_count": result_count,
+            }
+        except Exception as e:
+            logging.error(f"CSV 导出失败: {e}", exc_info=True)
+            raise
 
-            def _extract_formula_payload(formula_item: dict):
-                element_counts = formula_item.get('formula', formula_item.get('elements', {}))
-                calc = formula_item.get('calculated_properties', {})
-                dbr = calc.get('dbr', formula_item.get('dbr', 0.0))
-                predicted_mz = calc.get('predicted_mz', formula_item.get('mz', 0.0))
-                molecular_weight = calc.get('molecular_weight', formula_item.get('predicted_mw', 0.0))
-                return element_counts, dbr, predicted_mz, molecular_weight
+class JSONExporter_formulaGeneration:
+    def _build_json_path(self) -> str:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        path_manager = PathManager()
+        path_manager.get_mass_finding_cache_path()
+        return os.path.join(path_manager.get_formula_generation_cache_path(), f'mass_data_{timestamp}.json')
+
+    def _build_metadata(self) -> dict:
+        return {
+            "export_time": datetime.datetime.now().isoformat(),
+            "software_version": BaseConfig.VERSION,
+        }
 
-            # 构建完整数据结构
-            data_to_save = {
-                "metadata": {
-                    "export_time": datetime.datetime.now().isoformat(),
-                    "software_version": BaseConfig.VERSION,
-                },
-                "input_params": results["input_params"],  # 使用完整输入参数
-                "results": []
+    def _build_record(self, adduct_type: str, formula_item: dict) -> dict:
+        element_counts = formula_item.get('formula', formula_item.get('elements', {}))
+        calc = formula_item.get('calculated_properties', {})
+        record = {
+            "formula": element_counts,
+            "adduct_type": adduct_type,
+            "calculated_properties": {
+                "dbr": calc.get('dbr', formula_item.get('dbr', 0.0)),
+                "predicted_mz": calc.get('predicted_mz', formula_item.get('mz', 0.0)),
+                "molecular_weight": calc.get('molecular_weight', formula_item.get('predicted_mw', 0.0))
             }
+        }
+        # 同位素峰型打分结果仅在提供了 M+1 / M+2 观测强度时存在
+        for key in ("isotope_score", "predicted_m1", "predicted_m2"):
+            if key in calc:
+                record["calculated_properties"][key] = calc[key]
+        return record
+
+    def build(self, results: dict) -> dict:
+        """在内存中组装导出文档（不写文件），write 写出的即为该文档"""
+        # 构建完整数据结构
+        data_to_save = {
+            "metadata": self._build_metadata(),
+            "input_params": results["input_params"],  # 使用完整输入参数
+            "results": []
+        }
 
-            # 重组结果数据
-            for adduct_type, formulas in results["formulas"].items():
-                for formula in formulas:
-                    element_counts, dbr, predicted_mz, molecular_weight = _extract_formula_payload(formula)
-                    data_to_save["results"].append({
-                        "formula": element_counts,
-                        "adduct_type": adduct_type,
-                        "calculated_properties": {
-                            "dbr": dbr,
-                            "predicted_mz": predicted_mz,
-                            "molecular_weight": molecular_weight
-                        }
-                    })
+        # 重组结果数据
+        for adduct_type, formulas in results["formulas"].items():
+            for formula in formulas:
+                data_to_save["results"].append(self._build_record(adduct_type, formula))
+        return data_to_save
 
+    def write(self, data_to_save: dict) -> str:
+        try:
+            json_path = self._build_json_path()
             with open(json_path, 'w', encoding='utf-8') as f:
                 json.dump(data_to_save, f, ensure_ascii=False, indent=4)
 
             logging.info(f"JSON 文件已成功导出: {json_path}")
+            return json_path
+
+        except Exception as e:
+            logging.error(f"JSON 导出失败: {e}", exc_info=True)
+            raise
+
+    def export(self, results: dict):
+        data_to_save = self.build(results)
+        self.write(data_to_save)
+        return data_to_save
+
+    def export_stream(self, input_params: dict, chunks) -> dict:
+        """逐块写出结果，文件内容与 export 一致；内存中只保留当前块，返回文件路径与结果数"""
+        try:
+            json_path = self._build_json_path()
+            header = {
+                "metadata": self._build_metadata(),
+                "input_params": input_params,
+            }
+            result_count = 0
+
+            with open(json_path, 'w', encoding='utf-8') as f:
+                # 按 json.dump(indent=4) 的排版手工拼接，保持与整体导出相同的文件格式
+                f.write(json.dumps(header, ensure_ascii=False, indent=4)[:-2])
+                f.write(',\n    "results": [')
+                for chunk in chunks:
+                    for formula in chunk:
+                        record = json.dumps(self._build_record(formula.get('adduct_type', ''), formula), ensure_ascii=False, indent=4)
+                        f.write(',\n' if result_count else '\n')
+                        f.write('\n'.join('        ' + line for line in record.splitlines()))
+                        result_count += 1
+                f.write('\n    ]\n}' if result_count else ']\n}')
+
+            logging.info(f"JSON 文件已流式导出: {json_path}，共 {result_count} 条结果")
+            return {
+                **header,
+                "results_path": json_path,
+                "result_count": result_count,
+            }
 
-            return data_to_save
-        
         except Exception as e:
             logging.error(f"JSON 导出失败: {e}", exc_info=True)
             raise
 
+class NPZExporter_formulaGenerationBatch:
+    def export(self, results: dict):
+        try:
+            timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+            path_manager = PathManager()
+            path_manager.get_mass_finding_cache_path()
+            npz_path = os.path.join(path_manager.get_formula_generation_cache_path(), f'batch_mass_data_{timestamp}.npz')
+
+            metadata = {
+                "export_time": datetime.datetime.now().isoformat(),
+                "software_version": BaseConfig.VERSION,
+            }
+            columns = results["columns"]
+            # 每行一个候选：peak_index 指向 peaks，adduct_index 指向 adducts
+            np.savez_compressed(
+                npz_path,
+                metadata=np.array(json.dumps(metadata, ensure_ascii=False)),
+                input_params=np.array(json.dumps(results["input_params"], ensure_ascii=False)),
+                peaks=np.asarray(results["peaks"], dtype=np.float64),
+                adducts=np.asarray(results["adducts"], dtype=str),
+                elements=np.asarray(columns.elements, dtype=str),
+                counts=columns.counts,
+                mass=columns.mass,
+                mz=columns.mz,
+                dbr=columns.dbr,
+                peak_index=results["peak_index"],
+                adduct_index=results["adduct_index"],
+            )
+
+            logging.info(f"批量结果已导出: {npz_path}")
+            return {
+                "metadata": metadata,
+                "input_params": results["input_params"],
+                "peaks": list(results["peaks"]),
+                "results_path": npz_path,
+                "result_count": len(columns),
+            }
+
+        except Exception as e:
+            logging.error(f"NPZ 导出失败: {e}", exc_info=True)
+            raise
+
+class ColumnarExporter_formulaGeneration:
+    """以列式二进制格式导出单次分析结果：每列一个数组，读回时无需逐条解析 JSON。
+
+    npz 为未压缩的 numpy 归档（np.load 直接读出各列）；parquet 依赖可选的 pyarrow。
+    """
+
+    def __init__(self, file_format: str = 'npz'):
+        self.file_format = file_format
+
+    def _build_path(self) -> str:
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        path_manager = PathManager()
+        path_manager.get_mass_finding_cache_path()
+        return os.path.join(path_manager.get_formula_generation_cache_path(), f'mass_data_{timestamp}.{self.file_format}')
+
+    @staticmethod
+    def _columns_from_formulas(formulas: dict) -> dict:
+        # 通用路径：由 {加合物: [结果字典]} 组装列；元素列按首次出现的顺序排列
+        elements = []
+        for rows in formulas.values():
+            for row in rows:
+                for elem in row.get('formula', row.get('elements', {})):
+                    if elem not in elements:
+                        elements.append(elem)
+        adducts = list(formulas)
+        records = [(index, row) for index, adduct in enumerate(adducts) for row in formulas[adduct]]
+        table = {
+            'elements': elements,
+            'adducts': adducts,
+            'adduct_index': np.array([index for index, _ in records], dtype=np.int32),
+            'counts': np.array([[row.get('formula', row.get('elements', {})).get(elem, 0) for elem in elements] for _, row in records], dtype=np.int16).reshape(len(records), len(elements)),
+        }
+        for name, key, default in (('mass', 'molecular_weight', 'predicted_mw'), ('mz', 'predicted_mz', 'mz'), ('dbr', 'dbr', 'dbr')):
+            table[name] = np.array([row.get('calculated_properties', {}).get(key, row.get(default, 0.0)) for _, row in records], dtype=np.float64)
+        # 同位素打分列仅在存在打分结果时写出
+        for key in _OPTIONAL_SCORE_COLUMNS:
+            if any(key in row.get('calculated_properties', {}) for _, row in records):
+                table[key] = np.array([row.get('calculated_properties', {}).get(key, np.nan) for _, row in records], dtype=np.float64)
+        return table
+
+    @staticmethod
+    def _columns_from_candidates(columns: dict) -> dict:
+        # 快速路径：直接拼接各加合物的 FormulaColumns，不经过逐行字典
+        adducts = list(columns)
+        elements = list(columns[adducts[0]].elements) if adducts else []
+        parts = [columns[adduct] for adduct in adducts]
+        return {
+            'elements': elements,
+            'adducts': adducts,
+            'adduct_index': np.repeat(np.arange(len(adducts), dtype=np.int32), [len(part) for part in parts]),
+            'counts': np.concatenate([part.counts for part in parts]) if parts else np.zeros((0, 0), dtype=np.int16),
+            'mass': np.concatenate([part.mass for part in parts]) if parts else np.zeros(0),
+            'mz': np.concatenate([part.mz for part in parts]) if parts else np.zeros(0),
+            'dbr': np.concatenate([part.dbr for part in parts]) if parts else np.zeros(0),
+        }
+
+    def _write_npz(self, path: str, metadata: dict, input_params: dict, table: dict) -> None:
+        arrays = {
+            'metadata': np.array(json.dumps(metadata, ensure_ascii=False)),
+            'input_params': np.array(json.dumps(input_params, ensure_ascii=False)),
+            'elements': np.asarray(table['elements'], dtype=str),
+            'adducts': np.asarray(table['adducts'], dtype=str),
+        }
+        arrays.update({key: value for key, value in table.items() if key not in ('elements', 'adducts')})
+        # 保持不压缩：read_formula_generation_columns 直接内存映射各成员
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    def _write_parquet(self, path: str, metadata: dict, input_params: dict, table: dict) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        data = {elem: table['counts'][:, index] for index, elem in enumerate(table['elements'])}
+        data['adduct_type'] = pa.DictionaryArray.from_arrays(table['adduct_index'], table['adducts'])
+        for key in ('mass', 'mz', 'dbr') + _OPTIONAL_SCORE_COLUMNS:
+            if key in table:
+                data[key] = table[key]
+        arrow_table = pa.table(data).replace_schema_metadata({
+            'metadata': json.dumps(metadata, ensure_ascii=False),
+            'input_params': json.dumps(input_params, ensure_ascii=False),
+            'elements': json.dumps(table['elements'], ensure_ascii=False),
+        })
+        pq.write_table(arrow_table, path)
+
+    def build(self, results: dict) -> dict:
+        """在内存中组装列式结果（不写文件），返回值的 columns 即 write 写出的各列"""
+        metadata = {
+            "export_time": datetime.datetime.now().isoformat(),
+            "software_version": BaseConfig.VERSION,
+        }
+        if "columns" in results:
+            table = self._columns_from_candidates(results["columns"])
+        else:
+            table = self._columns_from_formulas(results["formulas"])
+        return {
+            "metadata": metadata,
+            "input_params": results["input_params"],
+            "results_path": None,
+            "result_count": len(table['adduct_index']),
+            "columns": table,
+        }
+
+    def write(self, summary: dict) -> str:
+        try:
+            path = self._build_path()
+            if self.file_format == 'parquet':
+                self._write_parquet(path, summary["metadata"], summary["input_params"], summary["columns"])
+            else:
+                self._write_npz(path, summary["metadata"], summary["input_params"], summary["columns"])
+
+            logging.info(f"{self.file_format.upper()} 文件已成功导出: {path}")
+            return path
+
+        except Exception as e:
+            logging.error(f"{self.file_format.upper()} 导出失败: {e}", exc_info=True)
+            raise
+
+    def export(self, results: dict):
+        summary = self.build(results)
+        summary["results_path"] = self.write(summary)
+        return summary
+
+
+def _map_npz_members(file_path: Path) -> dict:
+    # np.savez 写出的成员不压缩（ZIP_STORED），数值列按成员数据在文件中的偏移只读 memmap，不复制到内存；
+    # 压缩成员、字符串与空数组仍按常规方式读入
+    arrays = {}
+    with zipfile.ZipFile(file_path) as archive, open(file_path, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')] if info.filename.endswith('.npy') else info.filename
+            if info.compress_type == zipfile.ZIP_STORED:
+                # 本地文件头固定 30 字节，其后为文件名与扩展字段，再之后才是 .npy 数据
+                f.seek(info.header_offset + 26)
+                name_length, extra_length = struct.unpack('<HH', f.read(4))
+                f.seek(info.header_offset + 30 + name_length + extra_length)
+                version = np.lib.format.read_magic(f)
+                read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+                shape, fortran_order, dtype = read_header(f)
+                if dtype.kind in 'biuf' and np.prod(shape, dtype=np.int64) > 0:
+                    arrays[name] = np.memmap(file_path, dtype=dtype, mode='r', shape=shape, offset=f.tell(), order='F' if fortran_order else 'C')
+                    continue
+            with archive.open(info) as member:
+                arrays[name] = np.lib.format.read_array(member, allow_pickle=False)
+    return arrays
+
+def read_formula_generation_columns(file_path) -> dict:
+    """读回 ColumnarExporter_formulaGeneration 写出的 npz / parquet 文件，返回与 export 相同结构的字典；
+    数值列以只读内存映射返回，不整体读入内存"""
+    file_path = Path(file_path)
+    if file_path.suffix.lower() == '.parquet':
+        import pyarrow.parquet as pq
+
+        arrow_table = pq.read_table(file_path, memory_map=True)
+        schema_metadata = {key.decode('utf-8'): value.decode('utf-8') for key, value in (arrow_table.schema.metadata or {}).items()}
+        elements = json.loads(schema_metadata['elements'])
+        adduct_column = arrow_table.column('adduct_type').combine_chunks()
+        table = {
+            'elements': elements,
+            'adducts': adduct_column.dictionary.to_pylist(),
+            'adduct_index': adduct_column.indices.to_numpy().astype(np.int32, copy=False),
+            'counts': np.column_stack([arrow_table.column(elem).to_numpy() for elem in elements]).astype(np.int16, copy=False) if elements else np.zeros((arrow_table.num_rows, 0), dtype=np.int16),
+        }
+        for key in ('mass', 'mz', 'dbr') + _OPTIONAL_SCORE_COLUMNS:
+            if key in arrow_table.column_names:
+                table[key] = arrow_table.column(key).to_numpy()
+        metadata = json.loads(schema_metadata['metadata'])
+        input_params = json.loads(schema_metadata['input_params'])
+    else:
+        table = _map_npz_members(file_path)
+        metadata = json.loads(table.pop('metadata').item())
+        input_params = json.loads(table.pop('input_params').item())
+        table['elements'] = table['elements'].tolist()
+        table['adducts'] = table['adducts'].tolist()
+    return {
+        "metadata": metadata,
+        "input_params": input_params,
+        "results_path": str(file_path),
+        "result_count": len(table['adduct_index']),
+        "columns": table,
+    }
+
 class JSONExporter_formulaSearch_PubChem:
     def _get_value(self, compound, attr, aliases=None, default=None):
         if isinstance(compound, dict):
@@ -229,6 +557,9 @@ class ExporterFactory:
         exporters = {
             'csv_formulaGeneration': CSVExporter_formulaGeneration(),
             'json_formulaGeneration': JSONExporter_formulaGeneration(),
+            'npz_formulaGeneration': ColumnarExporter_formulaGeneration('npz'),
+            'parquet_formulaGeneration': ColumnarExporter_formulaGeneration('parquet'),
+            'npz_formulaGenerationBatch': NPZExporter_formulaGenerationBatch(),
             'json_formulaSearch_PubChem': JSONExporter_formulaSearch_PubChem(),
 
         }
@@ -254,6 +585,27 @@ class ChemElementConfigValidator:
             if not isinstance(adduct_dict, dict) or not all(ion in ion_weights for ion in adduct_dict.values()):
                 raise ValueError(f"Invalid adducts format for mode {mode}")
 
+    @staticmethod
+    def validate_isotopes(isotopes):
+        # 每个元素为 [[同位素质量, 丰度], ...]
+        if not isinstance(isotopes, dict):
+            raise ValueError("Invalid isotopes format")
+        for elem, entries in isotopes.items():
+            if not isinstance(entries, list) or not entries or not all(
+                isinstance(entry, list) and len(entry) == 2 and all(isinstance(v, (int, float)) for v in entry)
+                for entry in entries
+            ):
+                raise ValueError(f"Invalid isotopes format for element {elem}")
+
+    @staticmethod
+    def validate_heuristic_rules(rules):
+        # element_ratios: {元素: [X/C 下限, X/C 上限]}，senior: 是否启用 SENIOR 规则
+        if not isinstance(rules, dict) or not isinstance(rules.get('element_ratios', {}), dict):
+            raise ValueError("Invalid heuristic_rules format")
+        for elem, bounds in rules.get('element_ratios', {}).items():
+            if not isinstance(bounds, list) or len(bounds) != 2 or not all(isinstance(v, (int, float)) for v in bounds) or bounds[0] > bounds[1]:
+                raise ValueError(f"Invalid heuristic_rules format for element {elem}")
+
 class ReadChemElementConfig:
     def __init__(self, config_path: Path):
         self.config = self.load_config(config_path)
@@ -269,6 +621,10 @@ class ReadChemElementConfig:
         ChemElementConfigValidator.validate_keys(self.config, {'atomic_weights', 'ion_weights', 'adducts', 'element_categories'})
         ChemElementConfigValidator.validate_atomic_weights(self.config['atomic_weights'])
         ChemElementConfigValidator.validate_adducts(self.config['adducts'], self.config['ion_weights'])
+        if 'isotopes' in self.config:
+            ChemElementConfigValidator.validate_isotopes(self.config['isotopes'])
+        if 'heuristic_rules' in self.config:
+            ChemElementConfigValidator.validate_heuristic_rules(self.config['heuristic_rules'])
 
 # 示例调用
 if __name__ == "__main__":
@@ -0,0 +1,319 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# 单块网格的最大单元数，控制 meshgrid 展开时的峰值内存
+_GRID_BLOCK_CELLS = 4_000_000
+# 计数矩阵为 int16，超出该值的原子数（如高电荷或超大质量窗口下的 H 数）不能静默回绕
+_COUNT_MAX = int(np.iinfo(np.int16).max)
+
+
+@dataclass
+class FormulaColumns:
+    """列式候选结果：int16 计数矩阵 + float64 质量/质荷比/不饱和度向量"""
+    elements: List[str]
+    counts: np.ndarray
+    mass: np.ndarray
+    mz: np.ndarray
+    dbr: np.ndarray
+
+    def __len__(self) -> int:
+        return int(self.mass.shape[0])
+
+    @classmethod
+    def empty(cls, elements: Sequence[str]) -> 'FormulaColumns':
+        return cls(
+            elements=list(elements),
+            counts=np.zeros((0, len(elements)), dtype=np.int16),
+            mass=np.zeros(0, dtype=np.float64),
+            mz=np.zeros(0, dtype=np.float64),
+            dbr=np.zeros(0, dtype=np.float64),
+        )
+
+    def take(self, index) -> 'FormulaColumns':
+        return FormulaColumns(
+            elements=list(self.elements),
+            counts=self.counts[index],
+            mass=self.mass[index],
+            mz=self.mz[index],
+            dbr=self.dbr[index],
+        )
+
+    def with_adduct(self, charge: int, ion_weight: float) -> 'FormulaColumns':
+        return FormulaColumns(
+            elements=list(self.elements),
+            counts=self.counts,
+            mass=self.mass,
+            mz=(self.mass + charge * ion_weight) / charge,
+            dbr=self.dbr,
+        )
+
+    @classmethod
+    def from_formulas(cls, formulas: Sequence[Dict[str, int]], mass: Sequence[float], dbr: Sequence[float], elements: Sequence[str]) -> 'FormulaColumns':
+        counts = _to_counts(np.array([[formula.get(elem, 0) for elem in elements] for formula in formulas], dtype=np.int64).reshape(len(formulas), len(elements)))
+        mass = np.asarray(mass, dtype=np.float64)
+        return cls(elements=list(elements), counts=counts, mass=mass, mz=mass, dbr=np.asarray(dbr, dtype=np.float64))
+
+    @classmethod
+    def concat(cls, parts: Sequence['FormulaColumns'], elements: Sequence[str]) -> 'FormulaColumns':
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return cls.empty(elements)
+        return cls(
+            elements=list(parts[0].elements),
+            counts=np.concatenate([part.counts for part in parts]),
+            mass=np.concatenate([part.mass for part in parts]),
+            mz=np.concatenate([part.mz for part in parts]),
+            dbr=np.concatenate([part.dbr for part in parts]),
+        )
+
+    def dfs_sorted(self) -> 'FormulaColumns':
+        # 还原深度优先顺序：重原子计数降序，H 计数升序
+        if len(self) == 0:
+            return self
+        sort_keys = [self.counts[:, -1]] + [-self.counts[:, col].astype(np.int64) for col in range(self.counts.shape[1] - 2, -1, -1)]
+        return self.take(np.lexsort(sort_keys))
+
+    def to_dicts(self, adduct: str) -> List[dict]:
+        # 仅在导出时转换为与 FormulaCandidate.to_dict 一致的字典结构
+        rows = []
+        elements = self.elements
+        for counts, dbr, mass, mz in zip(self.counts.tolist(), self.dbr.tolist(), self.mass.tolist(), self.mz.tolist()):
+            rows.append({
+                'formula': {elem: count for elem, count in zip(elements, counts) if count != 0},
+                'dbr': dbr,
+                'predicted_mw': mass,
+                'adduct_type': adduct,
+                'calculated_properties': {
+                    'dbr': dbr,
+                    'predicted_mz': mz,
+                    'molecular_weight': mass,
+                }
+            })
+        return rows
+
+
+def _category_vector(elements: Sequence[str], members: Sequence[str]) -> np.ndarray:
+    member_set = set(members)
+    return np.array([1 if elem in member_set else 0 for elem in elements], dtype=np.int64)
+
+
+def _to_counts(values: np.ndarray) -> np.ndarray:
+    if len(values) and int(values.max()) > _COUNT_MAX:
+        raise ValueError(f'原子数 {int(values.max())} 超出计数矩阵上限 {_COUNT_MAX}，请缩小质量范围或电荷数')
+    return values.astype(np.int16)
+
+
+def _expand_element(partial_counts: np.ndarray, partial_mass: np.ndarray, weight: float, max_count: int, mw_max: float, min_count: int = 0):
+    # 以 meshgrid 展开 (已有部分组合 × 当前元素计数)，并剔除超过 mw_max 的组合；计数以 int16 保存，降低大表的内存占用
+    grid = np.arange(min_count, max(min_count, max_count + 1), dtype=np.int64)
+    if len(grid) == 0:
+        return np.zeros((0, partial_counts.shape[1] + 1), dtype=np.int16), np.zeros(0, dtype=np.float64)
+    block = max(1, _GRID_BLOCK_CELLS // len(grid))
+    counts_parts = []
+    mass_parts = []
+    for start in range(0, len(partial_mass), block):
+        rows, counts = np.meshgrid(np.arange(start, min(start + block, len(partial_mass))), grid, indexing='ij')
+        mass = partial_mass[rows] + counts * weight
+        keep = mass <= mw_max
+        rows = rows[keep]
+        counts_parts.append(np.column_stack([partial_counts[rows], _to_counts(counts[keep])]))
+        mass_parts.append(mass[keep])
+    if not mass_parts:
+        return np.zeros((0, partial_counts.shape[1] + 1), dtype=np.int16), np.zeros(0, dtype=np.float64)
+    return np.concatenate(counts_parts), np.concatenate(mass_parts)
+
+
+def _split_elements(elements_order: List[tuple]) -> tuple:
+    h_max = next((count for elem, _, count in elements_order if elem == 'H'), float('inf'))
+    non_h_elements = [(elem, weight, max_count) for elem, weight, max_count in elements_order if elem != 'H']
+    elements = [elem for elem, _, _ in non_h_elements] + ['H']
+    return non_h_elements, h_max, elements
+
+
+def _enumerate_heavy_atoms(non_h_elements: List[tuple], mw_max: float, prefix_ranges: Sequence[Tuple[int, int]] = ()) -> tuple:
+    # 逐层展开全部重原子组合（质量不超过 mw_max），H 留待解析求解
+    partial_counts = np.zeros((1, 0), dtype=np.int16)
+    partial_mass = np.zeros(1, dtype=np.float64)
+    for index, (_, weight, max_count) in enumerate(non_h_elements):
+        if mw_max < 0 or len(partial_mass) == 0:
+            return np.zeros((0, len(non_h_elements)), dtype=np.int16), np.zeros(0, dtype=np.float64)
+        max_possible = int(mw_max / weight) if weight > 0 else 0
+        if max_count != float('inf'):
+            max_possible = min(max_possible, int(max_count))
+        min_count = 0
+        if index < len(prefix_ranges):
+            min_count, high = prefix_ranges[index]
+            max_possible = min(max_possible, high)
+        partial_counts, partial_mass = _expand_element(partial_counts, partial_mass, weight, max_possible, mw_max, min_count)
+    return partial_counts, partial_mass
+
+
+def _hydrogen_upper_bounds(partial_counts: np.ndarray, elements: List[str], h_max: float, element_categories: Dict[str, List[str]]) -> np.ndarray:
+    # 每个重原子组合在 DBR 非负及 H 上限约束下可取的最大 H 计数；为 -1 时该组合无论取多少 H 都不合法
+    # 2*DBR = 2*valency_4 + 2 + valency_3 - valency_1：先求重原子部分，再看每个 H 的贡献
+    heavy = elements[:-1]
+    deltas = 2 * _category_vector(elements, element_categories['valency_4']) + _category_vector(elements, element_categories['valency_3']) - _category_vector(elements, element_categories['valency_1'])
+    unsaturation = 2 + partial_counts.astype(np.int64) @ deltas[:len(heavy)]
+    h_delta = int(deltas[-1])
+    limit = int(h_max) if h_max != float('inf') else np.iinfo(np.int32).max
+    if h_delta < 0:
+        bounds = np.minimum(np.floor_divide(unsaturation, -h_delta), limit)
+        return np.where(unsaturation >= 0, bounds, -1)
+    bounds = np.full(len(unsaturation), limit, dtype=np.int64)
+    if h_delta == 0:
+        bounds[unsaturation < 0] = -1
+    return bounds
+
+
+def _attach_hydrogen(partial_counts: np.ndarray, partial_mass: np.ndarray, mw_min: float, mw_max: float, h_weight: float, h_max: float, elements: List[str], element_categories: Dict[str, List[str]], h_limit: Optional[np.ndarray] = None, dfs_order: bool = True) -> FormulaColumns:
+    """为每个重原子组合求解窗口内的 H 计数。
+
+    h_limit 为逐行的 H 上限（如 _hydrogen_upper_bounds 的结果），用于在展开前收紧区间；
+    dfs_order 为 False 时不还原深度优先顺序，由调用方自行排序。
+    """
+    if len(partial_mass) == 0:
+        return FormulaColumns.empty(elements)
+
+    # H 的可行区间：与 backtrack_search 叶子节点一致的求解方式
+    min_h = np.floor(np.maximum(0.0, (mw_min - partial_mass) / h_weight)).astype(np.int64)
+    min_h += (partial_mass + min_h * h_weight < mw_min)
+    max_h = np.floor((mw_max - partial_mass) / h_weight).astype(np.int64)
+    if h_max != float('inf'):
+        max_h = np.minimum(max_h, int(h_max))
+    if h_limit is not None:
+        max_h = np.minimum(max_h, h_limit)
+    span = np.maximum(max_h - min_h + 1, 0)
+
+    row_index = np.repeat(np.arange(len(partial_mass)), span)
+    offsets = np.arange(len(row_index)) - np.repeat(np.cumsum(span) - span, span)
+    h_counts = min_h[row_index] + offsets
+
+    counts = np.column_stack([partial_counts[row_index], h_counts])
+    mass = partial_mass[row_index] + h_counts * h_weight
+
+    valency_1 = counts @ _category_vector(elements, element_categories['valency_1'])
+    valency_3 = counts @ _category_vector(elements, element_categories['valency_3'])
+    valency_4 = counts @ _category_vector(elements, element_categories['valency_4'])
+    dbr = (2 * valency_4 + 2 + valency_3 - valency_1) / 2
+
+    valid = (dbr >= 0) & ((dbr * 2) % 2 == 0) & (mass >= mw_min) & (mass <= mw_max)
+    columns = FormulaColumns(
+        elements=elements,
+        counts=_to_counts(counts[valid]),
+        mass=mass[valid],
+        mz=mass[valid],
+        dbr=dbr[valid],
+    )
+    return columns.dfs_sorted() if dfs_order else columns
+
+
+def vectorized_search(target_mw: float, tolerance_mw: float, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], charge: int = 1, ion_weight: Optional[float] = None, prefix_ranges: Sequence[Tuple[int, int]] = ()) -> FormulaColumns:
+    """NumPy 向量化枚举：重原子按网格展开，H 解析求解；行顺序与 backtrack_search 一致"""
+    mw_min = target_mw - tolerance_mw
+    mw_max = target_mw + tolerance_mw
+    h_weight = atomic_weights.get('H', 1.0)
+    non_h_elements, h_max, elements = _split_elements(elements_order)
+
+    partial_counts, partial_mass = _enumerate_heavy_atoms(non_h_elements, mw_max, prefix_ranges)
+    columns = _attach_hydrogen(partial_counts, partial_mass, mw_min, mw_max, h_weight, h_max, elements, element_categories)
+    if ion_weight is not None:
+        columns = columns.with_adduct(charge, ion_weight)
+    return columns
+
+
+def vectorized_search_windows(windows: Sequence[Tuple[float, float]], elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], prefix_ranges: Sequence[Tuple[int, int]] = ()) -> List[FormulaColumns]:
+    """多个质量闭区间共享一次重原子展开（上限取各窗口上限的最大值），再分别求解 H；返回与 windows 对应的结果"""
+    h_weight = atomic_weights.get('H', 1.0)
+    non_h_elements, h_max, elements = _split_elements(elements_order)
+    partial_counts, partial_mass = _enumerate_heavy_atoms(non_h_elements, max(mw_max for _, mw_max in windows), prefix_ranges)
+    return [
+        _attach_hydrogen(partial_counts, partial_mass, mw_min, mw_max, h_weight, h_max, elements, element_categories)
+        for mw_min, mw_max in windows
+    ]
+
+
+def mass_sorted_heavy_atoms(elements_order: List[tuple], element_categories: Dict[str, List[str]], mw_max: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """展开质量不超过 mw_max 的全部重原子组合，按质量排序后返回 (int16 计数, 质量, 逐行 H 上限)。
+
+    逐行 H 上限同时考虑 DBR 非负与 H 的元素上限；无论取多少 H 都不合法的组合已被去掉。
+    """
+    non_h_elements, h_max, elements = _split_elements(elements_order)
+    heavy_counts, heavy_mass = _enumerate_heavy_atoms(non_h_elements, mw_max)
+    h_limit = _hydrogen_upper_bounds(heavy_counts, elements, h_max, element_categories)
+    keep = np.flatnonzero(h_limit >= 0)
+    order = keep[np.argsort(heavy_mass[keep], kind='stable')]
+    return heavy_counts[order], heavy_mass[order], np.minimum(h_limit[order], np.iinfo(np.int32).max).astype(np.int32)
+
+
+def attach_hydrogen_bounded(heavy_counts: np.ndarray, heavy_mass: np.ndarray, h_limit: np.ndarray, mw_min: float, mw_max: float, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]]) -> FormulaColumns:
+    """为 mass_sorted_heavy_atoms 给出的重原子行求解 [mw_min, mw_max] 内的全部分子式；结果不还原深度优先顺序"""
+    _, h_max, elements = _split_elements(elements_order)
+    return _attach_hydrogen(
+        np.asarray(heavy_counts), np.asarray(heavy_mass), mw_min, mw_max, atomic_weights.get('H', 1.0), h_max, elements, element_categories,
+        h_limit=np.asarray(h_limit, dtype=np.int64), dfs_order=False,
+    )
+
+
+# H 质量余数比较时的浮点余量；候选集合放宽后再由 _attach_hydrogen 精确过滤
+_RESIDUE_EPSILON = 1e-9
+
+
+class HeavyAtomTable:
+    """重原子组合表：按质量上限展开一次，供多个不超过该上限的质量窗口复用。
+
+    组合按 (重原子质量 / H 原子量) 的小数部分排序。窄窗口（宽度小于一个 H）内可行的组合，
+    其小数部分必然落在窗口对应的一段（可能跨 0 回绕的）区间内，用 searchsorted 即可定位。
+    """
+
+    def __init__(self, elements_order: List[tuple], atomic_weights: Dict[str, float], element_categories: Dict[str, List[str]], mw_max: float):
+        self.h_weight = atomic_weights.get('H', 1.0)
+        self.element_categories = element_categories
+        self.non_h_elements, self.h_max, self.elements = _split_elements(elements_order)
+        self.mw_max = mw_max
+        partial_counts, partial_mass = _enumerate_heavy_atoms(self.non_h_elements, mw_max)
+        # 逐行 H 上限（DBR 非负与 H 元素上限）；去掉无论取多少 H 都不合法的组合，查询时只展开可达窗口的 H 计数
+        h_limit = _hydrogen_upper_bounds(partial_counts, self.elements, self.h_max, element_categories)
+        keep = h_limit >= 0
+        self.partial_counts = partial_counts[keep]
+        self.partial_mass = partial_mass[keep]
+        self.h_limit = h_limit[keep]
+        self.max_reach = self.partial_mass + self.h_limit * self.h_weight
+
+        units = self.partial_mass / self.h_weight
+        residues = units - np.floor(units)
+        self.residue_order = np.argsort(residues, kind='stable')
+        self.sorted_residues = residues[self.residue_order]
+
+    def __len__(self) -> int:
+        return int(self.partial_mass.shape[0])
+
+    def _candidate_rows(self, mw_min: float, mw_max: float) -> np.ndarray:
+        low = mw_min / self.h_weight - _RESIDUE_EPSILON
+        high = mw_max / self.h_weight + _RESIDUE_EPSILON
+        if high - low >= 1.0:
+            rows = np.arange(len(self))
+        else:
+            low_residue = low - np.floor(low)
+            high_residue = high - np.floor(high)
+            start = np.searchsorted(self.sorted_residues, low_residue, side='left')
+            stop = np.searchsorted(self.sorted_residues, high_residue, side='right')
+            if low_residue <= high_residue:
+                rows = self.residue_order[start:stop]
+            else:
+                rows = np.concatenate([self.residue_order[start:], self.residue_order[:stop]])
+        return rows[(self.partial_mass[rows] <= mw_max) & (self.max_reach[rows] >= mw_min - _RESIDUE_EPSILON * self.h_weight)]
+
+    def search(self, target_mw: float, tolerance_mw: float, charge: int = 1, ion_weight: Optional[float] = None) -> FormulaColumns:
+        """结果与 vectorized_search 相同；窗口上限不得超过建表时的 mw_max"""
+        mw_min = target_mw - tolerance_mw
+        mw_max = target_mw + tolerance_mw
+        if mw_max > self.mw_max:
+            raise ValueError(f'质量窗口上限 {mw_max:.4f} 超出重原子组合表范围 {self.mw_max:.4f}')
+        rows = self._candidate_rows(mw_min, mw_max)
+        columns = _attach_hydrogen(self.partial_counts[rows], self.partial_mass[rows], mw_min, mw_max, self.h_weight, self.h_max, self.elements, self.element_categories, h_limit=self.h_limit[rows])
+        if ion_weight is not None:
+            columns = columns.with_adduct(charge, ion_weight)
+        return columns
@@ -23,7 +23,7 @@ class DataValidator:
             logging.error("参数 m2z 无效或不在50-3000之间")
             return False
 
-        # 验证误差范围参数（% 和 Da）
+        # 验证误差范围参数（%、Da 和可选的 ppm）
         if "error_pct" not in params or not isinstance(params["error_pct"], (int, float)):
             logging.error("参数 error_pct 无效")
             return False
@@ -32,10 +32,20 @@ class DataValidator:
             logging.error("参数 error_da 无效")
             return False
 
-        if params["error_pct"] <= 0 and params["error_da"] <= 0:
-            logging.error("参数 error_pct 与 error_da 不能同时小于等于0")
+        if "error_ppm" in params and not isinstance(params["error_ppm"], (int, float)):
+            logging.error("参数 error_ppm 无效")
             return False
 
+        if params["error_pct"] <= 0 and params["error_da"] <= 0 and params.get("error_ppm", 0) <= 0:
+            logging.error("参数 error_pct、error_da 与 error_ppm 不能同时小于等于0")
+            return False
+
+        # 验证可选的同位素观测强度（相对 M 峰的百分比）
+        for key in ("isotope_m1", "isotope_m2"):
+            if key in params and (not isinstance(params[key], (int, float)) or params[key] < 0):
+                logging.error(f"参数 {key} 无效")
+                return False
+
         # 验证 charge 是否为正整数
         if "charge" not in params or not isinstance(params["charge"], int) or params["charge"] <= 0:
             logging.error("参数 charge 无效")
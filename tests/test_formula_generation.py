@@ -0,0 +1,968 @@
+import csv
+import gzip
+import json
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from contextlib import contextmanager
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from package.config.base_config import BaseConfig
+from package.core.background_writer import BackgroundWriter
+from package.core.process_pool import ProcessPool
+from package.service.formula_generation_service import (
+    SEARCH_ENGINES,
+    FormulaCandidate,
+    FormulaGenerator,
+    SearchStats,
+    backtrack_search,
+    backtrack_search_windows,
+    build_configured_formula_library,
+    dp_search,
+    normalize_elements,
+    plan_search_shards,
+    save_analysis_result,
+    shutdown_worker_pool,
+    start_analysis,
+    start_batch_analysis,
+    warm_up_worker_pool,
+)
+from package.service.formula_cache_service import FormulaQueryCache, WindowEnumerationStore
+from package.service.formula_heuristics_service import HeuristicFilter
+from package.service.formula_library_service import _OPENED_LIBRARIES, FormulaLibrary, _build_library_band, _write_heavy_table, build_formula_library, find_formula_library
+from package.service.isotope_pattern_service import IsotopePatternCalculator, observed_isotope_intensities
+from package.service.public import ColumnarExporter_formulaGeneration, CSVExporter_formulaGeneration, JSONExporter_formulaGeneration, read_formula_generation_columns
+from package.service.vectorized_generation_service import FormulaColumns, HeavyAtomTable, vectorized_search, vectorized_search_windows
+
+
+CONFIG_PATH = Path(__file__).resolve().parents[1] / "package" / "config" / "chem_element_config.json"
+
+
+def _load_config():
+    with CONFIG_PATH.open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _as_dicts(candidates):
+    return [candidate.to_dict() for candidate in candidates]
+
+
+@contextmanager
+def _record_submits(arg_index):
+    """照常提交到进程池，同时记录每次提交的第 arg_index 个任务参数"""
+    submitted = []
+    original_submit = ProcessPool.submit
+
+    def submit(pool, fn, *args, **kwargs):
+        submitted.append(args[arg_index])
+        return original_submit(pool, fn, *args, **kwargs)
+
+    with patch.object(ProcessPool, "submit", autospec=True, side_effect=submit):
+        yield submitted
+
+
+class FormulaGenerationEngineTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = _load_config()
+        cls.atomic_weights = config["atomic_weights"]
+        cls.element_categories = config["element_categories"]
+
+    def _order(self, elements):
+        return normalize_elements(elements, self.atomic_weights)
+
+    def test_dp_search_matches_backtrack_search(self):
+        cases = [
+            (300.1, 0.05, {"C": -1, "N": -1, "O": -1}),
+            (450.2, 0.3, {"C": -1, "N": 4, "O": -1, "Cl": 2, "Br": 1}),
+            (150.0, 0.002, {"C": -1, "N": -1, "O": -1, "S": 2, "F": 3}),
+            (89.05, 0.01, {"C": 3, "N": 1, "O": 2, "H": 7}),
+        ]
+        for target_mw, tolerance, elements in cases:
+            with self.subTest(target_mw=target_mw):
+                order = self._order(elements)
+                expected = backtrack_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories)
+                actual = dp_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories)
+                self.assertTrue(expected)
+                self.assertEqual(_as_dicts(actual), _as_dicts(expected))
+
+    def test_vectorized_search_matches_backtrack_search(self):
+        cases = [
+            (300.1, 0.05, {"C": -1, "N": -1, "O": -1}),
+            (450.2, 0.3, {"C": -1, "N": 4, "O": -1, "Cl": 2, "Br": 1}),
+            (89.05, 0.01, {"C": 3, "N": 1, "O": 2, "H": 7}),
+        ]
+        for target_mw, tolerance, elements in cases:
+            with self.subTest(target_mw=target_mw):
+                order = self._order(elements)
+                expected = _as_dicts(backtrack_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories))
+                columns = vectorized_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories)
+                actual = [
+                    {key: row[key] for key in ("formula", "dbr", "predicted_mw")}
+                    for row in columns.to_dicts("[M+H]+")
+                ]
+                self.assertEqual(columns.counts.dtype.name, "int16")
+                self.assertEqual(columns.mass.dtype.name, "float64")
+                self.assertEqual(actual, expected)
+
+    def test_counts_beyond_int16_raise_instead_of_wrapping(self):
+        # 电荷 100、m/z 2900 对应约 29 万 Da 的中性质量，H 数超过 int16 上限
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        with self.assertRaisesRegex(ValueError, "超出计数矩阵上限"):
+            vectorized_search(290000.0, 0.5, self._order({"C": -1, "H": -1}), self.atomic_weights, self.element_categories)
+        # 经进程池计算时该加合物记为失败，不返回回绕成负数的计数
+        with self.assertLogs(level="ERROR") as logs:
+            self.assertEqual(generator.build_formula_columns(2900.0, 0.0, 0.005, 100, "ESI+", ["H+"], {"C": -1, "H": -1}, engine="vectorized"), {})
+        self.assertIn("超出计数矩阵上限", "\n".join(logs.output))
+        with self.assertRaisesRegex(ValueError, "超出计数矩阵上限"):
+            FormulaColumns.from_formulas([{"C": 16400, "H": 32802}], [229858.6], [0.0], ["C", "H"])
+
+    def test_vectorized_engine_matches_backtrack_in_build_formula_results(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        args = (181.07, 0.01, 0.0, 1, "ESI+", ["H+", "Na+"], {"C": -1, "N": -1, "O": -1})
+        expected = generator.build_formula_results(*args, engine="backtrack")
+        actual = generator.build_formula_results(*args, engine="vectorized")
+        self.assertEqual(set(actual), set(expected))
+        for adduct in expected:
+            self.assertEqual(actual[adduct], expected[adduct])
+
+    def test_shared_window_search_matches_independent_searches(self):
+        order = self._order({"C": -1, "N": -1, "O": -1, "S": 2})
+        # H+ / NH4+ / Na+ 的中性质量窗口，其中前两个人为重叠
+        windows = [(180.05, 180.07), (180.06, 180.09), (158.07, 158.09), (163.05, 163.06)]
+        shared = backtrack_search_windows(windows, order, self.atomic_weights, self.element_categories)
+        vectorized = vectorized_search_windows(windows, order, self.atomic_weights, self.element_categories)
+        self.assertEqual(len(shared), len(windows))
+        for (mw_min, mw_max), candidates, columns in zip(windows, shared, vectorized):
+            with self.subTest(window=(mw_min, mw_max)):
+                expected = backtrack_search((mw_min + mw_max) / 2, (mw_max - mw_min) / 2, order, self.atomic_weights, self.element_categories)
+                self.assertTrue(expected)
+                self.assertEqual(_as_dicts(candidates), _as_dicts(expected))
+                self.assertEqual(
+                    [{key: row[key] for key in ("formula", "dbr", "predicted_mw")} for row in columns.to_dicts("")],
+                    _as_dicts(expected),
+                )
+
+    def test_shared_adduct_enumeration_submits_one_search(self):
+        args = (181.07, 0.0, 0.01, 1, "ESI+", ["H+", "NH4+", "Na+", "K+"], {"C": -1, "N": -1, "O": -1})
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        generator.shared_adduct_enumeration = False
+        for engine in ("backtrack", "vectorized"):
+            with self.subTest(engine=engine):
+                expected = generator.build_formula_results(*args, engine=engine)
+                shared_generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+                with _record_submits(1) as submitted:
+                    actual = shared_generator.build_formula_results(*args, engine=engine)
+                self.assertEqual(actual, expected)
+                self.assertEqual(list(actual), list(expected))
+                self.assertTrue(submitted)
+                self.assertTrue(all(len(windows) == 4 for windows in submitted))
+
+    def test_backtrack_search_prunes_unreachable_subtrees_with_capped_elements(self):
+        order = self._order({"C": 12, "N": 3, "O": 6, "H": 24})
+        stats = SearchStats()
+        results = backtrack_search(250.1, 0.05, order, self.atomic_weights, self.element_categories, stats=stats)
+        columns = vectorized_search(250.1, 0.05, order, self.atomic_weights, self.element_categories)
+
+        self.assertTrue(results)
+        self.assertEqual([candidate.formula for candidate in results], [
+            {"O": int(row[0]), "N": int(row[1]), "C": int(row[2]), "H": int(row[3])}
+            for row in columns.counts.tolist()
+        ])
+        self.assertGreater(stats.nodes_pruned, 0)
+        self.assertEqual(stats.candidates, len(results))
+
+    def test_backtrack_search_prunes_root_when_limits_cannot_reach_window(self):
+        order = self._order({"C": 2, "O": 1, "H": 6})
+        stats = SearchStats()
+        results = backtrack_search(400.0, 0.05, order, self.atomic_weights, self.element_categories, stats=stats)
+        self.assertEqual(results, [])
+        # 根节点在剪枝检查处即被剪掉，不计为访问节点
+        self.assertEqual(stats.nodes_visited, 0)
+        self.assertEqual(stats.nodes_pruned, 1)
+
+    def test_valency_propagation_matches_leaf_post_filtering(self):
+        cases = [
+            (300.1, 0.05, {"C": -1, "N": -1, "O": -1}),
+            (450.2, 0.3, {"C": -1, "N": 4, "O": -1, "Cl": 2, "Br": 1}),
+            (260.0, 0.5, {"C": -1, "N": 2, "O": -1, "B": 2, "Si": 1, "F": 4, "P": 1}),
+        ]
+        for target_mw, tolerance, elements in cases:
+            with self.subTest(target_mw=target_mw):
+                order = self._order(elements)
+                expected = backtrack_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories, propagate_valency=False)
+                actual = backtrack_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories, propagate_valency=True)
+                self.assertTrue(expected)
+                self.assertEqual(_as_dicts(actual), _as_dicts(expected))
+
+    def test_valency_propagation_only_builds_valid_candidates(self):
+        order = self._order({"C": -1, "N": -1, "O": -1})
+        original = FormulaCandidate.validate_valency
+        with patch.object(FormulaCandidate, "validate_valency", autospec=True, side_effect=original) as validate_mock:
+            results = backtrack_search(300.1, 0.5, order, self.atomic_weights, self.element_categories)
+        self.assertTrue(results)
+        self.assertEqual(validate_mock.call_count, len(results))
+
+    def test_sharded_search_concatenates_to_unsharded_results(self):
+        order = self._order({"C": -1, "N": -1, "O": -1, "S": -1, "P": -1})
+        target_mw, tolerance = 812.3, 0.02
+        shards = plan_search_shards(target_mw, tolerance, order, 32)
+        self.assertGreater(len(shards), 1)
+        self.assertTrue(any(len(prefix) == 2 for prefix in shards))
+
+        for engine in (backtrack_search, dp_search):
+            with self.subTest(engine=engine.__name__):
+                expected = _as_dicts(engine(target_mw, tolerance, order, self.atomic_weights, self.element_categories))
+                actual = []
+                for prefix in shards:
+                    actual.extend(_as_dicts(engine(target_mw, tolerance, order, self.atomic_weights, self.element_categories, prefix_ranges=prefix)))
+                self.assertEqual(actual, expected)
+
+        expected_columns = vectorized_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories)
+        actual_columns = FormulaColumns.concat(
+            [vectorized_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories, prefix_ranges=prefix) for prefix in shards],
+            expected_columns.elements,
+        )
+        self.assertEqual(actual_columns.to_dicts("[M+H]+"), expected_columns.to_dicts("[M+H]+"))
+
+    def test_plan_search_shards_keeps_small_searches_whole(self):
+        order = self._order({"C": 3, "N": 1, "O": 2, "H": 7})
+        self.assertEqual(plan_search_shards(89.05, 0.01, order, 32), [[]])
+        self.assertEqual(plan_search_shards(812.3, 0.02, self._order({"C": -1, "N": -1}), 1), [[]])
+
+    def test_build_formula_results_rejects_unknown_engine(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        with self.assertRaises(ValueError):
+            generator.build_formula_results(100.0, 0.1, 0.0, 1, "ESI+", ["H+"], {"C": -1}, engine="unknown")
+
+    def test_search_engines_registry_exposes_both_engines(self):
+        self.assertIs(SEARCH_ENGINES["backtrack"], backtrack_search)
+        self.assertIs(SEARCH_ENGINES["dp"], dp_search)
+
+
+class FormulaWorkerPoolTests(unittest.TestCase):
+    def tearDown(self):
+        shutdown_worker_pool()
+
+    def test_worker_pool_is_reused_across_analyses(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        args = (181.07, 0.01, 0.0, 1, "ESI+", ["H+"], {"C": -1, "N": -1, "O": -1})
+        first = generator.build_formula_results(*args)
+        executor = ProcessPool._executor
+        second = FormulaGenerator(CONFIG_PATH, use_query_cache=False).build_formula_results(*args)
+
+        self.assertIsNotNone(executor)
+        self.assertIs(ProcessPool._executor, executor)
+        self.assertEqual(first, second)
+
+    def test_warm_up_starts_configured_number_of_workers(self):
+        with patch("package.core.process_pool.BaseConfig.FORMULA_GENERATION_WORKERS", 2):
+            futures = warm_up_worker_pool()
+            pids = {future.result(timeout=60) for future in futures}
+        self.assertEqual(len(futures), 2)
+        self.assertLessEqual(len(pids), 2)
+        self.assertEqual(ProcessPool._executor._max_workers, 2)
+
+    def test_shutdown_allows_pool_to_be_recreated(self):
+        warm_up_worker_pool()
+        shutdown_worker_pool()
+        self.assertIsNone(ProcessPool._executor)
+
+        future = ProcessPool().submit(sum, [1, 2, 3])
+        self.assertEqual(future.result(timeout=60), 6)
+
+
+class FormulaStreamingTests(unittest.TestCase):
+    def tearDown(self):
+        shutdown_worker_pool()
+
+    def _sorted_rows(self, rows):
+        return sorted(rows, key=lambda row: json.dumps(row, sort_keys=True))
+
+    def test_iter_formula_candidates_matches_batch_results(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        args = (300.1, 0.0, 0.05, 1, "ESI+", ["H+", "Na+"], {"C": -1, "N": -1, "O": -1, "S": 2})
+        expected = [row for rows in generator.build_formula_results(*args).values() for row in rows]
+        for engine in ("backtrack", "vectorized"):
+            with self.subTest(engine=engine):
+                chunks = list(generator.iter_formula_candidates(*args, engine=engine, chunk_size=7))
+                self.assertTrue(all(len(chunk) <= 7 for chunk in chunks))
+                actual = [row for chunk in chunks for row in chunk]
+                self.assertEqual(self._sorted_rows(actual), self._sorted_rows(expected))
+
+    def test_closing_stream_early_cancels_producers(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        stream = generator.iter_formula_candidates(300.1, 0.0, 0.5, 1, "ESI+", ["H+"], {"C": -1, "N": -1, "O": -1}, chunk_size=1)
+        self.assertEqual(len(next(stream)), 1)
+        stream.close()
+
+        future = ProcessPool().submit(sum, [1, 2])
+        self.assertEqual(future.result(timeout=60), 3)
+
+    def test_export_stream_writes_same_document_as_export(self):
+        rows = FormulaGenerator(CONFIG_PATH, use_query_cache=False).build_formula_results(181.07, 0.0, 0.01, 1, "ESI+", ["H+"], {"C": -1, "N": -1, "O": -1})["H+"]
+        input_params = {"m2z": 181.07, "adduct_model": ["H+"]}
+        exporter = JSONExporter_formulaGeneration()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch.object(JSONExporter_formulaGeneration, "_build_json_path", side_effect=[f"{tmp_dir}/full.json", f"{tmp_dir}/stream.json", f"{tmp_dir}/empty.json"]):
+                full = exporter.export({"input_params": input_params, "formulas": {"H+": rows}})
+                summary = exporter.export_stream(input_params, [rows[:2], rows[2:]])
+                empty = exporter.export_stream(input_params, [])
+
+            with open(summary["results_path"], "r", encoding="utf-8") as f:
+                streamed = json.load(f)
+            with open(empty["results_path"], "r", encoding="utf-8") as f:
+                self.assertEqual(json.load(f)["results"], [])
+
+        self.assertEqual(summary["result_count"], len(rows))
+        self.assertEqual(streamed["input_params"], full["input_params"])
+        self.assertEqual(streamed["results"], full["results"])
+
+    def test_csv_export_stream_matches_export_with_optional_gzip(self):
+        rows = FormulaGenerator(CONFIG_PATH, use_query_cache=False).build_formula_results(181.07, 0.0, 0.01, 1, "ESI+", ["H+"], {"C": -1, "N": -1, "O": -1})["H+"]
+        input_params = {"ms_mode": "ESI+", "m2z": 181.07, "error_pct": 0.0, "error_da": 0.01, "charge": 1, "elements": {"C": -1}, "adduct_model": ["H+"]}
+        exporter = CSVExporter_formulaGeneration()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch.object(CSVExporter_formulaGeneration, "_build_csv_path", side_effect=[f"{tmp_dir}/full.csv", f"{tmp_dir}/stream.csv", f"{tmp_dir}/stream.csv.gz"]):
+                exporter.export({"input_params": input_params, "formulas": {"H+": rows}})
+                summary = exporter.export_stream(input_params, [rows[:2], rows[2:]])
+                compressed = exporter.export_stream(input_params, iter([rows[:1], [], rows[1:]]), compress=True)
+
+            with open(f"{tmp_dir}/full.csv", "r", encoding="utf-8") as f:
+                full = f.read()
+            with open(summary["results_path"], "r", encoding="utf-8") as f:
+                streamed = f.read()
+            with gzip.open(compressed["results_path"], "rt", encoding="utf-8") as f:
+                unzipped = f.read()
+
+        self.assertEqual(summary["result_count"], len(rows))
+        self.assertEqual(compressed["result_count"], len(rows))
+        self.assertEqual(len(full.splitlines()), len(rows) + 2)
+        self.assertEqual(streamed, full)
+        self.assertEqual(unzipped, full)
+
+    def test_csv_export_writes_isotope_fields_and_tolerances_only_when_given(self):
+        rows = FormulaGenerator(CONFIG_PATH, use_query_cache=False).build_formula_results(181.07, 0.0, 0.01, 1, "ESI+", ["H+"], {"C": -1, "N": -1, "O": -1})["H+"]
+        scored = [{**row, "calculated_properties": {**row["calculated_properties"], "isotope_score": 0.5}} for row in rows]
+        input_params = {"ms_mode": "ESI+", "m2z": 181.07, "error_ppm": 5.0, "charge": 1, "elements": {"C": -1}, "adduct_model": ["H+"]}
+        exporter = CSVExporter_formulaGeneration()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch.object(CSVExporter_formulaGeneration, "_build_csv_path", side_effect=[f"{tmp_dir}/plain.csv", f"{tmp_dir}/scored.csv"]):
+                exporter.export({"input_params": input_params, "formulas": {"H+": rows}})
+                exporter.export({"input_params": {**input_params, "isotope_m1": 12.0}, "formulas": {"H+": scored}})
+            with open(f"{tmp_dir}/plain.csv", "r", encoding="utf-8") as f:
+                plain = list(csv.reader(f))
+            with open(f"{tmp_dir}/scored.csv", "r", encoding="utf-8") as f:
+                scored_rows = list(csv.reader(f))
+
+        self.assertIn("error_ppm: 5.0ppm", plain[0])
+        self.assertFalse([field for field in plain[0] if field.startswith(("error:", "error_da:", "isotope_"))])
+        self.assertEqual(plain[1][-4:], ["ion", "dbr", "predicted_mz", "molecular_weight"])
+        self.assertEqual(len(plain[2]), len(plain[1]))
+        self.assertIn("isotope_m1: 12.0%", scored_rows[0])
+        self.assertNotIn("isotope_m2: 0%", scored_rows[0])
+        self.assertEqual(scored_rows[1][-1], "isotope_score")
+        self.assertEqual({row[-1] for row in scored_rows[2:]}, {"0.5000"})
+
+    def test_columnar_export_round_trips_rows_and_columns(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        args = (181.07, 0.0, 0.02, 1, "ESI+", ["H+", "Na+"], {"C": -1, "N": -1, "O": -1})
+        columns = generator.build_formula_columns(*args)
+        formulas = generator.build_formula_results(*args)
+        input_params = {"m2z": 181.07, "adduct_model": ["H+", "Na+"]}
+        exporter = ColumnarExporter_formulaGeneration("npz")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with patch.object(ColumnarExporter_formulaGeneration, "_build_path", side_effect=[f"{tmp_dir}/columns.npz", f"{tmp_dir}/rows.npz"]):
+                from_columns = exporter.export({"input_params": input_params, "columns": columns})
+                from_rows = exporter.export({"input_params": input_params, "formulas": formulas})
+            loaded = [read_formula_generation_columns(summary["results_path"]) for summary in (from_columns, from_rows)]
+            for key in ("counts", "mass", "mz", "dbr", "adduct_index"):
+                self.assertIsInstance(loaded[0]["columns"][key], np.memmap)
+            with np.load(from_columns["results_path"]) as archive:
+                np.testing.assert_array_equal(loaded[0]["columns"]["counts"], archive["counts"])
+            loaded = [{**summary, "columns": {key: np.array(value) if isinstance(value, np.memmap) else value for key, value in summary["columns"].items()}} for summary in loaded]
+
+        expected_count = sum(len(rows) for rows in formulas.values())
+        for summary in [from_columns, from_rows] + loaded:
+            table = summary["columns"]
+            self.assertEqual(summary["result_count"], expected_count)
+            self.assertEqual(summary["input_params"], input_params)
+            self.assertEqual(table["adducts"], ["H+", "Na+"])
+            rows = {}
+            for index, adduct_index in enumerate(table["adduct_index"].tolist()):
+                formula = {elem: count for elem, count in zip(table["elements"], table["counts"][index].tolist()) if count}
+                rows.setdefault(table["adducts"][adduct_index], []).append((formula, table["mz"][index], table["mass"][index], table["dbr"][index]))
+            self.assertEqual(rows, {
+                adduct: [(row["formula"], row["calculated_properties"]["predicted_mz"], row["predicted_mw"], row["dbr"]) for row in adduct_rows]
+                for adduct, adduct_rows in formulas.items()
+            })
+
+
+class FormulaResultSaveTests(unittest.TestCase):
+    INPUT = {"ms_mode": "ESI+", "adduct_model": ["H+"], "m2z": 181.07, "error_pct": 0.0, "error_da": 0.01, "charge": 1, "elements": {"C": -1, "N": -1, "O": -1}}
+
+    def tearDown(self):
+        BackgroundWriter().shutdown()
+        shutdown_worker_pool()
+
+    def test_background_writer_drains_queued_writes_on_shutdown(self):
+        written = []
+
+        def slow_write(value):
+            time.sleep(0.02)
+            written.append(value)
+            return value
+
+        writer = BackgroundWriter()
+        futures = [writer.submit(slow_write, value) for value in range(5)]
+        writer.shutdown()
+
+        self.assertEqual(written, list(range(5)))
+        self.assertEqual([future.result(timeout=0) for future in futures], list(range(5)))
+        self.assertEqual(writer.pending(), 0)
+        # 关闭后再次提交会重新启动写出线程
+        self.assertEqual(writer.submit(slow_write, 5).result(timeout=10), 5)
+
+    def test_start_analysis_returns_before_writing_and_saves_on_demand(self):
+        for export_format in ("npz", "json"):
+            with self.subTest(export_format=export_format), tempfile.TemporaryDirectory() as tmp_dir, \
+                    patch.object(BaseConfig, "FORMULA_GENERATION_EXPORT_FORMAT", export_format), \
+                    patch("package.service.formula_generation_service.FormulaGenerator", side_effect=lambda **kwargs: FormulaGenerator(CONFIG_PATH, use_query_cache=False, **kwargs)), \
+                    patch("package.service.public.PathManager") as path_manager_mock:
+                path_manager_mock.return_value.get_formula_generation_cache_path.return_value = tmp_dir
+                with patch.object(BaseConfig, "FORMULA_GENERATION_SAVE_MODE", "manual"):
+                    result = start_analysis(dict(self.INPUT))
+                self.assertEqual(list(Path(tmp_dir).iterdir()), [])
+
+                saved_path = save_analysis_result(result).result(timeout=60)
+                self.assertEqual([path.name for path in Path(tmp_dir).iterdir()], [Path(saved_path).name])
+                if export_format == "npz":
+                    self.assertEqual(read_formula_generation_columns(saved_path)["result_count"], result["result_count"])
+                else:
+                    with open(saved_path, "r", encoding="utf-8") as f:
+                        self.assertEqual(json.load(f)["results"], result["results"])
+
+                with patch.object(BaseConfig, "FORMULA_GENERATION_SAVE_MODE", "async"), \
+                        patch.object(ColumnarExporter_formulaGeneration, "_build_path", return_value=f"{tmp_dir}/async.npz"), \
+                        patch.object(JSONExporter_formulaGeneration, "_build_json_path", return_value=f"{tmp_dir}/async.json"):
+                    async_result = start_analysis(dict(self.INPUT))
+                    BackgroundWriter().shutdown()
+                self.assertEqual(async_result["save_future"].result(timeout=0), f"{tmp_dir}/async.{export_format}")
+                self.assertTrue((Path(tmp_dir) / f"async.{export_format}").exists())
+
+                with patch.object(BaseConfig, "FORMULA_GENERATION_SAVE_MODE", "sync"), \
+                        patch.object(ColumnarExporter_formulaGeneration, "_build_path", return_value=f"{tmp_dir}/sync.npz"), \
+                        patch.object(JSONExporter_formulaGeneration, "_build_json_path", return_value=f"{tmp_dir}/sync.json"):
+                    sync_result = start_analysis(dict(self.INPUT))
+                self.assertEqual(sync_result["results_path"], f"{tmp_dir}/sync.{export_format}")
+                self.assertNotIn("save_future", sync_result)
+                self.assertTrue(Path(sync_result["results_path"]).exists())
+
+
+class FormulaBatchTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = _load_config()
+        cls.atomic_weights = config["atomic_weights"]
+        cls.element_categories = config["element_categories"]
+
+    def tearDown(self):
+        shutdown_worker_pool()
+
+    def test_heavy_atom_table_matches_vectorized_search(self):
+        order = normalize_elements({"C": -1, "N": -1, "O": -1, "S": 2}, self.atomic_weights)
+        table = HeavyAtomTable(order, self.atomic_weights, self.element_categories, 420.0)
+        for target_mw, tolerance in [(180.0634, 0.002), (299.9, 0.02), (350.0, 1.5), (415.2, 0.0005)]:
+            with self.subTest(target_mw=target_mw, tolerance=tolerance):
+                expected = vectorized_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories)
+                actual = table.search(target_mw, tolerance)
+                np.testing.assert_array_equal(actual.counts, expected.counts)
+                np.testing.assert_array_equal(actual.mass, expected.mass)
+        with self.assertRaises(ValueError):
+            table.search(430.0, 0.01)
+
+    def test_build_batch_columns_matches_per_peak_results(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        peaks = [301.14, 181.07, 250.5, 181.07]
+        elements = {"C": -1, "N": -1, "O": -1}
+        batch = generator.build_batch_columns(peaks, 0.0, 0.005, 1, "ESI+", ["Na+", "H+"], elements)
+
+        self.assertEqual(batch["adducts"], ["H+", "Na+"])
+        for peak_idx, m2z in enumerate(peaks):
+            expected = generator.build_formula_results(m2z, 0.0, 0.005, 1, "ESI+", ["H+", "Na+"], elements)
+            for adduct_idx, adduct in enumerate(batch["adducts"]):
+                with self.subTest(peak=peak_idx, adduct=adduct):
+                    selected = (batch["peak_index"] == peak_idx) & (batch["adduct_index"] == adduct_idx)
+                    self.assertEqual(batch["columns"].take(selected).to_dicts(adduct), expected.get(adduct, []))
+
+    def test_batch_chunks_reuse_one_heavy_table_per_worker(self):
+        import package.service.formula_generation_service as generation_service
+
+        order = normalize_elements({"C": -1, "N": -1, "O": -1}, self.atomic_weights)
+        low_chunk = [[(0, 0, 181.0707, 0.005, 1.00728)]]
+        high_chunk = [[(1, 0, 301.1400, 0.005, 1.00728)]]
+        with patch.object(generation_service, "_WORKER_HEAVY_TABLE", None), \
+                patch.object(generation_service, "HeavyAtomTable", wraps=HeavyAtomTable) as table_class:
+            low = generation_service._run_batch_task(low_chunk, order, self.atomic_weights, self.element_categories, 1, None, 301.145)
+            high = generation_service._run_batch_task(high_chunk, order, self.atomic_weights, self.element_categories, 1, None, 301.145)
+            # 元素配置变化时重新展开
+            generation_service._run_batch_task(low_chunk, normalize_elements({"C": -1, "O": -1}, self.atomic_weights), self.atomic_weights, self.element_categories, 1, None, 301.145)
+
+        self.assertEqual([call.args[3] for call in table_class.call_args_list], [301.145, 301.145])
+        for (columns, _, _, _), (target_mw, tolerance) in ((low, (181.0707, 0.005)), (high, (301.1400, 0.005))):
+            expected = vectorized_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories)
+            self.assertTrue(len(expected))
+            np.testing.assert_array_equal(columns.counts, expected.counts)
+
+    def test_batch_counts_heuristic_rejections_per_rule(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False, heuristic_filter=True)
+        elements = {"C": -1, "N": -1, "O": -1}
+        order = normalize_elements(elements, self.atomic_weights)
+        # 后两个峰的窗口重叠，合并为一个质量带只筛选一次
+        peaks = [181.07, 250.1, 250.104]
+        batch = generator.build_batch_columns(peaks, 0.0, 0.005, 1, "ESI+", ["H+"], elements)
+
+        base_mws = [generator._build_adduct_tasks(m2z, 1, "ESI+", ["H+"])[0][1] for m2z in peaks]
+        expected = {}
+        for mw_min, mw_max in ((base_mws[0] - 0.005, base_mws[0] + 0.005), (base_mws[1] - 0.005, base_mws[2] + 0.005)):
+            generator.heuristic_filter.filter_columns(vectorized_search((mw_min + mw_max) / 2, (mw_max - mw_min) / 2, order, self.atomic_weights, self.element_categories), expected)
+        self.assertTrue(expected)
+        self.assertEqual(batch["rejected"], expected)
+
+    def test_ppm_batch_groups_overlapping_peaks_into_bands(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        # 10 ppm 下前三个峰的窗口相互重叠，应合并为一个质量带
+        peaks = [181.0700, 181.0712, 181.0721, 250.5]
+        elements = {"C": -1, "N": -1, "O": -1, "S": 1}
+        with _record_submits(0) as submitted:
+            batch = generator.build_batch_columns(peaks, 0.0, 0.0, 1, "ESI+", ["H+"], elements, error_ppm=10.0)
+        bands = [band for chunk in submitted for band in chunk]
+        self.assertEqual(sorted(len(band) for band in bands), [1, 3])
+
+        for peak_idx, m2z in enumerate(peaks):
+            expected = generator.build_formula_results(m2z, 0.0, 0.0, 1, "ESI+", ["H+"], elements, error_ppm=10.0)
+            with self.subTest(peak=peak_idx):
+                selected = batch["peak_index"] == peak_idx
+                self.assertEqual(batch["columns"].take(selected).to_dicts("H+"), expected.get("H+", []))
+
+    def test_ppm_tolerance_scales_with_mz(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        self.assertAlmostEqual(generator._resolve_mw_tolerance(500.0, 0.0, 0.0, 1, 5.0), 0.0025)
+        self.assertAlmostEqual(generator._resolve_mw_tolerance(500.0, 0.0, 0.0, 2, 5.0), 0.005)
+        # 三种误差同时给出时取最宽的窗口
+        self.assertAlmostEqual(generator._resolve_mw_tolerance(500.0, 0.0, 0.001, 1, 5.0), 0.0025)
+        self.assertAlmostEqual(generator._resolve_mw_tolerance(500.0, 0.0, 0.004, 1, 5.0), 0.004)
+        elements = {"C": -1, "N": -1, "O": -1}
+        self.assertEqual(
+            generator.build_formula_results(181.07, 0.0, 0.0, 1, "ESI+", ["H+"], elements, error_ppm=20.0),
+            generator.build_formula_results(181.07, 0.0, 181.07 * 20.0 / 1e6, 1, "ESI+", ["H+"], elements),
+        )
+
+    def test_start_batch_analysis_writes_one_columnar_file_with_peak_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path_manager = MagicMock()
+            path_manager.get_formula_generation_cache_path.return_value = Path(tmp_dir)
+            with patch("package.service.public.PathManager", return_value=path_manager):
+                summary = start_batch_analysis([181.07, 203.05], {
+                    "ms_mode": "ESI+",
+                    "adduct_model": ["H+", "Na+"],
+                    "error_pct": 0.0,
+                    "error_da": 0.005,
+                    "charge": 1,
+                    "elements": {"C": -1, "N": -1, "O": -1},
+                    "heuristic_filter": True,
+                })
+
+            self.assertEqual(Path(summary["results_path"]).parent, Path(tmp_dir))
+            self.assertTrue(summary["rejected"])
+            with np.load(summary["results_path"]) as data:
+                self.assertEqual(data["peaks"].tolist(), [181.07, 203.05])
+                self.assertEqual(data["adducts"].tolist(), ["H+", "Na+"])
+                self.assertEqual(len(data["peak_index"]), summary["result_count"])
+                self.assertEqual(set(data["peak_index"].tolist()), {0, 1})
+                self.assertEqual(data["counts"].shape, (summary["result_count"], 4))
+                self.assertEqual(json.loads(str(data["input_params"]))["adduct_model"], ["H+", "Na+"])
+
+
+class FormulaLibraryTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        cls.library_root = Path(cls.tmp_dir.name)
+        order = normalize_elements({"C": -1, "N": -1, "O": -1, "S": 2}, cls.generator.atomic_weights)
+        cls.library = build_formula_library(order, cls.generator.atomic_weights, cls.generator.element_categories, 320.0, cls.library_root)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutdown_worker_pool()
+        cls.tmp_dir.cleanup()
+
+    def _patch_library_root(self):
+        path_manager = MagicMock()
+        path_manager.get_formula_library_path.return_value = self.library_root
+        return patch("package.service.formula_library_service.PathManager", return_value=path_manager)
+
+    def test_library_is_mass_sorted_and_memory_mapped(self):
+        self.assertIsInstance(self.library.mass, np.memmap)
+        self.assertTrue(np.all(np.diff(self.library.mass) >= 0))
+        order = normalize_elements({"C": -1, "N": -1, "O": -1, "S": 2}, self.generator.atomic_weights)
+        rebuilt = build_formula_library(order, self.generator.atomic_weights, self.generator.element_categories, 320.0, self.library_root)
+        self.assertIs(rebuilt, self.library)
+
+    def test_library_engine_matches_backtrack_for_covered_queries(self):
+        cases = [
+            (181.07, {"C": -1, "N": -1, "O": -1, "S": 2}),
+            (250.1, {"C": -1, "N": 3, "O": -1}),
+            (149.1, {"C": 10, "O": -1, "H": 12}),
+        ]
+        with self._patch_library_root():
+            for m2z, elements in cases:
+                with self.subTest(m2z=m2z):
+                    order = normalize_elements(elements, self.generator.atomic_weights)
+                    self.assertIsNotNone(find_formula_library(order, self.generator.atomic_weights, self.generator.element_categories, m2z))
+                    args = (m2z, 0.0, 0.02, 1, "ESI+", ["H+", "Na+"], elements)
+                    expected = self.generator.build_formula_results(*args, engine="backtrack")
+                    self.assertTrue(expected)
+                    self.assertEqual(self.generator.build_formula_results(*args, engine="library"), expected)
+
+    def test_chnops_library_matches_vectorized_search(self):
+        order = normalize_elements({"C": -1, "H": -1, "N": -1, "O": -1, "P": -1, "S": -1}, self.generator.atomic_weights)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            library = build_formula_library(order, self.generator.atomic_weights, self.generator.element_categories, 450.0, Path(tmp_dir))
+
+            self.assertGreater(len(library), 500000)
+            self.assertTrue(np.all(np.diff(library.mass) >= 0))
+            # 构建期间的重原子表与各质量段临时文件已清理
+            self.assertEqual(sorted(path.name for path in library.library_dir.iterdir()), ["counts.bin", "dbr.bin", "mass.bin", "meta.json"])
+            # 包含跨越质量段边界（50 Da）与库上限附近的窗口
+            for target_mw, tolerance in ((50.0, 0.02), (301.1, 0.01), (449.95, 0.05)):
+                with self.subTest(target_mw=target_mw):
+                    expected = vectorized_search(target_mw, tolerance, order, self.generator.atomic_weights, self.generator.element_categories)
+                    actual = library.search(target_mw, tolerance, order)
+                    self.assertTrue(len(expected))
+                    np.testing.assert_array_equal(actual.counts, expected.counts)
+                    np.testing.assert_allclose(actual.mass, expected.mass)
+            # 释放内存映射，临时目录才能在 Windows 上删除
+            _OPENED_LIBRARIES.pop(library.library_dir, None)
+            del library
+
+    def test_library_band_reads_only_reachable_heavy_rows_within_memory_budget(self):
+        # CHNOPS 600 Da：约 37 万个重原子组合，575-600 Da 一段约 98 万条分子式
+        order = normalize_elements({"C": -1, "H": -1, "N": -1, "O": -1, "P": -1, "S": -1}, self.generator.atomic_weights)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            heavy_dir = Path(tmp_dir) / "heavy"
+            heavy_count = _write_heavy_table(heavy_dir, order, self.generator.atomic_weights, self.generator.element_categories, 600.0)
+            tracemalloc.start()
+            try:
+                band_count, heavy_rows = _build_library_band(
+                    heavy_dir, heavy_count, order, self.generator.atomic_weights, self.generator.element_categories,
+                    575.0, 600.0, True, Path(tmp_dir) / "band_",
+                )
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            mass = np.fromfile(Path(tmp_dir) / "band_mass.bin", dtype=np.float64)
+
+        self.assertLess(heavy_rows, heavy_count // 2)
+        self.assertEqual(len(mass), band_count)
+        self.assertGreater(band_count, 500000)
+        self.assertTrue(np.all(np.diff(mass) >= 0) and mass[0] >= 575.0 and mass[-1] <= 600.0)
+        # 单段峰值内存按子段展开量控制，而不是随整个库（或整段结果）增长
+        self.assertLess(peak, 160 * 2 ** 20)
+
+    def test_start_analysis_uses_library_by_default(self):
+        input_data = {"ms_mode": "ESI+", "adduct_model": ["H+"], "m2z": 181.07, "error_pct": 0.0, "error_da": 0.01, "charge": 1, "elements": {"C": -1, "N": -1, "O": -1}}
+        searched = []
+        original_search = FormulaLibrary.search
+        with self._patch_library_root(), \
+                patch.object(BaseConfig, "FORMULA_GENERATION_SAVE_MODE", "manual"), \
+                patch.object(BaseConfig, "FORMULA_GENERATION_EXPORT_FORMAT", "json"), \
+                patch("package.service.formula_generation_service.FormulaGenerator", side_effect=lambda **kwargs: FormulaGenerator(CONFIG_PATH, use_query_cache=False, **kwargs)), \
+                patch.object(FormulaLibrary, "search", autospec=True, side_effect=lambda library, *args: searched.append(library) or original_search(library, *args)):
+            result = start_analysis(dict(input_data))
+
+        self.assertEqual(searched, [self.library])
+        expected = self.generator.build_formula_results(181.07, 0.0, 0.01, 1, "ESI+", ["H+"], input_data["elements"], engine="backtrack")["H+"]
+        self.assertEqual(len(result["results"]), len(expected))
+
+    def test_configured_library_is_built_for_the_configured_alphabet(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                patch.object(BaseConfig, "FORMULA_LIBRARY_ELEMENTS", {"C": -1, "H": -1, "O": -1}), \
+                patch.object(BaseConfig, "FORMULA_LIBRARY_MW_LIMIT", 150.0), \
+                patch("package.service.formula_generation_service.FormulaGenerator", side_effect=lambda **kwargs: FormulaGenerator(CONFIG_PATH, **kwargs)), \
+                patch("package.service.formula_library_service.PathManager") as path_manager_mock:
+            path_manager_mock.return_value.get_formula_library_path.return_value = Path(tmp_dir)
+            library = build_configured_formula_library()
+            order = normalize_elements({"C": -1, "O": -1}, self.generator.atomic_weights)
+            self.assertIs(find_formula_library(order, self.generator.atomic_weights, self.generator.element_categories, 120.0), library)
+            self.assertEqual(library.mw_limit, 150.0)
+            _OPENED_LIBRARIES.pop(library.library_dir, None)
+            del library
+
+    def test_library_engine_falls_back_when_query_is_not_covered(self):
+        with self._patch_library_root():
+            order = normalize_elements({"C": -1, "N": -1, "O": -1, "P": 1}, self.generator.atomic_weights)
+            self.assertIsNone(find_formula_library(order, self.generator.atomic_weights, self.generator.element_categories, 200.0))
+            self.assertIsNone(find_formula_library(normalize_elements({"C": -1}, self.generator.atomic_weights), self.generator.atomic_weights, self.generator.element_categories, 400.0))
+            args = (401.2, 0.0, 0.01, 1, "ESI+", ["H+"], {"C": -1, "N": -1, "O": -1})
+            self.assertEqual(
+                self.generator.build_formula_results(*args, engine="library"),
+                self.generator.build_formula_results(*args, engine="backtrack"),
+            )
+
+
+class FormulaQueryCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = FormulaQueryCache(Path(self.tmp_dir.name))
+
+    def tearDown(self):
+        shutdown_worker_pool()
+        self.tmp_dir.cleanup()
+
+    def _generator(self, cache):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        generator.query_cache = cache
+        return generator
+
+    def test_repeated_query_skips_enumeration_and_reuses_adducts(self):
+        elements = {"C": -1, "N": -1, "O": -1}
+        expected = FormulaGenerator(CONFIG_PATH, use_query_cache=False).build_formula_results(181.07, 0.0, 0.01, 1, "ESI+", ["H+", "Na+"], elements)
+        generator = self._generator(self.cache)
+        generator.build_formula_results(181.07, 0.0, 0.01, 1, "ESI+", ["H+"], elements)
+
+        with _record_submits(1) as submitted:
+            actual = generator.build_formula_results(181.07, 0.0, 0.01, 1, "ESI+", ["H+", "Na+"], elements)
+        self.assertEqual(actual, expected)
+        self.assertEqual(list(actual), ["H+", "Na+"])
+        self.assertTrue(submitted)
+        base_mw = 181.07 - generator.ion_weights["Na+"]
+        self.assertTrue(all(abs((low + high) / 2 - base_mw) < 1e-9 for windows in submitted for low, high in windows))
+
+        for engine in ("backtrack", "vectorized"):
+            with self.subTest(engine=engine):
+                with patch.object(ProcessPool, "submit", side_effect=AssertionError("不应再次枚举")):
+                    self.assertEqual(generator.build_formula_results(181.07, 0.0, 0.01, 1, "ESI+", ["H+", "Na+"], elements, engine=engine), expected)
+
+    def test_disk_store_survives_new_cache_instance(self):
+        elements = {"C": -1, "N": -1, "O": -1}
+        expected = self._generator(self.cache).build_formula_results(181.07, 0.0, 0.01, 1, "ESI+", ["H+"], elements)
+        self.cache.flush()
+        fresh_cache = FormulaQueryCache(Path(self.tmp_dir.name))
+        with patch.object(ProcessPool, "submit", side_effect=AssertionError("不应再次枚举")):
+            actual = self._generator(fresh_cache).build_formula_results(181.07, 0.0, 0.01, 1, "ESI+", ["H+"], elements)
+        self.assertEqual(actual, expected)
+
+    def test_memory_lru_and_disk_cap_evict_oldest_entries(self):
+        columns = FormulaColumns.from_formulas([{"C": 1, "H": 4}], [16.0313], [0.0], ["C", "H"])
+        cache = FormulaQueryCache(Path(self.tmp_dir.name), memory_entries=2, disk_limit_bytes=10 ** 9)
+        for key in ("a", "b", "c"):
+            cache.put(key, columns)
+        cache.flush()
+        self.assertEqual(list(cache._memory), ["b", "c"])
+        self.assertEqual(len(list(Path(self.tmp_dir.name).glob("query_*.npz"))), 3)
+
+        entry_size = (Path(self.tmp_dir.name) / "query_a.npz").stat().st_size
+        small_cache = FormulaQueryCache(Path(self.tmp_dir.name), memory_entries=2, disk_limit_bytes=entry_size * 2)
+        small_cache.put("d", columns)
+        small_cache.flush()
+        remaining = sorted(path.name for path in Path(self.tmp_dir.name).glob("query_*.npz"))
+        self.assertEqual(len(remaining), 2)
+        self.assertIn("query_d.npz", remaining)
+        self.assertEqual(small_cache.get("d").counts.tolist(), [[1, 4]])
+
+        # 索引建立后，写入与淘汰只维护累计大小，不再扫描缓存目录
+        small_cache.put("e", columns)
+        with patch.object(Path, "glob", side_effect=AssertionError("不应再扫描目录")):
+            small_cache.put("f", columns)
+            small_cache.flush()
+        self.assertEqual(sorted(path.name for path in Path(self.tmp_dir.name).glob("query_*.npz")), ["query_e.npz", "query_f.npz"])
+        self.assertEqual(small_cache._disk_bytes, entry_size * 2)
+
+    def test_put_persists_off_the_calling_thread(self):
+        columns = FormulaColumns.from_formulas([{"C": 1, "H": 4}], [16.0313], [0.0], ["C", "H"])
+        caller = threading.get_ident()
+        writer_threads = []
+        original_savez = np.savez
+        with patch("package.service.formula_cache_service.np.savez", side_effect=lambda *args, **kwargs: writer_threads.append(threading.get_ident()) or original_savez(*args, **kwargs)):
+            self.cache.put("a", columns)
+            self.assertIs(self.cache.get("a"), columns)
+            self.cache.flush()
+        self.assertEqual(len(writer_threads), 1)
+        self.assertNotEqual(writer_threads[0], caller)
+
+    def test_key_covers_hydrogen_weight_and_schema(self):
+        order = normalize_elements({"C": -1, "O": -1}, {"C": 12.0, "O": 15.994915, "H": 1.007825})
+        categories = {"valency_1": ["H"], "valency_4": ["C"]}
+        key = FormulaQueryCache.make_key(order, categories, 1.007825, 180.0, 0.01)
+        self.assertNotEqual(key, FormulaQueryCache.make_key(order, categories, 1.00794, 180.0, 0.01))
+        with patch("package.service.formula_cache_service._QUERY_CACHE_SCHEMA_VERSION", 99):
+            self.assertNotEqual(key, FormulaQueryCache.make_key(order, categories, 1.007825, 180.0, 0.01))
+
+
+class FormulaWindowReuseTests(unittest.TestCase):
+    def tearDown(self):
+        shutdown_worker_pool()
+
+    def test_widened_window_enumerates_only_edge_bands(self):
+        elements = {"C": -1, "N": -1, "O": -1}
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        generator.window_store = WindowEnumerationStore()
+        generator.build_formula_results(181.07, 0.0, 0.002, 1, "ESI+", ["H+"], elements)
+
+        for engine in ("backtrack", "vectorized"):
+            with self.subTest(engine=engine):
+                expected = FormulaGenerator(CONFIG_PATH, use_query_cache=False).build_formula_results(181.07, 0.0, 0.02, 1, "ESI+", ["H+"], elements, engine=engine)
+                generator.window_store = WindowEnumerationStore()
+                generator.build_formula_results(181.07, 0.0, 0.002, 1, "ESI+", ["H+"], elements, engine=engine)
+                with _record_submits(1) as submitted:
+                    actual = generator.build_formula_results(181.07, 0.0, 0.02, 1, "ESI+", ["H+"], elements, engine=engine)
+                self.assertEqual(actual, expected)
+                self.assertTrue(submitted)
+                # 每个边缘区间的搜索窗口都只覆盖新增部分，不再重复枚举旧窗口
+                base_mw = 181.07 - generator.ion_weights["H+"]
+                self.assertTrue(all(high <= base_mw - 0.002 + 1e-6 or low >= base_mw + 0.002 - 1e-6 for windows in submitted for low, high in windows))
+
+    def test_narrowed_window_filters_previous_result(self):
+        elements = {"C": -1, "N": -1, "O": -1, "S": -1}
+        reference = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        narrow_expected = reference.build_formula_results(181.07, 0.0, 0.005, 1, "ESI+", ["H+"], elements)
+        wide_expected = reference.build_formula_results(181.07, 0.0, 0.02, 1, "ESI+", ["H+"], elements)
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        generator.window_store = WindowEnumerationStore()
+        generator.build_formula_results(181.07, 0.0, 0.02, 1, "ESI+", ["H+"], elements)
+        with patch.object(ProcessPool, "submit", side_effect=AssertionError("不应再次枚举")):
+            self.assertEqual(generator.build_formula_results(181.07, 0.0, 0.005, 1, "ESI+", ["H+"], elements), narrow_expected)
+            # 收窄后仍保留更宽的旧窗口，再次放宽回原窗口也无需枚举
+            self.assertEqual(generator.build_formula_results(181.07, 0.0, 0.02, 1, "ESI+", ["H+"], elements), wide_expected)
+
+class IsotopePatternTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = _load_config()
+        cls.calculator = IsotopePatternCalculator(config["isotopes"], config["atomic_weights"])
+
+    def tearDown(self):
+        shutdown_worker_pool()
+
+    def _pattern(self, formula, elements=None):
+        columns = FormulaColumns.from_formulas([formula], [0.0], [0.0], elements or list(formula))
+        return self.calculator.patterns(columns)[0]
+
+    def test_aggregated_patterns_match_known_ratios(self):
+        glucose = self._pattern({"C": 6, "H": 12, "O": 6})
+        self.assertAlmostEqual(self.calculator.offset_intensity(glucose[None, :], 0)[0], 100.0)
+        self.assertAlmostEqual(self.calculator.offset_intensity(glucose[None, :], 1)[0], 6.86, places=1)
+        self.assertAlmostEqual(self.calculator.offset_intensity(glucose[None, :], 2)[0], 1.43, places=1)
+        bromo = self._pattern({"C": 2, "H": 5, "Br": 1})
+        self.assertAlmostEqual(self.calculator.offset_intensity(bromo[None, :], 2)[0], 97.3, places=0)
+
+    def test_vectorized_patterns_match_single_formula_patterns(self):
+        formulas = [{"C": 20, "H": 30, "N": 2, "O": 4}, {"C": 8, "H": 7, "Cl": 2, "S": 1}, {"C": 12, "H": 10, "B": 1, "Si": 1}, {"C": 5, "H": 8}]
+        elements = ["C", "N", "O", "S", "Cl", "Si", "B", "H"]
+        columns = FormulaColumns.from_formulas(formulas, [0.0] * len(formulas), [0.0] * len(formulas), elements)
+        patterns = self.calculator.patterns(columns)
+        for row, formula in enumerate(formulas):
+            with self.subTest(formula=formula):
+                np.testing.assert_allclose(patterns[row], self._pattern(formula, elements), rtol=1e-9, atol=1e-12)
+
+    def test_score_ranks_matching_pattern_first(self):
+        formulas = [{"C": 6, "H": 12, "O": 6}, {"C": 2, "H": 5, "Br": 1}, {"C": 20, "H": 30}]
+        columns = FormulaColumns.from_formulas(formulas, [0.0] * 3, [0.0] * 3, ["C", "O", "Br", "H"])
+        scores = self.calculator.score(self.calculator.patterns(columns), {1: 2.3, 2: 97.0})
+        self.assertEqual(int(np.argmax(scores)), 1)
+        self.assertEqual(observed_isotope_intensities(0.0, None), {})
+        self.assertEqual(observed_isotope_intensities(6.5, 0), {1: 6.5})
+
+    def test_rank_by_isotope_pattern_keeps_top_candidates_across_adducts(self):
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False)
+        elements = {"C": -1, "N": -1, "O": -1, "S": 2}
+        columns = generator.build_formula_columns(181.07, 0.0, 0.05, 1, "ESI+", ["H+", "Na+"], elements)
+        ranked = generator.rank_by_isotope_pattern(columns, {1: 6.9, 2: 1.4}, limit=10)
+        rows = [row for adduct_rows in ranked.values() for row in adduct_rows]
+        self.assertEqual(len(rows), 10)
+        all_scores = self.calculator.score(
+            self.calculator.patterns(FormulaColumns.concat(list(columns.values()), columns["H+"].elements)), {1: 6.9, 2: 1.4}
+        )
+        self.assertAlmostEqual(min(row["calculated_properties"]["isotope_score"] for row in rows), np.sort(all_scores)[-10])
+        for adduct_rows in ranked.values():
+            scores = [row["calculated_properties"]["isotope_score"] for row in adduct_rows]
+            self.assertEqual(scores, sorted(scores, reverse=True))
+
+
+class FormulaHeuristicFilterTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        config = _load_config()
+        cls.atomic_weights = config["atomic_weights"]
+        cls.element_categories = config["element_categories"]
+        cls.heuristics = HeuristicFilter.from_config(config)
+
+    def tearDown(self):
+        shutdown_worker_pool()
+
+    def test_engines_apply_rules_identically_with_per_rule_counters(self):
+        order = normalize_elements({"C": -1, "N": -1, "O": -1, "S": 2, "Cl": 2}, self.atomic_weights)
+        for target_mw, tolerance in [(300.1, 0.05), (120.0, 0.3)]:
+            with self.subTest(target_mw=target_mw):
+                unfiltered = backtrack_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories)
+                backtrack_stats = SearchStats()
+                expected = backtrack_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories, stats=backtrack_stats, heuristics=self.heuristics)
+                dp_stats = SearchStats()
+                actual = dp_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories, stats=dp_stats, heuristics=self.heuristics)
+                vectorized_rejected = {}
+                columns = self.heuristics.filter_columns(vectorized_search(target_mw, tolerance, order, self.atomic_weights, self.element_categories), vectorized_rejected)
+
+                self.assertLess(len(expected), len(unfiltered))
+                self.assertEqual(_as_dicts(actual), _as_dicts(expected))
+                self.assertEqual([{key: row[key] for key in ("formula", "dbr", "predicted_mw")} for row in columns.to_dicts("")], _as_dicts(expected))
+                self.assertEqual(sum(backtrack_stats.rejected.values()), len(unfiltered) - len(expected))
+                self.assertEqual(dp_stats.rejected, backtrack_stats.rejected)
+                self.assertEqual(vectorized_rejected, backtrack_stats.rejected)
+
+    def test_ratio_and_senior_rules(self):
+        formulas = [{"C": 6, "H": 12, "O": 6}, {"C": 1, "H": 4, "N": 2}, {"C": 2, "H": 8}, {"N": 1, "H": 1}, {"H": 2, "O": 1}]
+        columns = FormulaColumns.from_formulas(formulas, [0.0] * 5, [0.0] * 5, ["C", "N", "O", "H"])
+        rejected = {}
+        kept = self.heuristics.filter_columns(columns, rejected)
+        self.assertEqual(kept.counts.tolist(), [[6, 0, 6, 12], [0, 0, 1, 2]])
+        self.assertEqual(rejected, {"N/C": 1, "H/C": 1, "SENIOR": 1})
+
+    def test_generator_filters_in_every_path(self):
+        elements = {"C": -1, "N": -1, "O": -1}
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False, heuristic_filter=False)
+        unfiltered = generator.build_formula_results(181.07, 0.0, 0.02, 1, "ESI+", ["H+"], elements)["H+"]
+        generator = FormulaGenerator(CONFIG_PATH, use_query_cache=False, heuristic_filter=True)
+        expected = [row for row in unfiltered if self.heuristics.heavy_rejection(row["formula"]) is None
+                    and self.heuristics.hydrogen_rejection(self.heuristics.hydrogen_limits({k: v for k, v in row["formula"].items() if k != "H"}), row["formula"].get("H", 0)) is None]
+        self.assertLess(len(expected), len(unfiltered))
+        for engine in ("backtrack", "dp", "vectorized"):
+            with self.subTest(engine=engine):
+                self.assertEqual(generator.build_formula_results(181.07, 0.0, 0.02, 1, "ESI+", ["H+"], elements, engine=engine)["H+"], expected)
+        batch = generator.build_batch_columns([181.07], 0.0, 0.02, 1, "ESI+", ["H+"], elements)
+        self.assertEqual(batch["columns"].to_dicts("H+"), expected)
+
+    def test_heuristic_setting_is_off_by_default_and_recorded_in_params(self):
+        with patch.object(BaseConfig, "FORMULA_HEURISTIC_FILTER", False):
+            self.assertEqual(FormulaGenerator(CONFIG_PATH, use_query_cache=False).heuristic_params(), {"heuristic_filter": False, "heuristic_rules": None})
+        params = FormulaGenerator(CONFIG_PATH, use_query_cache=False, heuristic_filter=True).heuristic_params()
+        self.assertEqual(params, {"heuristic_filter": True, "heuristic_rules": self.heuristics.cache_key()})
+
+        base = {"ms_mode": "ESI+", "m2z": 181.07, "error_da": 0.01, "charge": 1, "elements": {"C": -1}, "adduct_model": ["H+"]}
+        self.assertIn("heuristic_filter: off", CSVExporter_formulaGeneration._build_param_row(base))
+        param_row = CSVExporter_formulaGeneration._build_param_row({**base, **params})
+        self.assertIn("heuristic_filter: on", param_row)
+        self.assertIn(f"heuristic_rules: {params['heuristic_rules']}", param_row)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,16 +4,20 @@ import os
 import sys
 import threading
 import unittest
+from concurrent.futures import Future
 from pathlib import Path
 from tempfile import TemporaryDirectory
 from types import SimpleNamespace
 from unittest.mock import patch
 
+import numpy as np
+
 sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 
 from package.gui.main_window import APP
 from package.gui.pages.formula_generation_page import FormulaGenerationPage
 from package.gui.pages.formula_search_page import FormulaSearchPage
+from package.service.formula_result_table_service import FormulaResultTable
 from package.utils.widget_factory import WidgetFactory
 
 
@@ -142,6 +146,83 @@ class _FakeTreeviewForContextMenu:
         raise KeyError(option)
 
 
+class _FakeColumnTable:
+    def __init__(self, columns):
+        self._columns = columns
+        self.widths = {}
+
+    def __getitem__(self, key):
+        return self._columns
+
+    def column(self, col, option=None, **kwargs):
+        if option == "width":
+            return 50
+        self.widths[col] = kwargs["width"]
+
+
+class _FakeVirtualTreeview:
+    def __init__(self, columns, height):
+        self._columns = tuple(columns)
+        self._height = height
+        self._items = {}
+        self._order = []
+        self._selection = ()
+        self._focus = ""
+        self.insert_count = 0
+        self.headings = {}
+
+    def __getitem__(self, key):
+        return self._columns
+
+    def winfo_height(self):
+        return self._height
+
+    def get_children(self):
+        return tuple(self._order)
+
+    def delete(self, *row_ids):
+        for row_id in row_ids:
+            self._order.remove(row_id)
+            self._items.pop(row_id)
+
+    def insert(self, parent, index, iid=None, values=()):
+        self.insert_count += 1
+        self._items[iid] = {"values": values}
+        self._order.append(iid)
+        return iid
+
+    def item(self, row_id, option):
+        return self._items[row_id][option]
+
+    def selection(self):
+        return self._selection
+
+    def selection_set(self, row_ids):
+        self._selection = tuple(row_ids) if not isinstance(row_ids, str) else (row_ids,)
+
+    def focus(self, row_id=None):
+        if row_id is None:
+            return self._focus
+        self._focus = row_id
+
+    def index(self, row_id):
+        return self._order.index(row_id)
+
+    def yview_moveto(self, fraction):
+        pass
+
+    def heading(self, column, text=None, **kwargs):
+        self.headings[column] = text
+
+
+class _FakeScrollbar:
+    def __init__(self):
+        self.position = None
+
+    def set(self, first, last):
+        self.position = (first, last)
+
+
 class _FakeEvent:
     x = 10
     y = 10
@@ -170,6 +251,328 @@ class UiBehaviorTests(unittest.TestCase):
         self.assertEqual(page._current_table_context["cell_value"], "99.1234")
         self.assertEqual(page.table_popup_menu.entries[0]["state"], "normal")
 
+    def test_formula_generation_maps_columnar_results_like_json_records(self):
+        columns = {
+            "elements": ["C", "N", "O", "H"],
+            "adducts": ["H+", "Na+"],
+            "adduct_index": np.array([0, 1], dtype=np.int32),
+            "counts": np.array([[6, 0, 6, 12], [5, 1, 2, 9]], dtype=np.int16),
+            "mass": np.array([180.06339, 115.06333]),
+            "mz": np.array([181.07067, 138.05255]),
+            "dbr": np.array([1.0, 3.0]),
+            "isotope_score": np.array([0.5, np.nan]),
+        }
+        records = [
+            {"formula": {"C": 6, "H": 12, "O": 6}, "adduct_type": "H+", "calculated_properties": {"dbr": 1.0, "predicted_mz": 181.07067, "molecular_weight": 180.06339, "isotope_score": 0.5}},
+            {"formula": {"C": 5, "H": 9, "N": 1, "O": 2}, "adduct_type": "Na+", "calculated_properties": {"dbr": 3.0, "predicted_mz": 138.05255, "molecular_weight": 115.06333}},
+        ]
+        column_names = ["Adduct", "M/Z", "DBR", "C", "H", "N", "O", "Cl", "Mol Weight", "Iso Score"]
+
+        from_columns = FormulaResultTable.from_columns(columns)
+        from_records = FormulaResultTable.from_records(records)
+
+        self.assertEqual(from_columns.format_rows(range(2), column_names), from_records.format_rows(range(2), column_names))
+        self.assertEqual(from_columns.format_rows([1], column_names), [("Na+", "138.0525", 3.0, 5, 9, 1, 2, 0, "115.0633", "")])
+        self.assertEqual(from_records.formula(1), "C5H9NO2")
+        self.assertTrue(from_records.has_values("Iso Score"))
+        self.assertFalse(from_records.has_values("Cl"))
+
+    def test_formula_generation_filter_mask_matches_displayed_values(self):
+        records = [
+            {"formula": {"C": count, "H": 2 * count}, "adduct_type": adduct, "calculated_properties": {"dbr": float(count % 3), "predicted_mz": 100.00004 + count, "molecular_weight": 99.0 + count}}
+            for count, adduct in zip(range(1, 7), ["H+", "Na+", "NH4+", "H+", "Na+", "NH4+"])
+        ]
+        table = FormulaResultTable.from_records(records)
+
+        def matched(*conditions):
+            return np.flatnonzero(table.filter_mask(list(conditions))).tolist()
+
+        self.assertEqual(matched(), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(matched({"field": "Adduct", "type": "text", "operator": "等于", "value": " h+ "}), [0, 3])
+        self.assertEqual(matched({"field": "Adduct", "type": "text", "operator": "包含", "value": "H"}), [0, 2, 3, 5])
+        # M/Z 按显示的 4 位小数比较：101.00004 显示为 101.0000
+        self.assertEqual(matched({"field": "M/Z", "type": "number", "operator": "=", "value": 101.0, "second_value": None}), [0])
+        self.assertEqual(matched(
+            {"field": "C", "type": "number", "operator": "区间", "value": 2.0, "second_value": 5.0},
+            {"field": "DBR", "type": "number", "operator": ">", "value": 0.0, "second_value": None},
+        ), [1, 3, 4])
+        self.assertEqual(matched({"field": "Iso Score", "type": "number", "operator": "<", "value": 1.0, "second_value": None}), [])
+        # 138.05255 的二进制值略小于 .5，显示为 138.0525，筛选也按该值比较
+        tie = FormulaResultTable.from_records([{"formula": {"C": 1}, "adduct_type": "H+", "calculated_properties": {"dbr": 0.0, "predicted_mz": 138.05255, "molecular_weight": 137.0}}])
+        self.assertTrue(tie.filter_mask([{"field": "M/Z", "type": "number", "operator": "=", "value": 138.0525, "second_value": None}])[0])
+
+    def test_formula_generation_column_widths_use_cached_column_stats(self):
+        records = [
+            {"formula": {"C": count, "H": 2 * count}, "adduct_type": adduct, "calculated_properties": {"dbr": count / 2, "predicted_mz": mz, "molecular_weight": mz - 1.0}}
+            for count, adduct, mz in [(1, "H+", 99.99996), (12, "Na+", 1234.5), (3, "H+", 56.7)]
+        ]
+        table = FormulaResultTable.from_records(records)
+
+        self.assertEqual(table.widest_strings("M/Z"), ["1234.5000"])
+        # 99.99996 进位显示为 100.0000，按实际显示字符串而非估算长度排序
+        carry = FormulaResultTable.from_records([dict(records[0]), dict(records[2])])
+        self.assertEqual(carry.widest_strings("M/Z"), ["100.0000", "56.7000"])
+        self.assertEqual(table.widest_strings("C")[0], "12")
+        self.assertEqual(table.widest_strings("Adduct"), ["H+", "Na+"])
+        self.assertTrue(table.has_values("Iso Score") is False and table.has_values("H"))
+
+        table.delete_rows([1])
+        self.assertEqual(table.widest_strings("C"), ["1", "3"])
+        self.assertEqual(table.widest_strings("Adduct"), ["H+"])
+
+        page = FormulaGenerationPage.__new__(FormulaGenerationPage)
+        page.table_model = table
+        page.table = _FakeColumnTable(["M/Z", "C"])
+        fonts = []
+
+        class _CountingFont:
+            def __init__(self):
+                fonts.append(self)
+
+            def measure(self, text):
+                return 10 * len(text)
+
+        with patch("package.gui.pages.formula_generation_page.tkFont.Font", _CountingFont):
+            FormulaGenerationPage.auto_resize_columns(page)
+
+        self.assertEqual(len(fonts), 1)
+        self.assertEqual(page.table.widths, {"M/Z": 80, "C": 30})
+
+    def _filter_page(self, records, conditions):
+        page = FormulaGenerationPage.__new__(FormulaGenerationPage)
+        page.table_model = FormulaResultTable.from_records(records)
+        page.displayed_rows = np.zeros(0, dtype=np.int64)
+        page._filter_request_id = 0
+        page._filter_cancel_event = None
+        page._filter_preview_request_id = None
+        page._sort_column = None
+        page._sort_descending = False
+        page.thread_pool = DummyThreadPool()
+        page.filter_feedback_label = _FakeWidget()
+        page.after_calls = []
+        page.after = lambda delay, func, *args: page.after_calls.append((func, args))
+        page.rendered = []
+        page._collect_filter_conditions = lambda: conditions
+        page._serialize_draft_conditions = lambda: [("C", ">=", "2", "")]
+        page._set_filter_action_state = lambda applying: None
+        page._update_filter_dirty_state = lambda: None
+        page._update_result_summary = lambda total, matched: None
+        page._render_rows = lambda rows, keep_view=False: page.rendered.append(rows.tolist())
+        page.previews = []
+        page._render_visible_rows = lambda: page.previews.append(page.displayed_rows.tolist())
+        page.table = SimpleNamespace(delete=lambda *items: None, get_children=lambda: ())
+        return page
+
+    def test_formula_generation_filters_off_tk_thread_and_delivers_via_after(self):
+        records = [
+            {"formula": {"C": count, "H": 4}, "adduct_type": "H+", "calculated_properties": {"dbr": 0.0, "predicted_mz": 50.0 + count, "molecular_weight": 49.0 + count}}
+            for count in range(1, 5)
+        ]
+        page = self._filter_page(records, [{"field": "C", "type": "number", "operator": ">=", "value": 2.0, "second_value": None}])
+
+        FormulaGenerationPage._apply_filters(page)
+        # 求值只提交到线程池，Tk 线程上不做筛选
+        self.assertEqual(len(page.thread_pool.calls), 1)
+        self.assertEqual(page.rendered, [])
+
+        func, args, _ = page.thread_pool.calls[0]
+        func(*args)
+        callback, callback_args = page.after_calls[0]
+        callback(*callback_args)
+        self.assertEqual(page.rendered, [[1, 2, 3]])
+        self.assertEqual(page.displayed_rows.tolist(), [1, 2, 3])
+        self.assertFalse(page.is_filter_dirty)
+
+    def test_formula_generation_discards_superseded_filter_results(self):
+        records = [{"formula": {"C": 1}, "adduct_type": "H+", "calculated_properties": {"dbr": 0.0, "predicted_mz": 13.0, "molecular_weight": 12.0}}]
+        page = self._filter_page(records, [])
+
+        FormulaGenerationPage._apply_filters(page)
+        FormulaGenerationPage._apply_filters(page)
+        for func, args, _ in page.thread_pool.calls:
+            func(*args)
+        for callback, callback_args in page.after_calls:
+            callback(*callback_args)
+
+        self.assertEqual(page.rendered, [[0]])
+
+    def test_formula_generation_filter_cancels_older_scans_and_previews_first_matches(self):
+        records = [
+            {"formula": {"C": count, "H": 4}, "adduct_type": "H+", "calculated_properties": {"dbr": 0.0, "predicted_mz": 50.0 + count, "molecular_weight": 49.0 + count}}
+            for count in range(1, 11)
+        ]
+        page = self._filter_page(records, [{"field": "C", "type": "number", "operator": ">=", "value": 2.0, "second_value": None}])
+
+        with patch("package.gui.pages.formula_generation_page._FILTER_BLOCK_ROWS", 3), \
+                patch("package.gui.pages.formula_generation_page._FILTER_PREVIEW_ROWS", 4):
+            FormulaGenerationPage._apply_filters(page)
+            FormulaGenerationPage._apply_filters(page)
+            (old_func, old_args, _), (new_func, new_args, _) = page.thread_pool.calls
+            # 旧请求的取消标记已置位，扫描在第一块后即停止，不再回报任何结果
+            self.assertTrue(old_args[2].is_set())
+            old_func(*old_args)
+            self.assertEqual(page.after_calls, [])
+
+            new_func(*new_args)
+
+        # 每块回报一次进度；命中数首次达到 4 行时推送已命中的行作为预览
+        progress = [args for func, args in page.after_calls if func == page._on_filter_progress]
+        self.assertEqual([(args[2], args[3]) for args in progress], [(3, 2), (6, 5), (9, 8)])
+        for callback, callback_args in page.after_calls:
+            callback(*callback_args)
+        self.assertEqual(page.previews, [[1, 2, 3, 4, 5]])
+        self.assertEqual(page.filter_feedback_label.configured["text"], "筛选中: 已扫描 9/10 行，已命中 8 行")
+        self.assertEqual(page.rendered, [list(range(1, 10))])
+        self.assertIsNone(page._filter_cancel_event)
+
+    def test_formula_generation_virtual_table_renders_only_visible_window(self):
+        records = [
+            {"formula": {"C": count % 50 + 1, "H": 4}, "adduct_type": "H+", "calculated_properties": {"dbr": 0.0, "predicted_mz": 100.0 + count, "molecular_weight": 99.0 + count}}
+            for count in range(10000)
+        ]
+        page = FormulaGenerationPage.__new__(FormulaGenerationPage)
+        page.table_model = FormulaResultTable.from_records(records)
+        page.displayed_rows = np.arange(1, 10000, 2)
+        page.table = _FakeVirtualTreeview(["M/Z", "Adduct", "C"], height=220)
+        page.table_vsb = _FakeScrollbar()
+        page._is_rendering_view = False
+        page._show_empty_result_guidance = lambda show: None
+        page._set_filter_action_state = lambda applying: None
+
+        with patch("package.gui.pages.formula_generation_page.ttk.Style") as style_mock:
+            style_mock.return_value.lookup.return_value = 20
+            FormulaGenerationPage._render_rows(page, page.displayed_rows)
+            # 220 像素可容纳 10 行数据，另加 2 行缓冲
+            self.assertEqual(len(page.table.get_children()), 12)
+            self.assertEqual(page.table.item(page.table.get_children()[0], "values")[0], "101.0000")
+
+            page.table.selection_set(page.table.get_children()[1])
+            FormulaGenerationPage._on_table_select(page)
+            FormulaGenerationPage._on_table_yscroll(page, "moveto", "0.5")
+            self.assertEqual(page._view_top, 2500)
+            self.assertEqual(len(page.table.get_children()), 12)
+            self.assertEqual(page.table.item(page.table.get_children()[0], "values")[0], f"{100.0 + 5001:.4f}")
+            self.assertEqual(page.table_vsb.position, (0.5, 0.502))
+            self.assertEqual(page.table.selection(), ())
+
+            page.table.selection_set(page.table.get_children()[0])
+            FormulaGenerationPage._on_table_select(page)
+            FormulaGenerationPage._on_table_yscroll(page, "scroll", "-1", "pages")
+            self.assertEqual(page._view_top, 2490)
+            # 滚出窗口的选中行仍被记录
+            self.assertEqual(FormulaGenerationPage._selected_model_rows(page), [3, 5001])
+
+            FormulaGenerationPage._on_table_yscroll(page, "moveto", "1.0")
+            self.assertEqual(page._view_top, 4990)
+
+    def test_formula_generation_sorts_filtered_rows_with_cached_permutations(self):
+        records = [
+            {"formula": {"C": count}, "adduct_type": adduct, "calculated_properties": {"dbr": dbr, "predicted_mz": mz, "molecular_weight": mz - 1.0, **score}}
+            for count, adduct, dbr, mz, score in [
+                (1, "Na+", 2.0, 138.05255, {"isotope_score": 0.2}),
+                (2, "H+", 1.0, 138.05251, {}),
+                (3, "NH4+", 2.0, 90.5, {"isotope_score": 0.9}),
+                (4, "H+", 0.0, 200.25, {"isotope_score": 0.5}),
+            ]
+        ]
+        table = FormulaResultTable.from_records(records)
+        rows = np.array([0, 1, 3])
+
+        # 两行 M/Z 均显示为 138.0525，按显示值视为相同并保持原有顺序
+        self.assertEqual(table.sort_rows(rows, "M/Z").tolist(), [0, 1, 3])
+        self.assertEqual(table.sort_rows(rows, "M/Z", descending=True).tolist(), [3, 0, 1])
+        self.assertEqual(table.sort_rows(np.arange(4), "Adduct").tolist(), [1, 3, 2, 0])
+        # 空的 Iso Score 无论升降序都排在最后
+        self.assertEqual(table.sort_rows(np.arange(4), "Iso Score").tolist(), [0, 3, 2, 1])
+        self.assertEqual(table.sort_rows(np.arange(4), "Iso Score", descending=True).tolist(), [2, 3, 0, 1])
+        permutation = table.sort_permutation("DBR")
+        table.delete_rows([2])
+        self.assertIs(table.sort_permutation("DBR"), permutation)
+
+        page = self._filter_page(records, [])
+        page.table_model = table
+        page.displayed_rows = np.array([0, 1, 3])
+        page.table = _FakeVirtualTreeview(["M/Z", "DBR"], height=220)
+        page._view_top = 5
+        page._selected_positions = {1}
+        page.previews = []
+        FormulaGenerationPage._on_table_heading_click(page, "DBR")
+        FormulaGenerationPage._on_table_heading_click(page, "DBR")
+        self.assertEqual(page.previews, [[3, 1, 0], [0, 1, 3]])
+        self.assertEqual(page.table.headings, {"DBR": "DBR ▼"})
+        self.assertEqual((page._view_top, page._selected_positions), (0, set()))
+
+        FormulaGenerationPage._on_table_heading_click(page, "M/Z")
+        self.assertEqual(page.table.headings, {"DBR": "DBR", "M/Z": "M/Z ▲"})
+        # 新的筛选结果按当前排序列重排，筛选本身不因排序重新执行
+        FormulaGenerationPage._apply_filters(page)
+        func, args, _ = page.thread_pool.calls[0]
+        func(*args)
+        for callback, callback_args in page.after_calls:
+            callback(*callback_args)
+        self.assertEqual(page.rendered, [[0, 1, 3]])
+        page.after_calls.clear()
+        FormulaGenerationPage._on_table_heading_click(page, "M/Z")
+        self.assertEqual(page.displayed_rows.tolist(), [3, 0, 1])
+        self.assertEqual(len(page.thread_pool.calls), 1)
+
+    def test_formula_generation_table_mousewheel_handles_x11_buttons_and_small_deltas(self):
+        page = FormulaGenerationPage.__new__(FormulaGenerationPage)
+        page._view_top = 10
+        scrolled = []
+        page._scroll_view_to = scrolled.append
+
+        for event in (SimpleNamespace(num=5, delta=0), SimpleNamespace(num=4, delta=0),
+                      SimpleNamespace(num="??", delta=-240), SimpleNamespace(num="??", delta=1)):
+            self.assertEqual(FormulaGenerationPage._on_table_mousewheel(page, event), "break")
+
+        self.assertEqual(scrolled, [13, 7, 16, 7])
+
+    def test_formula_generation_table_actions_resolve_rows_by_row_id(self):
+        records = [
+            {"formula": {"C": count, "H": 2 * count + 2}, "adduct_type": "H+", "calculated_properties": {"dbr": 0.0, "predicted_mz": 100.0 + count, "molecular_weight": 99.0 + count}}
+            for count in range(1, 7)
+        ]
+        page = FormulaGenerationPage.__new__(FormulaGenerationPage)
+        page.table_model = FormulaResultTable.from_records(records)
+        page.displayed_rows = np.array([0, 2, 3, 5])
+        page.table = _FakeVirtualTreeview(["M/Z", "Adduct", "C"], height=220)
+        page.table_vsb = _FakeScrollbar()
+        page._view_top = 0
+        page._selected_positions = set()
+        page._is_rendering_view = False
+        page.event_mgr = DummyEventManager()
+        page.event_mgr.published = []
+        page.event_mgr.publish = lambda event_type, data=None, priority=None: page.event_mgr.published.append(data)
+        summaries = []
+        page._update_result_summary = lambda total, matched: summaries.append((total, matched))
+        page._show_empty_result_guidance = lambda show: None
+
+        with patch("package.gui.pages.formula_generation_page.ttk.Style") as style_mock, \
+                patch("package.gui.pages.formula_generation_page.messagebox") as messagebox_mock:
+            style_mock.return_value.lookup.return_value = 20
+            messagebox_mock.askyesno.return_value = True
+            FormulaGenerationPage._render_visible_rows(page)
+            self.assertEqual(page.table.get_children(), ("0", "2", "3", "5"))
+
+            page.table.selection_set(["2"])
+            FormulaGenerationPage._on_table_double_click(page, _FakeEvent())
+            self.assertEqual(page.event_mgr.published, ["C3H8"])
+
+            page.table.selection_set(["3", "5"])
+            FormulaGenerationPage._send_selected_row_to_bus(page)
+            self.assertEqual(page.event_mgr.published[-1], ["C4H10", "C6H14"])
+
+            FormulaGenerationPage._delete_selected_row(page)
+
+        # 删除只标记模型中的行，不重新筛选，其余行下标不变
+        self.assertEqual(page.displayed_rows.tolist(), [0, 2])
+        self.assertEqual(page.table.get_children(), ("0", "2"))
+        self.assertEqual(page.table_model.live_count(), 4)
+        self.assertEqual(summaries[-1], (4, 2))
+        self.assertEqual(page.table_model.filter_mask([]).tolist(), [True, True, True, False, True, False])
+        self.assertEqual(page.table_model.formula(5), "C6H14")
+
     def test_open_json_file_uses_formula_generation_cache_as_default_folder(self):
         expected_dir = Path("E:/Python/Mass_finding/mass_finding_cache/formula_generation_cache")
         page = FormulaGenerationPage.__new__(FormulaGenerationPage)
@@ -202,6 +605,31 @@ class UiBehaviorTests(unittest.TestCase):
 
         self.assertEqual(Path.cwd(), Path(original_cwd))
 
+    def test_save_results_never_writes_a_result_the_service_already_saved(self):
+        pending = Future()
+        page = SimpleNamespace(last_result={"results": [{}]}, _result_save_future=pending)
+        page._on_result_saved = lambda result, done: FormulaGenerationPage._on_result_saved(page, result, done)
+
+        with patch("package.gui.pages.formula_generation_page.save_analysis_result") as save_mock:
+            FormulaGenerationPage._save_results(page)
+            pending.set_result("/cache/async.json")
+            FormulaGenerationPage._save_results(page)
+            page.last_result = {"results": [{}], "results_path": "/cache/sync.json"}
+            page._result_save_future = None
+            FormulaGenerationPage._save_results(page)
+            save_mock.assert_not_called()
+
+            manual = Future()
+            save_mock.return_value = manual
+            page.last_result = {"results": [{}]}
+            FormulaGenerationPage._save_results(page)
+            FormulaGenerationPage._save_results(page)
+            manual.set_result("/cache/manual.json")
+            FormulaGenerationPage._save_results(page)
+
+        save_mock.assert_called_once_with({"results": [{}], "results_path": "/cache/manual.json"})
+        self.assertEqual(page.last_result["results_path"], "/cache/manual.json")
+
     def test_invalid_analysis_input_resets_status_to_done(self):
         dummy_page = SimpleNamespace(
             event_mgr=DummyEventManager(),
@@ -210,8 +638,12 @@ class UiBehaviorTests(unittest.TestCase):
             m2z=DummyVar(100),
             error_pct=DummyVar(0.1),
             error_da=DummyVar(0.0),
+            error_ppm=DummyVar(0.0),
+            isotope_m1=DummyVar(0.0),
+            isotope_m2=DummyVar(0.0),
             charge=DummyVar(1),
             element_vars={"C": DummyVar("bad")},
+            heuristic_filter=DummyVar(False),
             thread_pool=DummyThreadPool(),
         )
 
@@ -245,6 +677,38 @@ class UiBehaviorTests(unittest.TestCase):
         ask_mock.assert_not_called()
         self.assertTrue(destroyed["called"])
 
+    def test_close_request_shuts_down_formula_worker_pool(self):
+        app = APP.__new__(APP)
+        app.current_status_text = "done"
+        app.destroy = lambda: None
+
+        with patch("package.gui.main_window.shutdown_worker_pool") as shutdown_mock:
+            APP._on_close_request(app)
+
+        shutdown_mock.assert_called_once()
+
+    def test_close_request_flushes_pending_result_writes(self):
+        app = APP.__new__(APP)
+        app.current_status_text = "done"
+        app.destroy = lambda: None
+
+        with patch("package.gui.main_window.shutdown_worker_pool"), \
+                patch("package.gui.main_window.shutdown_result_writer") as writer_mock:
+            APP._on_close_request(app)
+
+        writer_mock.assert_called_once()
+
+    def test_close_request_keeps_worker_pool_when_exit_is_cancelled(self):
+        app = APP.__new__(APP)
+        app.current_status_text = "running..."
+        app.destroy = lambda: None
+
+        with patch("package.gui.main_window.messagebox.askyesno", return_value=False), \
+                patch("package.gui.main_window.shutdown_worker_pool") as shutdown_mock:
+            APP._on_close_request(app)
+
+        shutdown_mock.assert_not_called()
+
     def test_event_bus_publish_does_not_deadlock_when_log_listener_fails(self):
         from package.config.event_config import EventPriority, EventType
         from package.core.event import Event, EventBus